@@ -2,130 +2,205 @@
 # Matthew Kroesche
 
 import discord
-import recordclass
-import enum
 import sys
+import os
 import io
+import json
 import datetime
 import re
-import pickle
 import traceback
 import random
-import itertools
 import asyncio
+import heapq
+import itertools
+import contextvars
+import collections
+import concurrent.futures
 
-
-
-GOOD = True
-EVIL = False
-
-APPROVE = True
-REJECT = False
-
-SUCCESS = True
-FAIL = False
-
+from avalon_engine import APPROVE, REJECT, SUCCESS, FAIL, Role, GOOD_ROLES, EVIL_ROLES, ROLE_NAMES, ROLE_COMMANDS, \
+     SPOTIFY_HISTORY, EVENT_ARGS, Game, Announce, Reply, Whisper, Pause, DeleteCommand, GameOver, describe_timeout
+from avalon_stats import StatsStore
+from avalon_metrics import Metrics
+from avalon_ratings import Ratings
+from avalon_pairs import PairStats, tally
+from avalon_infer import RoleInference
 
 
 
-class Role(enum.Enum):
-    # Various player roles in the game
-    SERVANT = 1
-    MINION = 2
-    MERLIN = 3
-    ASSASSIN = 4
-    MORGANA = 5
-    PERCIVAL = 6
-    MORDRED = 7
-    OBERON = 8
-    NOREBO = 9
-    PALM = 10
+MENTION_RE = re.compile(r'<@!?(\d+)>')
+COMMAND_RE = re.compile(r'av \s*(\S+)', re.I) # Matches the start of a bot command, capturing its name
+STATS_RE = re.compile(r'^<@!?(\d+)>: ([\w /]+)$', re.M)
 
+MESSAGE_LIMIT = 2000 # Maximum length of a Discord message
+
+
+
+
+class Outbox:
+
+    # Outgoing message queue for one channel.
+    # Messages posted within `window` seconds of each other are joined with
+    # newlines and sent as a single Discord message (as long as that stays under
+    # MESSAGE_LIMIT characters), in the order they were posted. Each call to
+    # post() returns a future for the message its text ended up in. A failed
+    # send is logged here, so callers only need the future if they want the message.
+
+    def __init__(self, channel, window):
+        self.channel = channel
+        self.window = window
+        self.pending = [] # List of (text, future) pairs waiting to be sent
+        self.timer = None # Task that will flush the queue once the window has passed
+        self.lock = asyncio.Lock() # Only one flush at a time, so messages stay in order
+
+    def post(self, text):
+        future = asyncio.get_event_loop().create_future()
+        future.add_done_callback(retrieve) # Most callers never look at the future
+        self.pending.append((text, future))
+        if self.timer is None:
+            self.timer = asyncio.ensure_future(self.flush_later())
+        return future
+
+    async def flush_later(self):
+        await asyncio.sleep(self.window)
+        self.timer = None
+        await self.flush()
+
+    async def flush(self):
+        # Send everything that is waiting
+        async with self.lock:
+            while self.pending:
+                texts = [self.pending[0][0]]
+                size = len(texts[0])
+                while (len(texts) < len(self.pending)) and (size + 1 + len(self.pending[len(texts)][0]) <= MESSAGE_LIMIT):
+                    size += 1 + len(self.pending[len(texts)][0])
+                    texts.append(self.pending[len(texts)][0])
+                batch = self.pending[:len(texts)]
+                del self.pending[:len(texts)]
+                try:
+                    msg = (await self.channel.send('\n'.join(texts)))
+                except Exception as e:
+                    traceback.print_exc()
+                    for text, future in batch:
+                        future.set_exception(e)
+                else:
+                    for text, future in batch:
+                        future.set_result(msg)
 
 
-GOOD_ROLES = [Role.SERVANT, Role.MERLIN, Role.PERCIVAL, Role.NOREBO, Role.PALM]
-EVIL_ROLES = [Role.MINION, Role.ASSASSIN, Role.MORGANA, Role.MORDRED, Role.OBERON]
 
 
+def retrieve(future):
+    # Mark a future's exception as retrieved, so asyncio doesn't complain that
+    # nobody did (it has already been logged)
+    if not future.cancelled():
+        future.exception()
 
-ROLE_NAMES = [
-    # Descriptive names for all the roles
-    'None',
-    'Loyal Servant of Arthur',
-    'Minion of Mordred',
-    'Merlin',
-    'Assassin',
-    'Morgana',
-    'Percival',
-    'Mordred',
-    'Oberon',
-    'Norebo',
-    'Palm',
-    ]
 
 
-ROLE_COMMANDS = [
-    # Command names for all the roles
-    'none',
-    'servant',
-    'minion',
-    'merlin',
-    'assassin',
-    'morgana',
-    'percival',
-    'mordred',
-    'oberon',
-    'norebo',
-    'palm',
-    ]
 
+class Timers:
 
+    # Every game timer the bot has running (the end of a dramatic pause,
+    # deleting a vote message, and so on), kept in a heap ordered by when each
+    # one is due. Only the earliest is handed to the event loop, so there is
+    # one pending wakeup at any time rather than a sleeping task per timer.
+    # A callback may be a coroutine function, in which case the coroutine is
+    # run as a task of its own when the timer goes off. Callbacks run in the
+    # context they were scheduled from, so that their work is counted against
+    # the command that caused it (see avalon_metrics.py).
 
-FEATURE_NAMES = {
-    # Descriptive names for all the features
-    'merlin': 'Merlin',
-    'morgana': 'Morgana/Percival',
-    'mordred': 'Mordred',
-    'oberon': 'Oberon',
-    'norebo': 'Norebo',
-    'palm': 'Palm',
-    'lady': 'Lady of the Lake',
-    }
+    def __init__(self):
+        self.heap = [] # List of [when, sequence number, callback, args, context] entries
+        self.counter = itertools.count() # Keeps timers that are due at the same time in order
+        self.handle = None # Event loop handle for the earliest timer
+        self.due = None # Event loop time self.handle goes off at
+
+    def schedule(self, delay, callback, *args):
+        # Call callback(*args) in `delay` seconds. Returns a handle for cancel().
+        loop = asyncio.get_event_loop()
+        entry = [loop.time() + delay, next(self.counter), callback, args, contextvars.copy_context()]
+        heapq.heappush(self.heap, entry)
+        if (self.handle is None) or (entry[0] < self.due):
+            self.wake_at(entry[0])
+        return entry
+
+    def cancel(self, entry):
+        # Stop a timer from going off. It stays in the heap until it comes due.
+        entry[2] = None
+
+    def wake_at(self, when):
+        if self.handle:
+            self.handle.cancel()
+        self.handle = asyncio.get_event_loop().call_at(when, self.fire)
+        self.due = when
+
+    def fire(self):
+        # Run every timer that is due, then wait for the next one
+        self.handle = None
+        now = asyncio.get_event_loop().time()
+        while self.heap and (self.heap[0][0] <= now):
+            when, n, callback, args, context = heapq.heappop(self.heap)
+            if callback is None:
+                continue # Canceled
+            try:
+                result = context.run(callback, *args)
+                if asyncio.iscoroutine(result):
+                    context.run(asyncio.ensure_future, self.run(result))
+            except Exception:
+                traceback.print_exc()
+        if self.heap:
+            self.wake_at(self.heap[0][0])
+
+    async def run(self, coro):
+        try:
+            await coro
+        except Exception:
+            traceback.print_exc()
 
 
-MENTION_RE = re.compile(r'<@!?(\d+)>')
-STATS_RE = re.compile(r'^<@!?(\d+)>: ([\w /]+)$', re.M)
 
 
 
-Player = recordclass.recordclass('Player', 'user role side vote outcome')
-# user: the discord.User controlling this player.
-# role: the Role of this player.
-# side: True if this player is good, False if they are evil.
-# vote: True for an approve vote, False for a reject.
-# outcome: True for a success outcome, False for a fail.
 
 
 
-# Game parameters
+def bot_command(*aliases):
+    # Decorator for bot commands. A method named av_NAME is run for "av NAME",
+    # for any of its `aliases` (synonyms, by popular demand), and if it has a
+    # docstring for the shortest abbreviation of NAME not already taken.
+    def register(func):
+        func.aliases = aliases
+        return func
+    return register
 
-N_EVIL = {
-    5 : 2,
-    6 : 2,
-    7 : 3,
-    8 : 3,
-    9 : 3,
-    10: 4,
-    }
 
-QUEST_LISTS = {
-    5 : [(2, 1), (3, 1), (2, 1), (3, 1), (3, 1)],
-    6 : [(2, 1), (3, 1), (4, 1), (3, 1), (4, 1)],
-    7 : [(2, 1), (3, 1), (3, 1), (4, 2), (4, 1)],
-    8 : [(3, 1), (4, 1), (4, 1), (5, 2), (5, 1)],
-    9 : [(3, 1), (4, 1), (4, 1), (5, 2), (5, 1)],
-    10: [(3, 1), (4, 1), (4, 1), (5, 2), (5, 1)],
-    }
+def command_table(cls):
+    # Build the lookup table from command names to the functions decorated with
+    # bot_command in `cls`, along with the help text listing them
+    names = {}
+    for fname, func in vars(cls).items():
+        if fname.startswith('av_') and hasattr(func, 'aliases'):
+            names[fname[3:]] = (func, True)
+            for alias in func.aliases:
+                names[alias] = (func, False)
+    lookup = {}
+    help = '**Avalon bot commands:**\n'
+    snips = set()
+    for name, (func, primary) in sorted(names.items()):
+        lookup[name] = func
+        if not (primary and func.__doc__):
+            continue
+        snipsize = 1
+        while name[:snipsize] in snips:
+            snipsize += 1
+            if snipsize == len(name):
+                snipsize = 0
+                break
+        if snipsize:
+            snips.add(name[:snipsize])
+            lookup[name[:snipsize]] = func
+        help += '\nav __%s__%s: %s' % (name[:snipsize], name[snipsize:], func.__doc__)
+    return lookup, help
 
 
 
@@ -142,38 +217,127 @@ class Avalon(discord.Client):
     ROLE_ID = 697637135414591569 # Avalon role ID for pinging
     PING_DELAY = datetime.timedelta(hours=1) # One-hour ping delay
     VOTE_DELAY = 15 # Number of seconds before voting messages are deleted
+    TIMEOUT_WARNINGS = (120, 30) # Seconds before a phase's time limit runs out to remind people of it
+    ADMIN_ID = 452938434055503892 # User allowed to run debugging and maintenance commands
+    FAN_OUT_LIMIT = 5 # Maximum number of private messages being sent at once
+    SEND_RETRIES = 3 # Number of times to try sending a message that fails for a temporary reason
+    SEND_BACKOFF = 1 # Seconds to wait before the first retry (doubled after each one)
+    COALESCE_WINDOW = 0.1 # Seconds to wait for more messages to a channel before sending them together
+    STATS_CACHE_SIZE = 64 # Number of av stats replies to remember
+    TOP_PLAYERS = 20 # Number of players to show in av top
+    TOP_MIN_GAMES = 10 # Number of rated games needed to appear in av top
+    HISTORY_MONTHS = 24 # Number of months to show in av history
+    SYNERGY_PLAYERS = 10 # Number of partners and opponents to show in av synergy
+    SYNERGY_MIN_GAMES = 5 # Number of games two players need together to appear in av synergy
+    SNAPSHOT_DIR = 'avalon_games' # Directory holding a snapshot of every game in progress
+    METRICS_FILE = None # File to keep the command metrics in for Prometheus to collect, if any
+    METRICS_INTERVAL = 60 # Seconds between updates to METRICS_FILE
 
 
     def __init__(self):
         discord.Client.__init__(self)
         self.main_channel = None # The default channel to post messages in
-        self.owner = None # The player who started the game
-        self.running = False # True if the game is currently ongoing
+        self.channels = {} # Maps IDs to the channels the bot can see
+        self.roles = {} # Maps IDs to the roles in the bot's guilds
+        self.games = {} # Maps channel IDs to the Game being played there
+        self.player_games = {} # Maps user IDs to the Game they are playing
+        self.game_locks = {} # Maps each Game to the lock that serializes commands to it
+        self.held_effects = {} # Maps each Game in a dramatic pause to the (message, effects) pairs waiting for it to end
+        self.timers = Timers() # Game timers, such as dramatic pauses and deleting vote messages
+        self.deadlines = {} # Maps each Game to (phase key, timers) for the time limit on its current phase
+        self.inferences = {} # Maps each Game to the RoleInference following it for av odds, once someone asks
+        self.metrics = Metrics() # Timings and API request counts for every bot command
+        self.writing_metrics = False # True once METRICS_FILE is being updated
+        self.count_requests()
         self.last_ping = None # Keep a delay on pings in #off-topic so they don't flood it
-        self.muted = False # True if we are playing a silent game
         self.fetching_stats = False # True if the bot is busy fetching stats
         self.spotify_mode = False # True if the bot is in Spotify mode
-        self.cmd_lookup = {}
-        self.help = '**Avalon bot commands:**\n'
-        snips = set()
-        for fname in dir(self):
-            if not fname.startswith('av_'):
-                continue
-            func = getattr(self, fname)
-            name = fname[3:]
-            self.cmd_lookup[name] = func
-            if not ((func.__name__ == fname) and func.__doc__):
-                continue
-            snipsize = 1
-            while name[:snipsize] in snips:
-                snipsize += 1
-                if snipsize == len(name):
-                    snipsize = 0
-                    break
-            if snipsize:
-                snips.add(name[:snipsize])
-                self.cmd_lookup[name[:snipsize]] = func
-            self.help += '\nav __%s__%s: %s' % (name[:snipsize], name[snipsize:], func.__doc__)
+        self.stats_store = StatsStore() # Append-only log of player stats
+        self.stats_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1) # The one thread that touches self.stats_store
+        self.ratings = Ratings() # Skill ratings worked out from the stats (also only touched on the stats thread)
+        self.pairs = PairStats() # Teammate and opponent records worked out from the stats (likewise)
+        self.outboxes = {} # Maps channel IDs to their Outbox
+        self.member_ids = {} # Maps lowercased usernames and nicknames to the set of IDs of the users going by them
+        self.member_names = {} # Maps user IDs to usernames, including people who have left
+        self.stats_cache = collections.OrderedDict() # Maps parsed av stats queries to their replies, least recently used first
+        self.stats_cache_version = None # Value of self.stats_store.version when the cache was filled
+
+
+    async def on_ready(self):
+        # Index channels and roles by ID, so they never have to be searched for
+        self.channels = {channel.id: channel for channel in self.get_all_channels()}
+        self.roles = {role.id: role for guild in self.guilds for role in guild.roles}
+        self.main_channel = self.channels.get(self.DEFAULT_CHANNEL)
+        # Index the names of everyone the bot can see
+        self.member_names = (await self.in_stats_thread(self.stats_store.names))
+        self.member_ids = {}
+        for member in self.get_all_members():
+            self.index_names(member.id, member.name, member.nick)
+            self.member_names[member.id] = member.name
+        self.stats_cache.clear()
+        await self.in_stats_thread(self.stats_store.save_names, dict(self.member_names))
+        # Load the stats now rather than during the first query, and work out ratings and so on
+        await self.in_stats_thread(self.stats_store.load)
+        await self.in_stats_thread(self.update_analytics)
+        await self.resume_games()
+        if self.METRICS_FILE and not self.writing_metrics:
+            self.writing_metrics = True
+            self.write_metrics()
+
+
+    async def on_guild_join(self, guild):
+        for channel in guild.channels:
+            await self.on_guild_channel_create(channel)
+        for role in guild.roles:
+            await self.on_guild_role_create(role)
+
+    async def on_guild_remove(self, guild):
+        for channel in guild.channels:
+            await self.on_guild_channel_delete(channel)
+        for role in guild.roles:
+            await self.on_guild_role_delete(role)
+
+    async def on_guild_channel_create(self, channel):
+        self.channels[channel.id] = channel
+        if channel.id == self.DEFAULT_CHANNEL:
+            self.main_channel = channel
+
+    async def on_guild_channel_delete(self, channel):
+        self.channels.pop(channel.id, None)
+        if channel.id == self.DEFAULT_CHANNEL:
+            self.main_channel = None
+
+    async def on_guild_channel_update(self, before, after):
+        await self.on_guild_channel_create(after)
+
+    async def on_guild_role_create(self, role):
+        self.roles[role.id] = role
+
+    async def on_guild_role_delete(self, role):
+        self.roles.pop(role.id, None)
+
+    async def on_guild_role_update(self, before, after):
+        self.roles[after.id] = after
+
+
+    async def on_member_join(self, member):
+        self.index_names(member.id, member.name, member.nick)
+        await self.remember_name(member)
+
+    async def on_member_remove(self, member):
+        # Their name can no longer be used in queries, but stays in self.member_names
+        self.unindex_names(member.id, member.name, member.nick)
+
+    async def on_member_update(self, before, after):
+        if before.nick != after.nick:
+            self.unindex_names(before.id, before.nick)
+            self.index_names(after.id, after.name, after.nick) # (In case their old nickname was also their username)
+
+    async def on_user_update(self, before, after):
+        if before.name != after.name:
+            self.unindex_names(before.id, before.name)
+            self.index_names(after.id, after.name)
+            await self.remember_name(after)
 
 
     async def on_message(self, message):
@@ -181,16 +345,15 @@ class Avalon(discord.Client):
         # This bot does not reply to itself
         if message.author == self.user:
             return
-        # Find the main channel
-        if self.main_channel is None:
-            self.main_channel = discord.utils.get(self.get_all_channels(), id=self.DEFAULT_CHANNEL)
         # This bot only replies to "av" commands
-        if not message.content.lower().startswith('av '):
+        match = COMMAND_RE.match(message.content)
+        if match is None:
             return
-        command = message.content.split(None, 2)[1].lower()
-        if command in self.cmd_lookup:
-            await self.cmd_lookup[command](message)
-        if self.muted and self.running and (message.channel == self.main_channel):
+        func = self.cmd_lookup.get(match.group(1).lower())
+        if func:
+            await self.metrics.run(func.__name__[3:], func(self, message))
+        game = self.games.get(message.channel.id)
+        if game and game.muted and game.running:
             await message.delete()
 
 
@@ -199,6 +362,65 @@ class Avalon(discord.Client):
     ##### Convenience functions that are called by bot commands #####
 
 
+    def count_requests(self):
+        # Count every request made to the Discord API against the command that caused it
+        request = self.http.request
+        async def counted_request(route, **kwargs):
+            self.metrics.api_call('%s %s' % (route.method, route.path))
+            return (await request(route, **kwargs))
+        self.http.request = counted_request
+
+    def write_metrics(self):
+        # Save the metrics to METRICS_FILE, and again every METRICS_INTERVAL seconds
+        try:
+            with open(self.METRICS_FILE + '.tmp', 'w') as o:
+                o.write(self.metrics.prometheus())
+            os.replace(self.METRICS_FILE + '.tmp', self.METRICS_FILE)
+        finally:
+            self.timers.schedule(self.METRICS_INTERVAL, self.write_metrics)
+
+    def index_names(self, user_id, *names):
+        # Let these usernames/nicknames be used to look up the given user
+        for name in names:
+            if name:
+                self.member_ids.setdefault(name.lower(), set()).add(user_id)
+
+    def unindex_names(self, user_id, *names):
+        for name in names:
+            user_ids = self.member_ids.get(name.lower()) if name else None
+            if user_ids:
+                user_ids.discard(user_id)
+                if not user_ids:
+                    del self.member_ids[name.lower()]
+
+    def find_member(self, name):
+        # The ID of the user going by a lowercased username or nickname, or None.
+        # If several people share it, the one with the oldest account is picked.
+        user_ids = self.member_ids.get(name)
+        return min(user_ids) if user_ids else None
+
+    async def remember_name(self, user):
+        self.member_names[user.id] = user.name
+        self.stats_cache.clear() # Their old name may be in there
+        await self.in_stats_thread(self.stats_store.save_names, {user.id: user.name})
+
+    def update_analytics(self):
+        # Bring everything worked out from the stats up to date with any new records (runs on the stats thread)
+        self.ratings.update(self.stats_store)
+        self.pairs.update(self.stats_store)
+
+    async def in_stats_thread(self, func, *args):
+        # Run func(*args) on the stats thread and return the result.
+        # Everything that reads or writes the stats store goes through here, so
+        # that database access and aggregation never hold up the event loop (and
+        # the sqlite connection is only ever used from the thread that opened it).
+        return (await asyncio.get_event_loop().run_in_executor(self.stats_executor, func, *args))
+
+    def display_name(self, user_id):
+        # The name to show for a user in stats tables
+        return self.member_names.get(user_id, str(user_id))
+
+
     async def askyesno(self, question, user, channel):
         # Ask a yes/no question.
         await channel.send(question + ' (Yes/No)')
@@ -211,46 +433,322 @@ class Avalon(discord.Client):
         return yesno.content.lower().strip() == 'yes'
 
 
+    def game_for(self, message):
+        # Find the game a message refers to: the game being played in the channel
+        # it was sent in, or for a private message, the game its author is playing.
+        if message.channel.type == discord.ChannelType.private:
+            return self.player_games.get(message.author.id)
+        return self.games.get(message.channel.id)
+
+
+    def end_game(self, game):
+        # Forget about a game that has been canceled or has finished
+        game.owner = None
+        if self.games.get(game.channel.id) is game:
+            del self.games[game.channel.id]
+            try:
+                os.remove(self.snapshot_path(game.channel.id))
+            except FileNotFoundError:
+                pass
+        for player in game.players:
+            if self.player_games.get(player.user.id) is game:
+                del self.player_games[player.user.id]
+        self.game_locks.pop(game, None)
+        self.inferences.pop(game, None)
+        self.disarm_deadline(game)
+
+
+    def game_lock(self, game):
+        lock = self.game_locks.get(game)
+        if lock is None:
+            lock = self.game_locks[game] = asyncio.Lock()
+        return lock
+
+
+    def phase_key(self, game):
+        # Identifies the phase `game` is in; its time limit starts over whenever this changes
+        phase = game.phase()
+        if phase is None:
+            return None
+        return (phase, game.timeouts[phase], len(game.vote_history), len(game.quest_history), len(game.lady_history))
+
+
+    def arm_deadline(self, game):
+        # Set the timers for the time limit on the game's current phase, unless
+        # they are already running
+        key = self.phase_key(game)
+        current = self.deadlines.get(game)
+        if current and (current[0] == key):
+            return
+        self.disarm_deadline(game)
+        if (key is None) or (key[1] is None):
+            return
+        limit = key[1]
+        timers = [self.timers.schedule(limit - left, self.warn_deadline, game, left) for left in self.TIMEOUT_WARNINGS if left < limit]
+        timers.append(self.timers.schedule(limit, self.expire_deadline, game, key))
+        self.deadlines[game] = (key, timers)
+
+
+    def disarm_deadline(self, game):
+        current = self.deadlines.pop(game, None)
+        if current:
+            for entry in current[1]:
+                self.timers.cancel(entry)
+
+
+    def warn_deadline(self, game, left):
+        # Remind whoever the game is waiting for that time is running out
+        for effect in game.poke():
+            self.post(game.channel, '%s **%s left before the bot decides for them.**' % (effect.text, describe_timeout(left)))
+
+
+    async def expire_deadline(self, game, key):
+        # Make the default choices for whoever has run out of time
+        async with self.game_lock(game):
+            if (game.owner is None) or (self.phase_key(game) != key):
+                return # They made it after all
+            self.deadlines.pop(game, None)
+            moves = game.default_moves()
+            users = []
+            for name, user, args in moves:
+                if user not in users:
+                    users.append(user)
+            self.post(game.channel, '*Time is up! The bot is making the default choice for %s.*' % ', '.join([user.mention for user in users]))
+            for name, user, args in moves:
+                # Nobody is waiting for a reply
+                await self.perform(game, None, [effect for effect in game.command(name, user, *args) if not isinstance(effect, Reply)])
+            self.arm_deadline(game)
+
+
+    def snapshot_path(self, channel_id):
+        return os.path.join(self.SNAPSHOT_DIR, '%d.json' % channel_id)
+
+
+    def save_snapshot(self, game):
+        # Save the state of a game so it can be resumed if the bot restarts.
+        # The snapshot is written to a temporary file and renamed over the old
+        # one, so a crash part way through never leaves a half-written snapshot.
+        if (game.owner is None) or (self.games.get(game.channel.id) is not game):
+            return
+        os.makedirs(self.SNAPSHOT_DIR, exist_ok=True)
+        path = self.snapshot_path(game.channel.id)
+        with open(path + '.tmp', 'w') as o:
+            o.write(json.dumps(game.snapshot(), separators=(',', ':'))) # dumps() uses the C encoder; dump() doesn't
+        os.replace(path + '.tmp', path)
+
+
+    async def resume_games(self):
+        # Pick up the games that were in progress when the bot last stopped
+        if not os.path.isdir(self.SNAPSHOT_DIR):
+            return
+        for filename in os.listdir(self.SNAPSHOT_DIR):
+            if not filename.endswith('.json'):
+                continue
+            path = os.path.join(self.SNAPSHOT_DIR, filename)
+            channel = self.get_channel(int(filename[:-5]))
+            if (channel is None) or (channel.id in self.games):
+                continue
+            try:
+                with open(path) as o:
+                    game = Game.restore(json.load(o), channel, self.user, self.get_user)
+            except (ValueError, KeyError):
+                # Keep the file around for debugging, but don't try it again
+                traceback.print_exc()
+                os.replace(path, path + '.failed')
+                continue
+            self.games[channel.id] = game
+            for player in game.players:
+                self.player_games[player.user.id] = game
+            self.post(channel, '*The bot has restarted. The game in progress has been resumed.*')
+            self.arm_deadline(game) # Time limits start over
+
+
     async def check_game(self, message):
-        # Returns True if there is a game; else prints an error message and returns False
-        if self.owner:
-            return True
+        # Returns the Game this message refers to; else prints an error message and returns None
+        game = self.game_for(message)
+        if game and game.owner:
+            return game
         await message.channel.send('There is no active game right now.')
-        return False
+        return None
 
 
-    async def check_owner(self, message):
-        # Returns True if there is a game and the person who sent this message created it; else prints an error message and returns False
-        if (await self.check_game(message)):
-            if self.owner.user == message.author:
-                return True
-            await message.channel.send('This game was created by %s. You do not have permission to modify it.' % self.owner.user.mention)
-        return False
-    
+    async def send_retrying(self, destination, text):
+        # Send a message, retrying if Discord rate limits us or has a hiccup
+        for attempt in range(self.SEND_RETRIES):
+            try:
+                return (await destination.send(text))
+            except discord.HTTPException as e:
+                if isinstance(e, discord.Forbidden) or not ((e.status == 429) or (e.status >= 500)) \
+                   or (attempt == self.SEND_RETRIES - 1):
+                    raise
+            await asyncio.sleep(self.SEND_BACKOFF * 2 ** attempt)
+
+
+    async def fan_out(self, sends):
+        # Send a list of (destination, text) messages concurrently, at most
+        # FAN_OUT_LIMIT at a time. Messages to the same destination are still
+        # sent in order. A failure only affects its own destination; the list
+        # of destinations that could not be reached is returned.
+        queues = {}
+        for destination, text in sends:
+            queues.setdefault(destination, []).append(text)
+        semaphore = asyncio.Semaphore(self.FAN_OUT_LIMIT)
+        async def send_all(destination, texts):
+            async with semaphore:
+                for text in texts:
+                    await self.send_retrying(destination, text)
+        destinations = list(queues)
+        results = await asyncio.gather(*[send_all(d, queues[d]) for d in destinations], return_exceptions=True)
+        return [d for d, result in zip(destinations, results) if isinstance(result, Exception)]
+
+
+    async def send_safely(self, destination, text):
+        # Send a message like send_retrying(), but log a failure instead of
+        # raising it, so that it can't stop the effects after it from going out.
+        # Returns the message, or None if it couldn't be sent.
+        try:
+            return (await self.send_retrying(destination, text))
+        except Exception:
+            traceback.print_exc()
+            return None
+
+
+    def post(self, channel, text):
+        # Queue a message for `channel`, to be merged with any others posted
+        # shortly after it. Returns a future for the sent message.
+        outbox = self.outboxes.get(channel.id)
+        if outbox is None:
+            outbox = self.outboxes[channel.id] = Outbox(channel, self.COALESCE_WINDOW)
+        return outbox.post(text)
+
+
+    async def post_alone(self, channel, text):
+        # Send a message to `channel` on its own (e.g. so it can be deleted later),
+        # after anything that is already queued for it. Returns None if it couldn't be sent.
+        outbox = self.outboxes.get(channel.id)
+        if outbox:
+            await outbox.flush()
+        return (await self.send_safely(channel, text))
+
+
+    async def perform(self, game, message, effects):
+        # Carry out the effects returned by the game engine in response to `message`.
+        # If the game is in a dramatic pause, they wait until the ones before them
+        # have been carried out after it.
+        self.save_snapshot(game)
+        held = self.held_effects.get(game)
+        if held is not None:
+            held.append((message, effects))
+            return
+        self.held_effects[game] = [(message, effects)]
+        await self.perform_held(game)
 
-    async def check_running(self, message):
-        # Returns True if there is a game and it has been started; else prints an error message and returns False
-        if (await self.check_game(message)):
-            if self.running:
-                return True
-            await message.channel.send('This game has not started yet.')
-        return False
-    
 
-    async def check_not_running(self, message):
-        # Returns True if there is a game and it has not yet started; else prints an error message and returns False
-        if (await self.check_game(message)):
-            if not self.running:
-                return True
-            await message.channel.send('Cannot modify this game, it has already started.')
-        return False
+    async def perform_held(self, game):
+        # Carry out the effects held for `game` in order, up to the next dramatic pause
+        held = self.held_effects[game]
+        paused = False
+        try:
+            while held and not paused:
+                message, effects = held[0]
+                rest = (await self.deliver(game, message, effects))
+                if rest is None:
+                    del held[0]
+                else:
+                    held[0] = (message, rest)
+                    paused = True
+        finally:
+            # Stop holding effects even if something went wrong, or every later
+            # perform() would only add to the list and the game would go silent
+            if not paused:
+                del self.held_effects[game]
+                if game.owner is None:
+                    # The game has been canceled or has finished
+                    self.end_game(game)
+
+
+    async def deliver(self, game, message, effects):
+        # Carry out `effects` up to the first Pause, and schedule the rest of
+        # the held effects to go out when it ends. Returns the effects after
+        # the Pause, or None if there wasn't one. An effect that fails is logged
+        # and skipped, so that it can't hold up the ones after it.
+        whispers = []
+        for i, effect in enumerate(effects + [None]):
+            if isinstance(effect, Whisper):
+                # Private messages are collected up and sent all at once
+                whispers.append((effect.user, effect.text))
+                continue
+            if whispers:
+                failed = (await self.fan_out(whispers))
+                whispers = []
+                if failed:
+                    self.post(game.channel, 'Could not send a private message to %s. Please allow direct messages from server members.' % \
+                                            ', '.join([user.mention for user in failed]))
+            if isinstance(effect, Pause):
+                outbox = self.outboxes.get(game.channel.id)
+                if outbox:
+                    await outbox.flush() # Get everything out before the pause
+                try:
+                    await game.channel.trigger_typing() # Shows until the next message, or about 10 seconds
+                except Exception:
+                    traceback.print_exc()
+                self.timers.schedule(effect.seconds, self.perform_held, game)
+                return effects[i + 1:]
+            try:
+                if isinstance(effect, Announce):
+                    if effect.temporary:
+                        msg = (await self.post_alone(game.channel, effect.text))
+                        if msg:
+                            self.timers.schedule(self.VOTE_DELAY, self.delete_quietly, msg) # Delete after a certain time
+                    else:
+                        self.post(game.channel, effect.text)
+                elif isinstance(effect, Reply):
+                    if message.channel == game.channel:
+                        self.post(game.channel, effect.text)
+                    else:
+                        await self.send_safely(message.channel, effect.text)
+                elif isinstance(effect, DeleteCommand):
+                    await message.delete()
+                elif isinstance(effect, GameOver):
+                    reveal = (await self.post(game.channel, effect.text))
+                    await self.record_game(game, reveal)
+            except Exception:
+                traceback.print_exc()
+        return None
+
+
+    async def delete_quietly(self, message):
+        # Delete a message, if nobody has beaten us to it
+        try:
+            await message.delete()
+        except discord.NotFound:
+            pass
+
+
+    async def run_command(self, game, message, command, *args):
+        # Run one of the game's engine commands for the author of `message` and
+        # carry out its effects. Commands that can change the game are run one at
+        # a time per game, so that all the effects of one (dramatic pauses
+        # included) are delivered before the next one runs; the rest, like
+        # av info, don't have to wait.
+        if command not in EVENT_ARGS:
+            await self.perform(game, message, game.command(command, message.author, *args))
+            return
+        async with self.game_lock(game):
+            if game.owner is None:
+                # It ended while we were waiting
+                await message.channel.send('There is no active game right now.')
+                return
+            await self.perform(game, message, game.command(command, message.author, *args))
+            self.arm_deadline(game)
 
 
-    def find_player(self, user):
-        # Find the Player corresponding to the given user
-        for player in self.players:
-            if player.user == user:
-                return player
+    async def play(self, message, command, *args):
+        # Look up the game `message` refers to and run one of its engine commands,
+        # passing the author of the message along with `args`
+        game = (await self.check_game(message))
+        if game:
+            await self.run_command(game, message, command, *args)
 
 
 
@@ -260,233 +758,188 @@ class Avalon(discord.Client):
     ##### Bot commands #####
 
 
+    @bot_command('new')
     async def av_create(self, message):
         '''Create a new game'''
         # av create: creates a game
-        if self.owner:
-            if self.owner.user != message.author:
-                await message.channel.send('A game is currently being played. Please wait for it to finish, or ask %s to cancel it.' % self.owner.user.mention)
+        if message.channel.type == discord.ChannelType.private:
+            channel = self.main_channel # Games created by private message are played in the default channel
+            if channel is None:
+                await message.channel.send('The default channel could not be found. Please create the game in a server channel instead.')
+                return
+        else:
+            channel = message.channel
+        game = self.games.get(channel.id)
+        if game and game.owner:
+            # (A finished game stays here until its result has been recorded)
+            if game.owner.user != message.author:
+                await message.channel.send('A game is currently being played. Please wait for it to finish, or ask %s to cancel it.' % game.owner.user.mention)
                 return
             if not (await self.askyesno('You have already created a game. Do you want to cancel it and start a new one?', message.author, message.channel)):
                 return
-            if self.owner:
-                await self.main_channel.send('%s has canceled the currently active game.' % message.author.mention)
-        self.owner = Player(message.author, (), None, None, None)
-        self.running = False
-        self.players = [self.owner] # List of Player objects in the game, in order
-        self.team = [] # List of members of the current team
-        self.leader = None
-        self.quest_results = [] # Boolean values signifying which quests so far have passed
-        self.reject_counter = 1 # Number of consecutive teams that have been rejected
-        self.lady = None # The player who currently has the Lady of the Lake
-        self.investigated = [] # Keep track of who has been investigated using Lady of the Lake
-        self.waiting_for_votes = False # True if the client is waiting for people to cast their votes
-        self.waiting_for_outcomes = False # True if the client is waiting for people to decide the outcome
-        self.waiting_for_lady = False # True if the client is waiting for someone to play the Lady of the Lake
-        self.waiting_for_assassin = False # True if the client is waiting for the assassin to kill someone
-        self.has_team = False # if True, init_team() is a no-op until it is switched to False again
-        self.tabulating_votes = False # True if the bot is currently tabulating voting results
-        self.tabulating_outcomes = False # True if the bot is currently tabulating success/fail cards
-        self.muted = False # True if the bot is currently silencing all non-bot command messages
-        self.votekicks = set() # List of people who have requested that the game be canceled due to an unresponsive owner
-        # Game features
-        self.features = {
-            # True means enabled; False disabled.
-            'merlin': True,
-            'morgana': False,
-            'mordred': False,
-            'oberon': False,
-            'norebo': False,
-            'palm': False,
-            'lady': False,
-            }
-        self.merged = [] # Merged roles
+            if game.owner:
+                self.end_game(game)
+                self.post(game.channel, '%s has canceled the currently active game.' % message.author.mention)
+        other = self.player_games.get(message.author.id)
+        if other and other.owner:
+            await message.channel.send('You are already playing a game in %s.' % other.channel.mention)
+            return
+        game = Game(channel, message.author, self.user)
+        self.games[channel.id] = game
+        self.player_games[message.author.id] = game
+        self.save_snapshot(game)
         # Make a public announcement
-        await self.main_channel.send('%s has just created an Avalon game. To join, simply type "av join".' % message.author.mention)
+        self.post(game.channel, '%s has just created an Avalon game. To join, simply type "av join".' % message.author.mention)
         # Ping the #off-topic channel too if it's not too soon to do that
         now = datetime.datetime.now()
         if (self.last_ping is None) or (now - self.last_ping >= self.PING_DELAY):
-            if message.guild:
-                role = discord.utils.get(message.guild.roles, id=self.ROLE_ID)
+            role = self.roles.get(self.ROLE_ID)
+            ping_channel = self.channels.get(self.PING_CHANNEL)
+            if message.guild and role and ping_channel:
                 self.last_ping = now
-                ping_channel = discord.utils.get(self.get_all_channels(), id=self.PING_CHANNEL)
-                await ping_channel.send('%s: an Avalon game has been created in %s!' % (role.mention, self.main_channel.mention))
-                    
-                
+                await ping_channel.send('%s: an Avalon game has been created in %s!' % (role.mention, game.channel.mention))
+
+
+    @bot_command('quit', 'stop', 'end')
     async def av_cancel(self, message):
         '''Cancel a game you created'''
         # av cancel: Cancels a game. Only allowed if you created the game in the first place.
-        if (await self.check_owner(message)):
+        game = (await self.check_game(message))
+        if game:
+            errors = game.check_owner(message.author)
+            if errors:
+                await self.perform(game, message, errors)
+                return
             if (await self.askyesno('Are you sure you wish to cancel the currently active game?', message.author, message.channel)):
-                if self.owner:
-                    self.owner = None
+                if game.owner:
+                    self.end_game(game)
                     # Make a public announcement
-                    await self.main_channel.send('%s has canceled the currently active game.' % message.author.mention)
+                    self.post(game.channel, '%s has canceled the currently active game.' % message.author.mention)
 
 
 
+    @bot_command('in', 'enter')
     async def av_join(self, message):
         '''Join a game that has not yet started'''
         # av join: Joins a game.
-        if (await self.check_not_running(message)):
-            # Make sure we're not already part of the game
-            if self.find_player(message.author):
-                await message.channel.send('You are already part of this game.')
+        game = (await self.check_game(message))
+        if game:
+            other = self.player_games.get(message.author.id)
+            if other and other.owner and (other is not game):
+                await message.channel.send('You are already playing a game in %s.' % other.channel.mention)
                 return
-            # Add the player
-            self.players.append(Player(message.author, (), None, None, None))
-            # Make a public announcement
-            await self.main_channel.send('%s has joined the game.' % message.author.mention)
+            await self.run_command(game, message, 'join')
+            if game.find_player(message.author):
+                self.player_games[message.author.id] = game
 
 
 
+    @bot_command('out', 'exit')
     async def av_leave(self, message):
         '''Leave a game before it begins'''
         # av leave: Leaves a game
-        if (await self.check_not_running(message)):
+        game = (await self.check_game(message))
+        if game:
             # Leave is the same thing as cancel if you're the game owner
-            if self.owner and (message.author == self.owner.user):
+            if (message.author == game.owner.user) and not game.running:
                 await self.av_cancel(message)
                 return
-            # Make sure we're currently part of the game
-            player = self.find_player(message.author)
-            if not player:
-                await message.channel.send('You are not part of this game.')
-                return
-            # Remove the player
-            self.players.remove(player)
-            # Make a public announcement
-            await self.main_channel.send('%s has left the game.' % message.author.mention)
+            await self.run_command(game, message, 'leave')
+            if (not game.find_player(message.author)) and (self.player_games.get(message.author.id) is game):
+                del self.player_games[message.author.id]
 
 
 
-    async def enable(self, message, enable):
-        # Internal method to enable or disable a feature
+    @bot_command()
+    async def av_enable(self, message):
+        '''Enable a feature of the game'''
+        # av enable: Enables a feature
         try:
             feature = message.content.split(None, 2)[2].lower()
         except IndexError:
             # Print usage
-            await message.channel.send('Syntax: av %s [feature]' % ('enable' if enable else 'disable'))
+            await message.channel.send('Syntax: av enable [feature]')
             return
-        if (await self.check_not_running(message)) and (await self.check_owner(message)):
-            # Make sure the feature exists
-            if feature == 'all':
-                # Enable/disable all
-                await self.main_channel.send('all %s' % ('enabled' if enable else 'disabled'))
-                for key in self.features:
-                    self.features[key] = enable
-                return
-            if feature in ('perc', 'percival'):
-                feature = 'morgana' # alias
-            if feature not in self.features:
-                await message.channel.send('Unrecognized feature "%s": should be one of %s, all' % (feature, ', '.join(self.features)))
-                return
-            await self.main_channel.send('%s %s' % (FEATURE_NAMES[feature], 'enabled' if enable else 'disabled'))
-            self.features[feature] = enable
-
-
-
-    async def av_enable(self, message):
-        '''Enable a feature of the game'''
-        # av enable: Enables a feature
-        await self.enable(message, True)
+        await self.play(message, 'enable', feature, True)
 
+    @bot_command()
     async def av_disable(self, message):
         '''Disable a feature of the game'''
         # av disable: Enables a feature
-        await self.enable(message, False)
+        try:
+            feature = message.content.split(None, 2)[2].lower()
+        except IndexError:
+            # Print usage
+            await message.channel.send('Syntax: av disable [feature]')
+            return
+        await self.play(message, 'enable', feature, False)
+
 
-    
 
+    @bot_command()
     async def av_votekick(self, message):
         '''Vote to end the game if the owner has become unresponsive'''
         # av votekick: Votes to end the game
-        if (await self.check_game(message)):
-            self.votekicks.add(message.author.id)
-            if len(self.votekicks) == 1:
-                await message.channel.send('1 person has voted to cancel the game.')
-            else:
-                await message.channel.send('%d people have voted to cancel the game.' % len(self.votekicks))
-            if len(self.votekicks) >= 4:
-                if self.owner:
-                    self.owner = None
-                    # Make a public announcement
-                    await self.main_channel.send('The currently active game has been canceled by popular vote.')
-                
-            
+        await self.play(message, 'votekick')
 
+
+
+    @bot_command()
     async def av_mute(self, message):
         '''Turn on silent mode'''
         # av mute: Blocks discussion during gameplay
-        if (await self.check_not_running(message)) and (await self.check_owner(message)):
-            self.muted = True
-            await self.main_channel.send('**The host has muted the game.** All in-game discussion will be deleted by the bot.')
+        await self.play(message, 'mute', True)
 
+    @bot_command()
     async def av_unmute(self, message):
         '''Turn off silent mode'''
         # av unmute: Unblocks discussion during gameplay
-        if (await self.check_not_running(message)) and (await self.check_owner(message)):
-            self.muted = False
-            await self.main_channel.send('**The host has unmuted the game.** In-game discussion is freely allowed.')
+        await self.play(message, 'mute', False)
 
 
 
+    @bot_command()
+    async def av_timeout(self, message):
+        '''Set how long a phase of the game can take before the bot decides for the players'''
+        # av timeout [phase] [minutes]: Sets the time limit on a phase; "off" removes it
+        args = message.content.split()[2:]
+        seconds = 0
+        if len(args) == 2:
+            if args[1].lower() == 'off':
+                seconds = None
+            else:
+                try:
+                    seconds = round(float(args[1]) * 60)
+                except (ValueError, OverflowError):
+                    pass
+        if (seconds is not None) and (seconds <= 0):
+            # Print usage
+            await message.channel.send('Syntax: av timeout [pick/vote/outcome/lady/assassin/all] [minutes/off]')
+            return
+        await self.play(message, 'timeout', args[0].lower(), seconds)
+
+
+
+    @bot_command()
     async def av_info(self, message):
         '''Print out the current game info'''
         # av info: Prints out game info
-        if (await self.check_game(message)):
-            info = '**Current players:**\n%s\n' % ', '.join([player.user.name for player in self.players])
-            info += 'Game owner: %s\n' % self.owner.user.mention
-            if self.muted:
-                info += '*This is a silent game.*\n'
-            info += '**Game settings:**\n%s\n' % '\n'.join(['%s %s' % \
-                                                            (FEATURE_NAMES[key], 'enabled' if value else 'disabled') \
-                                                            for key, value in self.features.items()])
-            if self.merged:
-                info += '**Merged roles:**\n%s\n' % '\n'.join([', '.join([ROLE_NAMES[role.value] for role in group]) for group in self.merged])
-            if not self.running:
-                info += 'Game has not yet started.'
-                await message.channel.send(info)
-                return
-            info += '**Current team**:\n%s\n' % ', '.join([player.user.name for player in self.team])
-            info += '**Current results**:\n```\n%s\n%s\nVote tracker: %d\n```\n' % \
-                    (' '.join([str(i[0]) for i in QUEST_LISTS[len(self.players)]]),
-                     ' '.join(['S' if i else 'F' for i in self.quest_results]),
-                     self.reject_counter)
-            if self.lady:
-                info += '%s currently has the Lady of the Lake' % self.lady.user.name
-            if self.muted and self.running:
-                await message.author.send(info)
-            else:
-                await message.channel.send(info)
-            await self.av_poke(message)
+        await self.play(message, 'info')
 
 
 
+    @bot_command('prod')
     async def av_poke(self, message):
         '''Pokes people who need to make a decision'''
         # av poke: pings people who the game is currently waiting for to make a decision
-        if (await self.check_running(message)):
-            if self.waiting_for_votes:
-                await message.channel.send('*Currently waiting for the following players to cast their votes: %s*' % \
-                                           ', '.join([p.user.mention for p in self.players if p.vote is None]))
-            elif self.waiting_for_outcomes:
-                await message.channel.send('*Currently waiting for the following players to play their Success/Fail cards: %s*' % \
-                                           ', '.join([p.user.mention for p in self.team if p.outcome is None]))
-            elif self.waiting_for_lady:
-                await message.channel.send('*Currently waiting for %s to play the Lady of the Lake*' % self.lady.user.mention)
-            elif self.waiting_for_assassin:
-                await message.channel.send('*Currently waiting for %s to pick someone to assassinate*' % self.assassin.user.mention)
-            elif self.leader and (len(self.team) < self.current_quest[0]):
-                n = self.current_quest[0] - len(self.team)
-                await message.channel.send('*Currently waiting for %s to pick %d%s team member%s*' % \
-                                           (self.leader.user.mention, n, (' more' if self.team else ''), ('s' if n > 1 else '')))
-            else:
-                await message.channel.send('*Not currently waiting for anyone to make a decision.*')
+        game = (await self.check_game(message))
+        if game:
+            await self.perform(game, message, game.poke())
 
 
 
 
+    @bot_command()
     async def av_merge(self, message):
         '''Merge two special roles'''
         # av merge: merge two or more roles
@@ -495,127 +948,32 @@ class Avalon(discord.Client):
             # Print usage
             await message.channel.send('Syntax: av merge [role1 role2 ...]')
             return
-        if (await self.check_not_running(message)) and (await self.check_owner(message)):
-            values = []
-            # Look up the roles based on the string
-            for role in roles:
-                try:
-                    value = ROLE_NAMES[3:].index(role.title()) + 3
-                except ValueError:
-                    # Role does not exist
-                    await message.channel.send('Unrecognized role "%s": should be one of %s' % (role, ', '.join(ROLE_NAMES[3:])))
-                    return
-                else:
-                    if Role(value) in values:
-                        await message.channel.send('Duplicate role "%s"' % role)
-                        return
-                    values.append(Role(value))
-            # Find everything else that overlaps and merge it into one
-            for merge in self.merged[:]:
-                if set(merge).intersect(values):
-                    values.extend(merge)
-                    self.merged.remove(merge)
-            values = sorted(set(values), key = lambda x: x.value)
-            # Make sure the merged roles are actually okay to merge
-            # First check that they are either all good or all evil
-            good = [value for value in values if value in GOOD_ROLES]
-            if len(good) not in (0, len(values)):
-                await message.channel.send('Cannot merge good roles with evil roles.')
-                return
-            if (Role.MERLIN in values) and (Role.PERCIVAL in values):
-                await message.channel.send('Cannot merge Merlin with Percival.') # This would break too many things
-                return
-            self.merged.append(values)
-            # Enable things if necessary
-            for role in values:
-                name = ROLE_NAMES[role.value].lower()
-                if name == 'assassin': name = 'merlin'
-                if name == 'percival': name = 'morgana'
-                if not self.features[name]:
-                    self.features[name] = True
-                    await message.channel.send('%s enabled' % FEATURE_NAMES[name])
-            # Make a public announcement
-            await self.main_channel.send('Roles %s have been merged for this game.' % ', '.join([ROLE_NAMES[role.value] for role in values]))
+        await self.play(message, 'merge', roles)
 
 
 
 
+    @bot_command()
     async def av_unmerge(self, message):
         '''Unmerge all previously merged special roles'''
         # av unmerge: unmerge all roles
-        if (await self.check_not_running(message)) and (await self.check_owner(message)):
-            self.merged = []
-            await self.main_channel.send('All roles have been unmerged for this game.')
+        await self.play(message, 'unmerge')
 
 
 
 
+    @bot_command('begin')
     async def av_start(self, message):
         '''Start the game that was previously created'''
         # av start: starts the game
-        if (await self.check_owner(message)):
-            if self.running:
-                await message.channel.send('The game has already started.')
-                return
-            # Set up the quests
-            try:
-                self.quests = iter(QUEST_LISTS[len(self.players)])
-            except KeyError:
-                await message.channel.send('Cannot start: this game has too %s players' % ('few' if len(self.players) < 5 else 'many'))
-                return
-            self.current_quest = next(self.quests) # This is always a 2-tuple (team members, fails required)
-            self.running = True
-            # Make a public announcement
-            await self.main_channel.send('The game has now been started!')
-            # Set up the game
-            random.seed() # Seed the random number generator
-            random.shuffle(self.players) # Randomize the play order
-            if self.features['lady']:
-                self.lady = self.players[-1] # Give the Lady of the Lake to the last player who will get to lead a team
-                self.investigated = [self.lady]
-            await self.av_info(message) # Print out the public info
-            await self.secret_info()
-            await self.init_team()
-
-
-
-    async def pick(self, message, *users):
-        # Internal method to add people to the team
-        if (await self.check_running(message)):
-            if message.author != self.leader.user:
-                await message.channel.send('Error: You are not currently the leader of the team.')
-                return
-            if len(self.team) == self.current_quest[0]:
-                await message.channel.send('Error: Your team is currently full.')
-                return
-            new_players = []
-            for user in users:
-                player = self.find_player(user)
-                if not player:
-                    await message.channel.send('Error: %s is not part of the game.' % user.name)
-                    return
-                if player in self.team + new_players:
-                    await message.channel.send('Error: %s is already part of the team.' % player.user.name)
-                    return
-                new_players.append(player)
-                if len(self.team + new_players) > self.current_quest[0]:
-                    await message.channel.send('Error: the team only has room for %d members.' % self.current_quest[0])
-                    return
-            # Add the new players then
-            self.team.extend(new_players)
-            # Make a public announcement:
-            await self.main_channel.send('%s added new teammate%s %s.' % (self.leader.user.mention,
-                                                                          's' if len(new_players) >= 2 else '',
-                                                                          ', '.join([player.user.mention for player in new_players])))
-            # Figure out if we now have the correct number
-            if len(self.team) == self.current_quest[0]:
-                await self.init_voting()
-            else:
-                n = self.current_quest[0] - len(self.team)
-                await message.channel.send('You still need to pick %d more teammate%s.' % (n, 's' if n >= 2 else ''))
+        spotify_stats = None
+        if self.spotify_mode:
+            spotify_stats = (await self.fetch_stats())
+        await self.play(message, 'start', None, spotify_stats)
 
 
 
+    @bot_command('choose', 'add', 'picc')
     async def av_pick(self, message):
         '''Pick someone as a member of your team (note there is no way to "un-pick" them later!)'''
         # av pick: Pick people to join your team
@@ -623,136 +981,51 @@ class Avalon(discord.Client):
             # Print usage
             await message.channel.send('Syntax: av pick [mention teammates]')
             return
-        await self.pick(message, *message.mentions)
+        await self.play(message, 'pick', message.mentions)
 
+    @bot_command()
     async def av_pickme(self, message):
         '''Shortcut to pick yourself for your own team'''
         # av pickme: Pick yourself to join your team
-        await self.pick(message, message.author)
+        await self.play(message, 'pick', [message.author])
 
+    @bot_command('rand', 'random')
     async def av_pickrandom(self, message):
         '''Pick a random person to join your team'''
         # av pickrandom: Pick a random person to join your team
-        if (await self.check_running(message)):
-            await self.pick(message, random.choice([p for p in self.players if p not in self.team]).user)
-
-
-
-    async def vote(self, message, vote):
-        # Internal method to vote for or against a team
-        if (await self.check_running(message)):
-            if message.channel.type != discord.ChannelType.private:
-                await message.delete()
-                await message.channel.send('Votes should be cast in a **private message** to %s. Please try again.' % self.user.mention)
-                return
-            if len(self.team) != self.current_quest[0]:
-                await message.channel.send('Cannot vote: the team is not full yet.')
-                return
-            player = self.find_player(message.author)
-            if player is None:
-                await message.channel.send('Cannot vote: you are not part of this game.')
-                return
-            if not self.waiting_for_votes:
-                await message.channel.send('Sorry, it is too late to change your vote.')
-                return
-            if player.vote is None:
-                await message.channel.send('Thank you for voting!')
-            else:
-                await message.channel.send('Your vote has been updated.')
-            player.vote = vote
-            if not any([p.vote is None for p in self.players]):
-                # Only do this *once*!
-                if not self.tabulating_votes:
-                    self.tabulating_votes = True
-                else:
-                    return
-                approved = (await self.tabulate_votes())
-                if self.running:
-                    if approved:
-                        await self.init_outcome()
-                    else:
-                        self.has_team = False
-                        await self.init_team()
-                # Reset the votes to make extra sure
-                for player in self.players:
-                    player.vote = None
-                self.tabulating_votes = False
+        await self.play(message, 'pickrandom')
 
 
 
+    @bot_command('accept', 'yes', 'yee', 'ok', 'okay', 'aight', 'yep', 'yeet')
     async def av_approve(self, message):
         '''Vote yes to a proposed team'''
         # av approve: Signal that you approve of the proposed team.
-        await self.vote(message, APPROVE)
+        await self.play(message, 'vote', APPROVE, message.channel.type == discord.ChannelType.private)
 
+    @bot_command('no', 'nope', 'noway', 'rejecc')
     async def av_reject(self, message):
         '''Vote no to a proposed team'''
         # av reject: Signal that you disapprove of the proposed team.
-        await self.vote(message, REJECT)
-
-
-
-    async def outcome(self, message, outcome):
-        # Internal method to signal a quest to succeed or fail
-        if (await self.check_running(message)):
-            if message.channel.type != discord.ChannelType.private:
-                await message.delete()
-                await message.channel.send('Play your success or fail cards in a **private message** to %s, you doofus.' % self.user.mention)
-                return
-            if not self.waiting_for_outcomes:
-                await message.channel.send('Too early to play success or fail cards.')
-                return
-            player = self.find_player(message.author)
-            if player is None:
-                await message.channel.send('Cannot play success/fail cards: you are not part of this game.')
-                return
-            if player not in self.team:
-                await message.channel.send('Cannot play success/fail cards: you are not part of this team.')
-                return
-            if player.outcome is not None:
-                await message.channel.send('You have already played a success/fail card.')
-                return
-            if (player.side == GOOD) and (outcome == FAIL):
-                await message.channel.send('Servants of Arthur are not permitted to play Fail cards. Please use the "av success" command.')
-                return
-            player.outcome = outcome
-            await message.channel.send('Thank you for playing your card!')
-            if self.team and not any([p.outcome is None for p in self.team]):
-                # Only do this *once*!
-                if not self.tabulating_outcomes:
-                    self.tabulating_outcomes = True
-                else:
-                    return
-                if self.waiting_for_lady:
-                    return
-                await self.tabulate_outcome()
-                if self.running and not self.waiting_for_assassin:
-                    if self.lady and (len(self.quest_results) >= 2):
-                        self.waiting_for_lady = True
-                        await self.main_channel.send('**Lady of the Lake:** %s, choose someone to investigate using "av lady".' % self.lady.user.mention)
-                    else:
-                        self.current_quest = next(self.quests)
-                        self.has_team = False
-                        await self.init_team()
-                # Reset the outcomes to make extra sure
-                for player in self.players:
-                    player.outcome = None
-                self.tabulating_outcomes = False
+        await self.play(message, 'vote', REJECT, message.channel.type == discord.ChannelType.private)
 
 
 
+    @bot_command('succ')
     async def av_success(self, message):
         '''Signal that a quest should succeed'''
         # av success: Signal that a quest should succeed.
-        await self.outcome(message, SUCCESS)
+        await self.play(message, 'outcome', SUCCESS, message.channel.type == discord.ChannelType.private)
 
+    @bot_command('sab', 'sabotage')
     async def av_fail(self, message):
         '''Cause a quest to fail'''
         # av fail: Signal that a quest should fail.
-        await self.outcome(message, FAIL)
+        await self.play(message, 'outcome', FAIL, message.channel.type == discord.ChannelType.private)
 
 
 
+    @bot_command('investigate')
     async def av_lady(self, message):
         '''Investigate the alignment of another player using Lady of the Lake'''
         # av lady: Pick someone to investigate.
@@ -760,37 +1033,11 @@ class Avalon(discord.Client):
             # Print usage
             await message.channel.send('Syntax: av lady [mention target]')
             return
-        if (await self.check_running(message)):
-            if not self.waiting_for_lady:
-                await message.channel.send('Error: It is not currently time to use the Lady of the Lake.')
-                return
-            if message.author != self.lady.user:
-                await message.channel.send('Error: You do not currently have the Lady of the Lake.')
-                return
-            target = message.mentions[0]
-            player = self.find_player(target)
-            if not player:
-                await message.channel.send('Error: %s is not part of the game.' % target.name)
-                return
-            if player.user == message.author:
-                await message.channel.send('Error: you cannot investigate yourself.')
-                return
-            if player in self.investigated:
-                await message.channel.send('Error: you cannot investigate someone who has already had the Lady of the Lake.')
-                return
-            # Make a public announcement
-            await self.main_channel.send('**Lady of the Lake:** %s has chosen to investigate %s.' % (self.lady.user.mention, player.user.mention))
-            # Send a private message
-            await self.lady.user.send('Investigative result: %s is **%s**' % (player.user.name, 'Good' if player.side == GOOD else 'Evil'))
-            # And update who has the Lady of the Lake
-            self.lady = player
-            self.waiting_for_lady = False
-            self.current_quest = next(self.quests)
-            self.has_team = False
-            await self.init_team()
-            
+        await self.play(message, 'lady_of_the_lake', message.mentions[0])
+
 
 
+    @bot_command('shoot', 'kill')
     async def av_assassinate(self, message):
         '''Try to kill Merlin (if you are the Assassin and it is the end of the game)'''
         # av assassinate: Pick someone to assassinate.
@@ -798,32 +1045,12 @@ class Avalon(discord.Client):
             # Print usage
             await message.channel.send('Syntax: av assassinate [mention victim]')
             return
-        if (await self.check_running(message)):
-            if not self.waiting_for_assassin:
-                await message.channel.send('Error: It is not currently time to assassinate someone.')
-                return
-            if message.author != self.assassin.user:
-                await message.channel.send('Error: You are not the Assassin.')
-                return
-            target = message.mentions[0]
-            player = self.find_player(target)
-            if not player:
-                await message.channel.send('Error: %s is not part of the game.' % target.name)
-                return
-            # Make a public announcement
-            await self.main_channel.send('**Assassin:** %s has chosen to assassinate %s.' % (self.assassin.user.mention, player.user.mention))
-            async with self.main_channel.typing():
-                await asyncio.sleep(5) # Pause for dramatic effect
-            if Role.MERLIN in player.role:
-                await message.channel.send('**The game is over. %s correctly identified Merlin. Evil wins!!**' % self.assassin.user.mention)
-                await self.finish_game(EVIL)
-            else:
-                await message.channel.send('**The game is over. %s failed to identify Merlin. Good wins!!**' % self.assassin.user.mention)
-                await self.finish_game(GOOD)
-            
+        await self.play(message, 'assassinate', message.mentions[0])
+
 
 
 
+    @bot_command('characters', 'chars')
     async def av_roles(self, message):
         '''Print out info about the gameplay roles'''
         # av characters: DMs character info
@@ -841,16 +1068,19 @@ Lady of the Lake - a card used to learn the alignment of another player''')
 
 
 
+    @bot_command()
     async def av_rules(self, message):
         '''Gives link to the game rulebook'''
         # av rules: Posts link to game rules
         await message.channel.send('http://upload.snakesandlattes.com/rules/r/ResistanceAvalon.pdf')
 
+    @bot_command()
     async def av_ping(self, message):
         '''Ping the Avalon bot'''
         # av ping: Ping the Avalon bot
         await message.channel.send('pong')
 
+    @bot_command('coinflip')
     async def av_coin(self, message):
         '''Simulate a random coin flip'''
         # av coin: Simulate a random coin flip
@@ -861,21 +1091,28 @@ Lady of the Lake - a card used to learn the alignment of another player''')
 
 
     async def fetch_stats(self):
+        # The stats records Spotify mode looks at: a list of tuples of the form
+        # (user_id, role_id, win_bool, merge_count, timestamp) in chronological
+        # order. Games are recorded as they finish, so there is nothing to fetch
+        # here; use backfill_stats() to import old games from the channel history.
+        return (await self.in_stats_thread(self.stats_store.recent, SPOTIFY_HISTORY))
+
+
+    async def backfill_stats(self):
+        # Scrape the channel history for role reveals of games that were not recorded directly
+        # Returns the number of records imported
         self.fetching_stats = True
-        # First load the stats if they exist
-        try:
-            with open('avalon_stats', 'rb') as o:
-                stats = pickle.load(o)
-            last_update = stats[-1][-1]
-        except IOError:
-            stats = []
-            last_update = None
-        # `stats` is a list of tuples of the form (user_id, role_id, win_bool, merge_count, timestamp)
-        # in chronological order
-        # First, update the stats so they're current
+        # Only scan the messages that have been posted since the last time we looked
+        checkpoint = (await self.in_stats_thread(self.stats_store.checkpoint))
+        if checkpoint is not None:
+            last_update = discord.Object(id=checkpoint)
+        else:
+            last_update = (await self.in_stats_thread(self.stats_store.scanned_until))
+        new_stats = []
         good_won = None
         async for msg in self.main_channel.history(after=last_update, oldest_first=True, limit=None):
-            if msg.author == self.user:
+            checkpoint = msg.id
+            if (msg.author == self.user) and not (await self.in_stats_thread(self.stats_store.has_game, msg.id)):
                 # Check for a victory announcement.
                 # Going from oldest to newest means this should be made
                 # right before role reveals
@@ -893,113 +1130,140 @@ Lady of the Lake - a card used to learn the alignment of another player''')
                         role_id = ROLE_NAMES.index(role_name)
                         good_role = (Role(role_id) in GOOD_ROLES)
                         win_bool = (good_won == good_role)
-                        stats.append((user_id, role_id, win_bool, merge_count, timestamp))
-        # Then save them back to the file
-        with open('avalon_stats', 'wb') as o:
-            pickle.dump(stats, o)
+                        new_stats.append((user_id, role_id, win_bool, merge_count, timestamp))
+        # Then append only the new records to the stats log
+        if checkpoint is not None:
+            await self.in_stats_thread(self.stats_store.append, new_stats, checkpoint)
+            await self.in_stats_thread(self.update_analytics)
         self.fetching_stats = False
-        return stats
+        return len(new_stats)
+
+
+
+    @bot_command()
+    async def av_perf(self, message):
+        # av perf: Show the commands that take the longest and make the most API requests
+        if message.author.id != self.ADMIN_ID:
+            await message.channel.send('You do not have permission to run debugging commands!')
+            return
+        for text in self.metrics.report():
+            await message.channel.send(text)
 
 
 
+    @bot_command()
+    async def av_backfill(self, message):
+        # av backfill: Import stats for old games from the channel history
+        if message.author.id != self.ADMIN_ID:
+            await message.channel.send('You do not have permission to run maintenance commands!')
+            return
+        if self.fetching_stats:
+            await message.channel.send('*The bot is currently busy fetching stats.*')
+            return
+        async with message.channel.typing():
+            count = (await self.backfill_stats())
+        await message.channel.send('Imported %d new stats records.' % count)
+
+
+
+    @bot_command()
     async def av_stats(self, message):
         '''Print out the player stats'''
         # av stats: Print out the player stats
-        if self.muted and self.running:
+        game = self.game_for(message)
+        if game and game.muted and game.running:
             channel = message.author
         else:
             channel = message.channel
         if self.fetching_stats:
             await channel.send('*The bot is currently busy fetching stats.*')
             return
-        async with channel.typing():
-            stats = (await self.fetch_stats())
-            # Parse the query the user has made
-            content_iter = iter(message.content.split()[2:])
-            user_id = None
-            role_id = None
-            before_ts = None
-            after_ts = None
-            for string in content_iter:
-                string = string.lower()
-                m = MENTION_RE.match(string)
-                if m:
-                    # First case: the string is a mention
-                    if user_id:
-                        await channel.send('Error: Duplicate user name given in stats request')
-                        return
-                    user_id = int(m.group(1))
-                    continue
-                # Role aliases
-                if string == 'perc':
-                    string = 'percival'
-                if string == 'loyal':
-                    string = 'servant'
-                if string in ROLE_COMMANDS[1:]:
-                    # Second case: the string is a role name
-                    if role_id:
-                        await channel.send('Error: Duplicate role name given in stats request')
-                        return
-                    role_id = int(ROLE_COMMANDS.index(string))
-                    continue
-                if string == 'before':
-                    # Third case: the string indicates that a "before" date should be parsed next
-                    if before_ts:
-                        await channel.send('Error: Duplicate timestamp given in stats request')
-                        return
-                    try:
-                        ts = next(content_iter)
-                    except StopIteration:
-                        await channel.send('Error: Truncated timestamp given in stats request')
-                        return
-                    try:
-                        before_ts = datetime.datetime.strptime(ts, '%m/%d/%Y') + datetime.timedelta(days=1)
-                    except ValueError:
-                        await channel.send('Error: Invalid timestamp; should be given in format mm/dd/yyyy')
-                        return
-                    continue
-                if string == 'after':
-                    # Fourth case: the string indicates that an "after" date should be parsed next
-                    if after_ts:
-                        await channel.send('Error: Duplicate timestamp given in stats request')
-                        return
-                    try:
-                        ts = next(content_iter)
-                    except StopIteration:
-                        await channel.send('Error: Truncated timestamp given in stats request')
-                        return
-                    try:
-                        after_ts = datetime.datetime.strptime(ts, '%m/%d/%Y')
-                    except ValueError:
-                        await channel.send('Error: Invalid timestamp; should be given in format mm/dd/yyyy')
-                        return
-                    continue
+        # Parse the query the user has made
+        content_iter = iter(message.content.split()[2:])
+        user_id = None
+        role_id = None
+        before_ts = None
+        after_ts = None
+        for string in content_iter:
+            string = string.lower()
+            m = MENTION_RE.match(string)
+            if m:
+                # First case: the string is a mention
+                if user_id:
+                    await channel.send('Error: Duplicate user name given in stats request')
+                    return
+                user_id = int(m.group(1))
+                continue
+            # Role aliases
+            if string == 'perc':
+                string = 'percival'
+            if string == 'loyal':
+                string = 'servant'
+            if string in ROLE_COMMANDS[1:]:
+                # Second case: the string is a role name
+                if role_id:
+                    await channel.send('Error: Duplicate role name given in stats request')
+                    return
+                role_id = int(ROLE_COMMANDS.index(string))
+                continue
+            if string == 'before':
+                # Third case: the string indicates that a "before" date should be parsed next
+                if before_ts:
+                    await channel.send('Error: Duplicate timestamp given in stats request')
+                    return
                 try:
-                    dt = datetime.datetime.strptime(string, '%b')
+                    ts = next(content_iter)
+                except StopIteration:
+                    await channel.send('Error: Truncated timestamp given in stats request')
+                    return
+                try:
+                    before_ts = datetime.datetime.strptime(ts, '%m/%d/%Y') + datetime.timedelta(days=1)
                 except ValueError:
-                    try:
-                        dt = datetime.datetime.strptime(string, '%B')
-                    except ValueError:
-                        dt = None
-                if dt:
-                    # Fifth case: the string indicates a month during which stats should be gathered
-                    now = datetime.datetime.utcnow()
-                    if before_ts or after_ts:
-                        await channel.send('Error: Duplicate timestamp given in stats request')
-                        return
-                    if dt.month > now.month:
-                        year = now.year - 1
-                    else:
-                        year = now.year
-                    after_ts = datetime.datetime(year, dt.month, 1)
-                    if dt.month == 12:
-                        before_ts = datetime.datetime(year+1, 1, 1)
-                    else:
-                        before_ts = datetime.datetime(year, dt.month+1, 1)
-                    continue
-                if string == 'help':
-                    # Sixth case: the user wants help using the stats command
-                    await channel.send('''Specifiers that can be given in an `av stats` invocation include:
+                    await channel.send('Error: Invalid timestamp; should be given in format mm/dd/yyyy')
+                    return
+                continue
+            if string == 'after':
+                # Fourth case: the string indicates that an "after" date should be parsed next
+                if after_ts:
+                    await channel.send('Error: Duplicate timestamp given in stats request')
+                    return
+                try:
+                    ts = next(content_iter)
+                except StopIteration:
+                    await channel.send('Error: Truncated timestamp given in stats request')
+                    return
+                try:
+                    after_ts = datetime.datetime.strptime(ts, '%m/%d/%Y')
+                except ValueError:
+                    await channel.send('Error: Invalid timestamp; should be given in format mm/dd/yyyy')
+                    return
+                continue
+            try:
+                dt = datetime.datetime.strptime(string, '%b')
+            except ValueError:
+                try:
+                    dt = datetime.datetime.strptime(string, '%B')
+                except ValueError:
+                    dt = None
+            if dt:
+                # Fifth case: the string indicates a month during which stats should be gathered
+                now = datetime.datetime.utcnow()
+                if before_ts or after_ts:
+                    await channel.send('Error: Duplicate timestamp given in stats request')
+                    return
+                if dt.month > now.month:
+                    year = now.year - 1
+                else:
+                    year = now.year
+                after_ts = datetime.datetime(year, dt.month, 1)
+                if dt.month == 12:
+                    before_ts = datetime.datetime(year+1, 1, 1)
+                else:
+                    before_ts = datetime.datetime(year, dt.month+1, 1)
+                continue
+            if string == 'help':
+                # Sixth case: the user wants help using the stats command
+                await channel.send('''Specifiers that can be given in an `av stats` invocation include:
  - The mention, username, or nickname of a Discord user
  - The name of a role (%s)
  - The word "good" or "evil"
@@ -1007,105 +1271,117 @@ Lady of the Lake - a card used to learn the alignment of another player''')
  - A string of the form "before mm/dd/yyyy" or "after mm/dd/yyyy" to restrict stats to a certain range of dates (both may be specified) 
  - The word "help" to print out this message
  ''' % ', '.join(ROLE_COMMANDS[1:]))
+                return
+            if string == 'bad':
+                string = 'evil' # Synonyms
+            if string in ('good', 'evil'):
+                # Seventh case: the string is the "good" or "evil" side
+                if role_id:
+                    await channel.send('Error: Duplicate role name given in stats request')
                     return
-                if string == 'bad':
-                    string = 'evil' # Synonyms
-                if string in ('good', 'evil'):
-                    # Seventh case: the string is the "good" or "evil" side
-                    if role_id:
-                        await channel.send('Error: Duplicate role name given in stats request')
-                        return
-                    role_id = string
-                    continue
-                if string == 'heff':
-                    string = 'heff10' # Expected behavior :P
-                for member in self.get_all_members():
-                    # Eighth case: the string is a username or nickname of someone on the channel (but not a mention)
-                    if (member.name.lower() == string) or (member.nick and (member.nick.lower() == string)):
-                        if user_id:
-                            await channel.send('Error: Duplicate user name given in stats request')
-                            return
-                        user_id = member.id
-                        break
-                else:
-                    # Fail message
-                    await channel.send('Error: unparseable token "%s" given in stats request' % string)
+                role_id = string
+                continue
+            if string == 'heff':
+                string = 'heff10' # Expected behavior :P
+            if self.find_member(string):
+                # Eighth case: the string is a username or nickname of someone on the channel (but not a mention)
+                if user_id:
+                    await channel.send('Error: Duplicate user name given in stats request')
                     return
-            # Put together the statistical data to be printed
-            if user_id:
-                stats = [i for i in stats if i[0] == user_id]
-            if role_id == 'good':
-                stats = [i for i in stats if Role(i[1]) in GOOD_ROLES]
-            elif role_id == 'evil':
-                stats = [i for i in stats if Role(i[1]) in EVIL_ROLES]
-            elif role_id:
-                stats = [i for i in stats if i[1] == role_id]
-            if before_ts:
-                stats = [i for i in stats if i[4] < before_ts]
-            if after_ts:
-                stats = [i for i in stats if i[4] >= after_ts]
-            if not stats:
-                await channel.send('No statistical data exists matching this query.')
+                user_id = self.find_member(string)
+            else:
+                # Fail message
+                await channel.send('Error: unparseable token "%s" given in stats request' % string)
                 return
-            # Create the rows of data
-            rows = []
+        # Answer from the cache if nothing has changed since this query was last made
+        if self.stats_cache_version != self.stats_store.version:
+            self.stats_cache.clear()
+            self.stats_cache_version = self.stats_store.version
+        key = (user_id, role_id, before_ts, after_ts)
+        if key in self.stats_cache:
+            self.stats_cache.move_to_end(key)
+            await channel.send(self.stats_cache[key])
+            return
+        async with channel.typing():
+            text = (await self.in_stats_thread(self.stats_table, user_id, role_id, before_ts, after_ts))
+        self.stats_cache[key] = text
+        if len(self.stats_cache) > self.STATS_CACHE_SIZE:
+            self.stats_cache.popitem(last=False)
+        await channel.send(text)
+
+
+
+    def stats_table(self, user_id, role_id, before_ts, after_ts):
+        # Returns the av stats reply for a parsed query (runs on the stats thread)
+        # Put together the statistical data to be printed.
+        # The store counts the records in each (user, role, win, merge count) group
+        # within the date range; the remaining filters are applied to the groups.
+        if role_id == 'good':
+            role_ids = {role.value for role in GOOD_ROLES}
+        elif role_id == 'evil':
+            role_ids = {role.value for role in EVIL_ROLES}
+        elif role_id:
+            role_ids = {role_id}
+        else:
+            role_ids = None
+        counter = {}
+        total = [0, 0]
+        for (user, role, win_bool, merge_count), count in self.stats_store.tally(after_ts, before_ts).items():
+            if (user_id and (user != user_id)) or ((role_ids is not None) and (role not in role_ids)):
+                continue
             if user_id:
-                # If a specific user is given, print out their role info
-                counter = {}
-                total = [0, 0]
-                for user, role, win_bool, merge_count, timestamp in stats:
-                    data = counter.setdefault(role, [0, 0])
-                    if win_bool:
-                        data[0] += 1
-                        total[0] += 1.0 / merge_count
-                    else:
-                        data[1] += 1
-                        total[1] += 1.0 / merge_count
-                header_row = ('Role', 'Wins', 'Losses', 'Total', 'Win Ratio')
-                rows = [(ROLE_NAMES[key], str(w), str(l), str(w+l), '%.4g%%' % (100*w/(w+l))) for key, (w, l) in counter.items()]
-                total_row = ('Total', str(int(total[0])), str(int(total[1])), str(int(total[0]+total[1])), '%.4g%%' % (100*total[0]/(total[0]+total[1])))
-                rows.sort(key = lambda x: float(x[-1][:-1]), reverse=True)
-                rows.insert(0, header_row)
-                if len(rows) > 2:
-                    rows.append(total_row)
+                # If a specific user is given, count their games by role
+                data = counter.setdefault(role, [0, 0])
+                data[0 if win_bool else 1] += count
+                total[0 if win_bool else 1] += count / merge_count
             else:
-                # Print out info sorted by users then
-                counter = {}
-                for user, role, win_bool, merge_count, timestamp in stats:
-                    data = counter.setdefault(user, [0, 0])
-                    if win_bool:
-                        data[0] += (1 if isinstance(role_id, int) else 1.0 / merge_count)
-                    else:
-                        data[1] += (1 if isinstance(role_id, int) else 1.0 / merge_count)
-                header_row = ('Player', 'Wins', 'Losses', 'Total', 'Win Ratio')
-                rows = [(discord.utils.get(self.get_all_members(), id=key).name, str(int(w)), str(int(l)), str(int(w+l)), '%.4g%%' % (100*w/(w+l))) for key, (w, l) in counter.items()]
-                rows.sort(key = lambda x: float(x[-1][:-1]), reverse=True)
-                rows.insert(0, header_row)
-            # Create the aligned table message
-            lengths = [max([len(row[i]) for row in rows]) for i in range(5)]
-            divider = '+%s+\n' % '+'.join(['-'*l for l in lengths])
-            rows = ['|%s|\n' % '|'.join([entry.rjust(l) for entry, l in zip(row, lengths)]) for row in rows]
-            table = divider + divider.join(rows) + divider
-            # Generate the descriptive message at the top
-            description = 'Avalon player stats'
-            if user_id:
-                description += ' for %s' % discord.utils.get(self.get_all_members(), id=user_id).mention
-            if role_id == 'good':
-                description += ' for Good'
-            elif role_id == 'evil':
-                description += ' for Evil'
-            elif role_id:
-                description += ' for %s' % ROLE_NAMES[role_id]
-            if before_ts:
-                before_ts -= datetime.timedelta(days=1)
-            if before_ts and after_ts:
-                description += ' between %s and %s' % (after_ts.strftime('%x'), before_ts.strftime('%x'))
-            elif before_ts:
-                description += ' before %s' % before_ts.strftime('%x')
-            elif after_ts:
-                description += ' after %s' % after_ts.strftime('%x')
-            # Print out the whole table
-            await channel.send('**%s:**\n```\n%s```' % (description, table))
+                # Otherwise count by user
+                data = counter.setdefault(user, [0, 0])
+                data[0 if win_bool else 1] += (count if isinstance(role_id, int) else count / merge_count)
+        if not counter:
+            return 'No statistical data exists matching this query.'
+        # Create the rows of data
+        rows = []
+        if user_id:
+            # If a specific user is given, print out their role info
+            header_row = ('Role', 'Wins', 'Losses', 'Total', 'Win Ratio')
+            rows = [(ROLE_NAMES[key], str(w), str(l), str(w+l), '%.4g%%' % (100*w/(w+l))) for key, (w, l) in counter.items()]
+            total_row = ('Total', str(round(total[0])), str(round(total[1])), str(round(total[0]+total[1])), '%.4g%%' % (100*total[0]/(total[0]+total[1])))
+            rows.sort(key = lambda x: float(x[-1][:-1]), reverse=True)
+            rows.insert(0, header_row)
+            if len(rows) > 2:
+                rows.append(total_row)
+        else:
+            # Print out info sorted by users then
+            header_row = ('Player', 'Wins', 'Losses', 'Total', 'Win Ratio')
+            rows = [(self.display_name(key), str(round(w)), str(round(l)), str(round(w+l)), '%.4g%%' % (100*w/(w+l))) for key, (w, l) in counter.items()]
+            rows.sort(key = lambda x: float(x[-1][:-1]), reverse=True)
+            rows.insert(0, header_row)
+        # Create the aligned table message
+        lengths = [max([len(row[i]) for row in rows]) for i in range(5)]
+        divider = '+%s+\n' % '+'.join(['-'*l for l in lengths])
+        rows = ['|%s|\n' % '|'.join([entry.rjust(l) for entry, l in zip(row, lengths)]) for row in rows]
+        table = divider + divider.join(rows) + divider
+        # Generate the descriptive message at the top
+        description = 'Avalon player stats'
+        if user_id:
+            description += ' for <@%d>' % user_id
+        if role_id == 'good':
+            description += ' for Good'
+        elif role_id == 'evil':
+            description += ' for Evil'
+        elif role_id:
+            description += ' for %s' % ROLE_NAMES[role_id]
+        if before_ts:
+            before_ts -= datetime.timedelta(days=1)
+        if before_ts and after_ts:
+            description += ' between %s and %s' % (after_ts.strftime('%x'), before_ts.strftime('%x'))
+        elif before_ts:
+            description += ' before %s' % before_ts.strftime('%x')
+        elif after_ts:
+            description += ' after %s' % after_ts.strftime('%x')
+        # Put together the whole table
+        return '**%s:**\n```\n%s```' % (description, table)
                 
 
 
@@ -1116,6 +1392,219 @@ Lady of the Lake - a card used to learn the alignment of another player''')
                 
 
 
+    @bot_command()
+    async def av_top(self, message):
+        '''Show the players with the highest skill ratings, overall or for "good", "evil" or a role'''
+        # av top [good/evil/role]: Print out the rating leaderboard
+        game = self.game_for(message)
+        if game and game.muted and game.running:
+            channel = message.author
+        else:
+            channel = message.channel
+        args = message.content.lower().split()[2:]
+        kind = args[0] if args else None
+        kind = {'bad': 'evil', 'perc': 'percival', 'loyal': 'servant'}.get(kind, kind)
+        if kind in ROLE_COMMANDS[1:]:
+            kind = ROLE_COMMANDS.index(kind)
+        elif kind not in (None, 'good', 'evil'):
+            await channel.send('Syntax: av top [good/evil/role]')
+            return
+        await channel.send((await self.in_stats_thread(self.top_table, kind)))
+
+    @bot_command()
+    async def av_history(self, message):
+        '''Show how your skill ratings (or someone else's) have changed month by month'''
+        # av history [user]: Print out a player's ratings at the end of each month
+        game = self.game_for(message)
+        if game and game.muted and game.running:
+            channel = message.author
+        else:
+            channel = message.channel
+        args = message.content.split()[2:]
+        if not args:
+            user_id = message.author.id
+        elif (len(args) == 1) and MENTION_RE.match(args[0]):
+            user_id = int(MENTION_RE.match(args[0]).group(1))
+        elif (len(args) == 1) and self.find_member(args[0].lower()):
+            user_id = self.find_member(args[0].lower())
+        else:
+            await channel.send('Syntax: av history [user]')
+            return
+        await channel.send((await self.in_stats_thread(self.history_table, user_id)))
+
+
+    @bot_command('pair')
+    async def av_synergy(self, message):
+        '''Show who you (or someone else) do best with and worst against, or how two players do together and against each other'''
+        # av synergy [user] [good/evil] or av synergy user1 user2: Print out teammate and opponent records
+        game = self.game_for(message)
+        if game and game.muted and game.running:
+            channel = message.author
+        else:
+            channel = message.channel
+        user_ids = []
+        side = None
+        for string in message.content.split()[2:]:
+            m = MENTION_RE.match(string)
+            string = string.lower()
+            if string == 'bad':
+                string = 'evil'
+            if m:
+                user_ids.append(int(m.group(1)))
+            elif (string in ('good', 'evil')) and (side is None):
+                side = string
+            elif self.find_member(string):
+                user_ids.append(self.find_member(string))
+            else:
+                user_ids = None
+                break
+        if (user_ids is None) or (len(user_ids) > 2) or ((len(user_ids) == 2) and (side or (user_ids[0] == user_ids[1]))):
+            await channel.send('Syntax: av synergy [user] [good/evil], or av synergy user1 user2')
+            return
+        if len(user_ids) == 2:
+            text = (await self.in_stats_thread(self.pair_table, user_ids[0], user_ids[1]))
+        else:
+            text = (await self.in_stats_thread(self.synergy_table, user_ids[0] if user_ids else message.author.id, side))
+        await channel.send(text)
+
+
+    @bot_command()
+    async def av_odds(self, message):
+        '''Show how likely each player is to have each role, judging only by the votes and quests so far (or in the last game)'''
+        # av odds: Print out everyone's chances of having each role, worked out from public information
+        game = self.game_for(message)
+        if game and game.muted and game.running:
+            channel = message.author
+        else:
+            channel = message.channel
+        if game and game.running:
+            ids = [p.user.id for p in game.players]
+            roles = [(p.role, p.side) for p in game.players] # Only which roles are in play is used, not who has them
+            assassin = game.assassin.user.id if game.assassin else None
+            inference, text = (await self.in_stats_thread(self.odds_table, self.inferences.get(game), ids, roles,
+                                                          list(game.vote_history), list(game.quest_history), assassin, None))
+            if game.running:
+                self.inferences[game] = inference
+            await channel.send(text)
+            return
+        # Otherwise look back at the last game played here
+        if message.channel.type != discord.ChannelType.private:
+            channel_id = message.channel.id
+        elif self.main_channel:
+            channel_id = self.main_channel.id
+        else:
+            await channel.send('The default channel could not be found.')
+            return
+        record = (await self.in_stats_thread(self.stats_store.last_game, channel_id))
+        if record is None:
+            await channel.send('No games have been recorded in this channel yet.')
+            return
+        ids = [p['id'] for p in record['players']]
+        roles = [(tuple([Role(value) for value in p['roles']]), p['side']) for p in record['players']]
+        assassin = None
+        if record['assassinated'] is not None:
+            assassin = [user_id for user_id, (role, side) in zip(ids, roles) if Role.ASSASSIN in role][0]
+        inference, text = (await self.in_stats_thread(self.odds_table, None, ids, roles, record['votes'], record['quests'], assassin, roles))
+        await channel.send(text)
+
+
+    def odds_table(self, inference, ids, roles, votes, quests, assassin, reveal):
+        # Returns a RoleInference for a game, brought up to date with its vote and
+        # quest histories and Assassin (or a new one if `inference` is None), and
+        # the av odds reply. If the roles are to be revealed, `reveal` is the same
+        # as `roles`. (Runs on the stats thread.)
+        if inference is None:
+            inference = RoleInference(ids, roles)
+        inference.catch_up(votes, quests, assassin)
+        evil, chances = inference.chances()
+        rows = [['Player', 'Evil'] + [ROLE_NAMES[role.value] for role in inference.special]]
+        for seat, user_id in enumerate(ids):
+            rows.append([self.display_name(user_id)] + ['%.0f%%' % (100*chance[seat]) for chance in [evil] + [chances[role] for role in inference.special]])
+        if reveal:
+            rows[0].append('Role')
+            for row, (role, side) in zip(rows[1:], reveal):
+                row.append('/'.join([ROLE_NAMES[r.value] for r in role]))
+        description = 'Chances of each role, judging by %d team vote%s and %d quest%s' % \
+                      (len(votes), '' if len(votes) == 1 else 's', len(quests), '' if len(quests) == 1 else 's')
+        if reveal:
+            description += ' (in the last game played here)'
+        return inference, self.text_table(description, rows)
+
+
+    def top_table(self, kind):
+        # Returns the av top reply for 'good', 'evil', a role ID or None (runs on the stats thread)
+        board = self.ratings.leaderboard(kind, self.TOP_MIN_GAMES)[:self.TOP_PLAYERS]
+        if kind == 'good':
+            description = 'Top rated Good players'
+        elif kind == 'evil':
+            description = 'Top rated Evil players'
+        elif kind:
+            description = 'Top rated %s players' % ROLE_NAMES[kind]
+        else:
+            description = 'Top rated players'
+        if not board:
+            return 'No one has played %d rated games yet.' % self.TOP_MIN_GAMES
+        rows = [('Rank', 'Player', 'Rating', 'Games')]
+        rows += [(str(i + 1), self.display_name(user_id), '%.0f' % rating, str(games)) for i, (rating, games, user_id) in enumerate(board)]
+        return self.text_table(description, rows)
+
+
+    def history_table(self, user_id):
+        # Returns the av history reply for a user (runs on the stats thread)
+        history = self.ratings.history(user_id)[-self.HISTORY_MONTHS:]
+        if not history:
+            return '<@%d> has not played any rated games.' % user_id
+        rows = [('Month', 'Good', 'Evil', 'Games')]
+        for (year, month), good, evil, games in history:
+            rows.append((datetime.date(year, month, 1).strftime('%b %Y'), '-' if good is None else '%.0f' % good,
+                         '-' if evil is None else '%.0f' % evil, str(games)))
+        return self.text_table('Rating history for <@%d> (now %.0f overall)' % (user_id, self.ratings.overall(user_id)), rows)
+
+
+    def synergy_table(self, user_id, side):
+        # Returns the av synergy reply for one user (runs on the stats thread)
+        partners = self.pairs.partners(user_id, side, self.SYNERGY_MIN_GAMES)[:self.SYNERGY_PLAYERS]
+        opponents = self.pairs.opponents(user_id, side, self.SYNERGY_MIN_GAMES)[:self.SYNERGY_PLAYERS]
+        on_side = {'good': ' on Good', 'evil': ' on Evil', None: ''}[side]
+        if not (partners or opponents):
+            return '<@%d> has not played %d games%s with anyone yet.' % (user_id, self.SYNERGY_MIN_GAMES, on_side)
+        texts = []
+        if partners:
+            rows = [('Teammate', 'Wins', 'Games', 'Win Ratio', 'Synergy')]
+            rows += [(self.display_name(other), str(wins), str(games), '%.4g%%' % (100*wins/games), '%+.1f%%' % (100*synergy)) \
+                     for synergy, wins, games, other in partners]
+            texts.append(self.text_table('Best teammates for <@%d>%s' % (user_id, on_side), rows))
+        if opponents:
+            rows = [('Opponent', 'Wins', 'Games', 'Win Ratio')]
+            rows += [(self.display_name(other), str(wins), str(games), '%.4g%%' % (100*ratio)) for ratio, wins, games, other in opponents]
+            texts.append(self.text_table('Toughest opponents for <@%d>%s' % (user_id, on_side), rows))
+        return '\n'.join(texts)
+
+
+    def pair_table(self, user_id, other):
+        # Returns the av synergy reply for two users (runs on the stats thread)
+        together, against = self.pairs.pair(user_id, other)
+        rows = [('', 'Wins', 'Losses', 'Total', 'Win Ratio')]
+        for label, counts, side in (('Together as Good', together, 'good'), ('Together as Evil', together, 'evil'),
+                                    ('Against, on Good', against, 'good'), ('Against, on Evil', against, 'evil')):
+            wins, games = tally(counts, side)
+            if games:
+                rows.append((label, str(wins), str(games - wins), str(games), '%.4g%%' % (100*wins/games)))
+        if len(rows) == 1:
+            return '<@%d> and <@%d> have not played together.' % (user_id, other)
+        return self.text_table('Games of <@%d> with and against <@%d>' % (user_id, other), rows)
+
+
+    def text_table(self, description, rows):
+        # Lay out rows of strings (the first being the header) as an aligned table
+        lengths = [max([len(row[i]) for row in rows]) for i in range(len(rows[0]))]
+        divider = '+%s+\n' % '+'.join(['-'*l for l in lengths])
+        rows = ['|%s|\n' % '|'.join([entry.rjust(l) for entry, l in zip(row, lengths)]) for row in rows]
+        return '**%s:**\n```\n%s```' % (description, divider + divider.join(rows) + divider)
+
+
+
+    @bot_command()
     async def av_help(self, message):
         '''I'm guessing you've figured out by now what this one does'''
         # av help: DMs list of commands
@@ -1123,9 +1612,10 @@ Lady of the Lake - a card used to learn the alignment of another player''')
 
 
 
+    @bot_command()
     async def av_debug(self, message):
         # av debug: For debugging only!!
-        if message.author.id != 452938434055503892:
+        if message.author.id != self.ADMIN_ID:
             await message.channel.send('You do not have permission to run debugging commands!')
             return
         start = message.content.find('```')
@@ -1154,6 +1644,7 @@ Lady of the Lake - a card used to learn the alignment of another player''')
 
 
 
+    @bot_command()
     async def av_heff(self, message):
         # av heff: self explanatory
         if message.channel_mentions:
@@ -1164,11 +1655,13 @@ Lady of the Lake - a card used to learn the alignment of another player''')
 
 
 
+    @bot_command()
     async def av_spotify(self, message):
         # av spotify: Turn on the secret true randomness feature
         await message.channel.send('Spotify mode on')
         self.spotify_mode = True
 
+    @bot_command()
     async def av_unspotify(self, message):
         # av unspotify: Turn off the secret true randomness feature
         # and use normal, boring randomness instead.
@@ -1179,272 +1672,17 @@ Lady of the Lake - a card used to learn the alignment of another player''')
 
 
 
-    # Synonyms (by popular demand)
-    av_new = av_create
-    av_quit = av_stop = av_end = av_cancel
-    av_in = av_enter = av_join
-    av_out = av_exit = av_leave
-    av_prod = av_poke
-    av_begin = av_start
-    av_choose = av_add = av_picc = av_pick
-    av_rand = av_random = av_pickrandom
-    av_accept = av_yes = av_yee = av_ok = av_okay = av_aight = av_yep = av_yeet = av_approve
-    av_no = av_nope = av_noway = av_rejecc = av_reject
-    av_succ = av_success
-    av_sab = av_sabotage = av_fail
-    av_investigate = av_lady
-    av_shoot = av_kill = av_assassinate
-    av_characters = av_chars = av_roles
-    av_coinflip = av_coin
-        
-        
-
-
-
 
 
     ##### Other game running methods #####
 
 
-    async def secret_info(self):
-        # Figure out which roles are being used
-        n_evil = N_EVIL[len(self.players)]
-        good = [Role.SERVANT for i in range(len(self.players) - n_evil)]
-        evil = [Role.MINION for i in range(n_evil)]
-        special_good = []
-        special_evil = []
-        # Merlin/Morgana roles
-        if self.features['merlin']:
-            special_good.append(Role.MERLIN)
-            special_evil.append(Role.ASSASSIN)
-            if self.features['morgana']:
-                special_good.append(Role.PERCIVAL)
-                special_evil.append(Role.MORGANA)
-        elif self.features['morgana']:
-            # Warn that these are being ignored
-            await self.main_channel.send('Switching Morgana/Percival off because Merlin is off.')
-            self.features['morgana'] = False
-        # Other weird roles
-        if self.features['mordred']:
-            special_evil.append(Role.MORDRED)
-        if self.features['oberon']:
-            special_evil.append(Role.OBERON)
-        if self.features['norebo']:
-            special_good.append(Role.NOREBO)
-        if self.features['palm']:
-            special_good.append(Role.PALM)
-        # Merged roles
-        for merge in self.merged:
-            good_merge = tuple([role for role in merge if role in special_good])
-            evil_merge = tuple([role for role in merge if role in special_evil])
-            if len(good_merge) >= 2:
-                for role in good_merge:
-                    special_good.remove(role)
-                special_good.append(good_merge)
-            elif len(evil_merge) >= 2:
-                for role in evil_merge:
-                    special_evil.remove(role)
-                special_evil.append(evil_merge)
-        # Consolidate all roles into the appropriately sized lists
-        good = (special_good + good)[:len(good)]
-        evil = (special_evil + evil)[:len(evil)]
-        # Turn off roles if we don't have enough players for them
-        rejected_roles = [role for role in special_good if role not in good] + \
-                         [role for role in special_evil if role not in evil]
-        for role in rejected_roles:
-            if not isinstance(role, tuple):
-                role = (role,)
-            await self.main_channel.send('Switching %s off because there are not enough players.' % '/'.join([ROLE_NAMES[r.value] for r in role]))
-            for sub in role:
-                feature = ROLE_NAMES[sub.value].lower()
-                if feature in self.features:
-                    self.features[feature] = False
-        # Randomly assign them to players
-        roles = [(role, True) for role in good] + [(role, False) for role in evil]
-        if self.spotify:
-            roles = (await self.spotify_shuffle(roles))
-        else:
-            random.shuffle(roles)
-        for player, (role, side) in zip(self.players, roles):
-            player.role = (role if isinstance(role, tuple) else (role,))
-            player.side = side
-            names = [ROLE_NAMES[role.value] for role in player.role]
-            names = [name for name in names if name not in ('Palm', 'Norebo')] # Palm and Norebo don't know their own identities.
-            name = '/'.join(names) or ROLE_NAMES[Role.SERVANT.value] # `names` should only be empty if it's a good guy whose special role is Palm or Norebo
-            await player.user.send('Your role for this game: **%s**\nYour alignment: **%s**' % \
-                                   (name, ('Good' if side == GOOD else 'Evil')))
-        # Disclose information to players as appropriate
-        for player in self.players:
-            # Bad guys figure out who each other are (save for Oberon)
-            # There may be impostors in this list if Norebo and/or Palm are in play.
-            if (player.side == EVIL) and (Role.OBERON not in player.role):
-                other_minions = [p.user.name for p in self.players if (p != player) and (((p.side == EVIL) and (Role.OBERON not in p.role)) \
-                                 or (Role.NOREBO in p.role) or (Role.PALM in p.role))]
-                if other_minions:
-                    await player.user.send('Other Minions of Mordred: %s' % ', '.join(other_minions))
-                else:
-                    await player.user.send('There are no other Minions of Mordred.')
-            # Merlin knows who the bad guys are (save for Mordred)
-            # If Palm is in play Merlin will think he's bad too.
-            elif Role.MERLIN in player.role:
-                minions = [p.user.name for p in self.players if ((Role.MORDRED not in p.role) and (p.side == EVIL)) or (Role.PALM in p.role)]
-                if minions:
-                    await player.user.send('The Minions of Mordred are: %s' % ', '.join(minions))
-                else:
-                    await player.user.send('There are no Minions of Mordred.')
-            # Percival knows who Morgana and Merlin are (but not which is which)
-            elif Role.PERCIVAL in player.role:
-                merlins = [p.user.name for p in self.players if (Role.MERLIN in p.role) or (Role.MORGANA in p.role)]
-                random.shuffle(merlins)
-                await player.user.send('Merlin and Morgana are %s and %s (in some order)' % tuple(merlins))
-                
-
-        
-
-
-    async def init_team(self):
-        # Announce a new leader and let them pick a team
-        if self.has_team:
-            return # Shouldn't happen (but does... ugh)
-        self.has_team = True
-        if self.leader:
-            index = self.players.index(self.leader)
-            self.leader = self.players[(index + 1) % len(self.players)]
-        else:
-            self.leader = self.players[0]
-        self.team = []
-        await self.main_channel.send('%s is now the leader. Pick %d people to join the team (possibly including yourself) using "av pick".' % \
-                                     (self.leader.user.mention, self.current_quest[0]))
-        # Special messages if necessary
-        if self.current_quest[1] == 2:
-            await self.main_channel.send('**Reminder: This quest requires 2 fails instead of 1.**')
-        if self.reject_counter == 4:
-            await self.main_channel.send('**Warning: Evil will win if this quest is rejected.**')
-
-
-
-    async def init_voting(self):
-        # Reset everyone's votes and let them cast votes again
-        if not self.waiting_for_votes:
-            self.waiting_for_votes = True
-            for player in self.players:
-                player.vote = None
-            await self.main_channel.send('''Everyone: the team for this quest is %s.
-Please cast your votes **privately** by DMing either "av approve" or "av reject" to %s.''' % \
-                                         (', '.join([player.user.mention for player in self.team]), self.user.mention))
-
-
-    async def tabulate_votes(self):
-        # Tabulate the votes that were cast
-        if self.waiting_for_votes:
-            self.waiting_for_votes = False
-            voting_msg = (await self.main_channel.send('Voting for the team has concluded. Results are:\n%s' % \
-                                                       '\n'.join(['%s: %s' % (p.user.name, 'Approve' if p.vote == APPROVE else 'Reject') for p in self.players])))
-            await voting_msg.delete(delay=self.VOTE_DELAY) # Delete after a certain time
-            if sum([p.vote for p in self.players]) > len(self.players) // 2:
-                await self.main_channel.send('The team consisting of %s was approved!' % ', '.join([player.user.mention for player in self.team]))
-                self.reject_counter = 1
-                return True
-            self.reject_counter += 1
-            await self.main_channel.send('The team consisting of %s was rejected. Vote tracker is now at **%d** out of 5.' % \
-                                         (', '.join([player.user.mention for player in self.team]), self.reject_counter))
-            await self.check_for_winner()
-        return False
-
-
-
-    async def init_outcome(self):
-        # Let everyone on the team play success/fail cards
-        if not self.waiting_for_outcomes:
-            self.waiting_for_outcomes = True
-            for player in self.team:
-                player.outcome = None
-            await self.main_channel.send('''Everyone who is on the team: please signal the outcome of this quest
-**privately** by DMing either "av success" or "av fail" to %s.''' % self.user.mention)
-
-
-    async def tabulate_outcome(self):
-        # Determine whether the quest succeeded
-        if self.waiting_for_outcomes:
-            self.waiting_for_outcomes = False
-            async with self.main_channel.typing():
-                await asyncio.sleep(5) # Pause for dramatic effect
-            n_fails = [p.outcome for p in self.team].count(FAIL)
-            if n_fails == 1:
-                await self.main_channel.send('There was 1 Fail card played out of %d.' % len(self.team))
-            else:
-                await self.main_channel.send('There were %d Fail cards played out of %d.' % (n_fails, len(self.team)))
-            if n_fails >= self.current_quest[1]:
-                await self.main_channel.send('**The quest has failed.**')
-                self.quest_results.append(False)
-            else:
-                await self.main_channel.send('**The quest has succeeded!**')
-                self.quest_results.append(True)
-            await self.check_for_winner()
-
-
-
-    async def check_for_winner(self):
-        # Check for a winner
-        if self.quest_results.count(False) >= 3:
-            await self.main_channel.send('**The game is over. Evil wins!!**')
-            await self.finish_game(EVIL)
-        elif self.reject_counter >= 5:
-            await self.main_channel.send('**The game is over. The vote tracker has reached 5. Evil wins!!**')
-            await self.finish_game(EVIL)
-        elif self.quest_results.count(True) >= 3:
-            if self.features['merlin']:
-                self.assassin = [p for p in self.players if Role.ASSASSIN in p.role][0]
-                self.waiting_for_assassin = True
-                await self.main_channel.send('**Good is about to win.** %s, choose someone to assassinate using "av assassinate".' % self.assassin.user.mention)
-            else:
-                await self.main_channel.send('**The game is over. Good wins!!**')
-                await self.finish_game(GOOD)
-
-
-    async def finish_game(self, winner):
-        # Announce the roles and clear the `running' flag
-        self.owner = None
-        self.running = False
-        info = '**Game role reveals:**\n'
-        for p in self.players:
-            info += '%s: %s\n' % (p.user.mention, '/'.join([ROLE_NAMES[role.value] for role in p.role]))
-        await self.main_channel.send(info)
-
-
-
-
-    async def spotify_shuffle(self, roles):
-        # Implements TRUE randomness
-        roles = [i if isinstance(i, tuple) else (i,) for i in roles]
-        sample = list(itertools.permutations(roles))
-        if len(sample) > 500:
-            sample = random.sample(sample, 500)
-        stats = (await self.fetch_stats())
-        ids = [p.user.id for p in self.players]
-        count = 0
-        for user_id, role_id, win_bool, merge_count, timestamp in stats[::-1]:
-            count += 1
-            role = Role(role_id)
-            if user_id in ids:
-                index = ids.index(user_id)
-                newsample = []
-                # When building the new, reduced, sample of permutations to choose
-                # from, make sure that the player indicated by user_id did not have
-                # the same role in this recent game as they do now
-                for perm in sample:
-                    if role not in perm[index]:
-                        newsample.append(perm)
-                if not newsample:
-                    # Have to finish now
-                    return list(random.choice(sample))
-                # Otherwise loop back again
-                sample = newsample
-                if count == 100:
-                    return list(random.choice(sample))
-        # If we make it all the way to the end, just do a random permutation from
-        # the remaining choices
-        return list(random.choice(sample))
+    async def record_game(self, game, reveal):
+        # Write the finished game straight into the stats store
+        record, rows = game.record(reveal.created_at)
+        record['channel'] = game.channel.id
+        await self.in_stats_thread(self.stats_store.record_game, record, rows, reveal.created_at, reveal.id)
+        await self.in_stats_thread(self.update_analytics)
         
         
                 
@@ -1457,6 +1695,11 @@ Please cast your votes **privately** by DMing either "av approve" or "av reject"
 
 
 
+Avalon.cmd_lookup, Avalon.help = command_table(Avalon) # Maps command names and abbreviations to their functions
+
+
+
+
 if __name__ == '__main__':
     client = Avalon()
     client.run(client.TOKEN)
@@ -0,0 +1,1311 @@
+# Avalon game engine
+# The rules of the game, independent of Discord. A Game is driven by calling
+# its methods with the users who sent each command; every method updates the
+# game state synchronously and returns a list of effects (messages to post,
+# pauses, ...) for the caller to carry out. Users are opaque objects that only
+# need `id`, `name` and `mention` attributes.
+
+import enum
+import random
+import functools
+import datetime
+import collections
+
+from avalon_stats import to_micros, from_micros
+
+
+
+GOOD = True
+EVIL = False
+
+APPROVE = True
+REJECT = False
+
+SUCCESS = True
+FAIL = False
+
+
+
+
+class Role(enum.Enum):
+    # Various player roles in the game
+    SERVANT = 1
+    MINION = 2
+    MERLIN = 3
+    ASSASSIN = 4
+    MORGANA = 5
+    PERCIVAL = 6
+    MORDRED = 7
+    OBERON = 8
+    NOREBO = 9
+    PALM = 10
+
+
+
+GOOD_ROLES = [Role.SERVANT, Role.MERLIN, Role.PERCIVAL, Role.NOREBO, Role.PALM]
+EVIL_ROLES = [Role.MINION, Role.ASSASSIN, Role.MORGANA, Role.MORDRED, Role.OBERON]
+
+
+
+ROLE_NAMES = [
+    # Descriptive names for all the roles
+    'None',
+    'Loyal Servant of Arthur',
+    'Minion of Mordred',
+    'Merlin',
+    'Assassin',
+    'Morgana',
+    'Percival',
+    'Mordred',
+    'Oberon',
+    'Norebo',
+    'Palm',
+    ]
+
+
+ROLE_COMMANDS = [
+    # Command names for all the roles
+    'none',
+    'servant',
+    'minion',
+    'merlin',
+    'assassin',
+    'morgana',
+    'percival',
+    'mordred',
+    'oberon',
+    'norebo',
+    'palm',
+    ]
+
+
+
+FEATURE_NAMES = {
+    # Descriptive names for all the features
+    'merlin': 'Merlin',
+    'morgana': 'Morgana/Percival',
+    'mordred': 'Mordred',
+    'oberon': 'Oberon',
+    'norebo': 'Norebo',
+    'palm': 'Palm',
+    'lady': 'Lady of the Lake',
+    }
+
+
+
+# Game parameters
+
+N_EVIL = {
+    5 : 2,
+    6 : 2,
+    7 : 3,
+    8 : 3,
+    9 : 3,
+    10: 4,
+    }
+
+QUEST_LISTS = {
+    5 : [(2, 1), (3, 1), (2, 1), (3, 1), (3, 1)],
+    6 : [(2, 1), (3, 1), (4, 1), (3, 1), (4, 1)],
+    7 : [(2, 1), (3, 1), (3, 1), (4, 2), (4, 1)],
+    8 : [(3, 1), (4, 1), (4, 1), (5, 2), (5, 1)],
+    9 : [(3, 1), (4, 1), (4, 1), (5, 2), (5, 1)],
+    10: [(3, 1), (4, 1), (4, 1), (5, 2), (5, 1)],
+    }
+
+DRAMATIC_PAUSE = 5 # Number of seconds to pause before revealing quest results and assassinations
+
+PHASE_TIMEOUTS = {
+    # Default number of seconds each phase of a game may take before the bot
+    # makes the choice for whoever is holding it up (None for no limit)
+    'pick': 600,
+    'vote': 300,
+    'outcome': 300,
+    'lady': 600,
+    'assassin': 600,
+    }
+
+SPOTIFY_HISTORY = 100 # Number of recent stats records Spotify mode tries to avoid repeating
+SPOTIFY_TRIES = 5 # Number of plain shuffles to try before drawing seat by seat
+
+
+
+
+# Effects returned by the engine
+
+Announce = collections.namedtuple('Announce', 'text temporary', defaults=(False,))
+# Post `text` in the game's channel. If `temporary` is True the message should
+# be deleted again after a short while.
+
+Reply = collections.namedtuple('Reply', 'text')
+# Reply to the user who sent the command, wherever they sent it.
+
+Whisper = collections.namedtuple('Whisper', 'user text')
+# Send `text` to `user` privately.
+
+Pause = collections.namedtuple('Pause', 'seconds')
+# Pause (showing that the bot is typing in the game's channel) before carrying on.
+
+DeleteCommand = collections.namedtuple('DeleteCommand', '')
+# Delete the message that contained the command.
+
+GameOver = collections.namedtuple('GameOver', 'text winner')
+# Post the role reveals in `text`; the game has ended and `winner` won.
+
+
+
+
+# Event log
+# Every command that can change a game is logged in Game.events as a list
+# [name, user_id, timestamp, args...], where timestamp is in microseconds and
+# args are the rest of the method's arguments in JSON-friendly form. The first
+# event is always ['create', owner_id, timestamp]. Since the game's random
+# number generator is seeded from the logged 'start' event, replay() can rebuild
+# the game exactly from its log.
+
+EVENT_ARGS = {
+    # Maps each logged method to the kinds of its arguments after the user:
+    # 'v' plain value, 'u' user, 'U' list of users, 's' Spotify stats (or None)
+    'join': '',
+    'leave': '',
+    'enable': 'vv',
+    'votekick': '',
+    'mute': 'v',
+    'merge': 'v',
+    'unmerge': '',
+    'start': 'vs',
+    'pick': 'U',
+    'pickrandom': '',
+    'vote': 'vv',
+    'outcome': 'vv',
+    'lady_of_the_lake': 'u',
+    'assassinate': 'u',
+    'timeout': 'vv',
+    }
+
+
+def describe_timeout(seconds):
+    # Describe a time limit in words
+    if seconds is None:
+        return 'no limit'
+    if seconds % 60:
+        return '%d second%s' % (seconds, '' if seconds == 1 else 's')
+    return '%d minute%s' % (seconds // 60, '' if seconds == 60 else 's')
+
+
+def encode_arg(kind, arg):
+    if kind == 'u':
+        return arg.id
+    if kind == 'U':
+        return [user.id for user in arg]
+    if (kind == 's') and (arg is not None):
+        # Only the most recent records can affect role assignment
+        return [[user_id, role_id, bool(win_bool), merge_count, to_micros(timestamp)] \
+                for user_id, role_id, win_bool, merge_count, timestamp in arg[-SPOTIFY_HISTORY:]]
+    return arg
+
+
+def decode_arg(kind, arg, get_user):
+    if kind == 'u':
+        return get_user(arg)
+    if kind == 'U':
+        return [get_user(user_id) for user_id in arg]
+    if (kind == 's') and (arg is not None):
+        return [(user_id, role_id, win_bool, merge_count, from_micros(timestamp)) \
+                for user_id, role_id, win_bool, merge_count, timestamp in arg]
+    return arg
+
+
+def replay(events, get_user, bot, channel=None):
+    # Rebuild a game by running its event log through the engine again, with its
+    # clock set to the time of each event. `get_user` maps user IDs to users.
+    # Returns the game and a list of the effects of each event after 'create'.
+    name, user_id, timestamp = events[0]
+    clock = [from_micros(timestamp)]
+    game = Game(channel, get_user(user_id), bot)
+    game.now = lambda: clock[0]
+    game.events = [events[0]]
+    effects = []
+    for name, user_id, timestamp, *args in events[1:]:
+        clock[0] = from_micros(timestamp)
+        args = [decode_arg(kind, arg, get_user) for kind, arg in zip(EVENT_ARGS[name], args)]
+        effects.append(game.command(name, get_user(user_id), *args))
+    game.now = datetime.datetime.utcnow
+    return game, effects
+
+
+
+
+# Role disclosure
+
+Visibility = collections.namedtuple('Visibility', 'view appears_evil appears_merlin')
+# What each player learns at the start of the game, indexed by seat.
+# view[i] is 'minion' if player i sees the other Minions of Mordred, 'merlin'
+# if they see the Minions as Merlin does, 'percival' if they see Merlin and
+# Morgana, or None if they learn nothing.
+# appears_evil[i] is a bitmask of the players that look evil to player i, and
+# appears_merlin[i] a bitmask of the players that look like Merlin to them.
+
+
+@functools.lru_cache(maxsize=1024)
+def role_visibility(config):
+    # Work out the Visibility for a sorted tuple of role tuples. This only depends
+    # on which roles are in play, so it is cached and shared by every game (and
+    # every seating) with the same role configuration.
+    evil = [role[0] in EVIL_ROLES for role in config]
+    view = []
+    appears_evil = []
+    appears_merlin = []
+    for i, role in enumerate(config):
+        seen_evil = seen_merlin = 0
+        # Bad guys figure out who each other are (save for Oberon)
+        # There may be impostors in this list if Norebo and/or Palm are in play.
+        if evil[i] and (Role.OBERON not in role):
+            view.append('minion')
+            for j, other in enumerate(config):
+                if (j != i) and ((evil[j] and (Role.OBERON not in other)) or (Role.NOREBO in other) or (Role.PALM in other)):
+                    seen_evil |= 1 << j
+        # Merlin knows who the bad guys are (save for Mordred)
+        # If Palm is in play Merlin will think he's bad too.
+        elif Role.MERLIN in role:
+            view.append('merlin')
+            for j, other in enumerate(config):
+                if (evil[j] and (Role.MORDRED not in other)) or (Role.PALM in other):
+                    seen_evil |= 1 << j
+        # Percival knows who Morgana and Merlin are (but not which is which)
+        elif Role.PERCIVAL in role:
+            view.append('percival')
+            for j, other in enumerate(config):
+                if (Role.MERLIN in other) or (Role.MORGANA in other):
+                    seen_merlin |= 1 << j
+        else:
+            view.append(None)
+        appears_evil.append(seen_evil)
+        appears_merlin.append(seen_merlin)
+    return Visibility(tuple(view), tuple(appears_evil), tuple(appears_merlin))
+
+
+def seat_visibility(roles):
+    # The Visibility for a game whose player in seat i has the role tuple roles[i]
+    order = sorted(range(len(roles)), key = lambda i: [role.value for role in roles[i]])
+    table = role_visibility(tuple([roles[i] for i in order]))
+    # Translate from positions in the sorted configuration back to seats
+    def seats(mask):
+        result = 0
+        for k, seat in enumerate(order):
+            if mask >> k & 1:
+                result |= 1 << seat
+        return result
+    view = [None] * len(roles)
+    appears_evil = [0] * len(roles)
+    appears_merlin = [0] * len(roles)
+    for k, seat in enumerate(order):
+        view[seat] = table.view[k]
+        appears_evil[seat] = seats(table.appears_evil[k])
+        appears_merlin[seat] = seats(table.appears_merlin[k])
+    return Visibility(tuple(view), tuple(appears_evil), tuple(appears_merlin))
+
+
+
+
+class Player:
+
+    # A single player in a game
+    __slots__ = ('user', 'role', 'side', 'vote', 'outcome')
+
+    def __init__(self, user, role=(), side=None, vote=None, outcome=None):
+        self.user = user # The user controlling this player.
+        self.role = role # The tuple of Roles of this player.
+        self.side = side # True if this player is good, False if they are evil.
+        self.vote = vote # True for an approve vote, False for a reject.
+        self.outcome = outcome # True for a success outcome, False for a fail.
+
+    def __repr__(self):
+        return 'Player(%r, %r, %r, %r, %r)' % (self.user, self.role, self.side, self.vote, self.outcome)
+
+
+
+
+# Constrained role assignment (used by Spotify mode)
+
+def find_assignment(allowed, fixed=()):
+    # Returns a list giving every player a distinct slot, or None if there is
+    # no way to. `allowed` is a list (one entry per player) of sets of slot
+    # indices that player may receive; `fixed` is a sequence of slots that are
+    # already taken. This is a plain augmenting-path bipartite matching, which
+    # is instant for the 5-10 players a game can have.
+    owner = dict.fromkeys(fixed, -1) # slot -> player index holding it
+    def augment(i, seen):
+        for slot in allowed[i]:
+            if slot in seen:
+                continue
+            seen.add(slot)
+            if (slot not in owner) or ((owner[slot] >= 0) and augment(owner[slot], seen)):
+                owner[slot] = i
+                return True
+        return False
+    if not all(augment(i, set()) for i in range(len(allowed))):
+        return None
+    slots = [None] * len(allowed)
+    for slot, i in owner.items():
+        if i >= 0:
+            slots[i] = slot
+    return slots
+
+
+def has_assignment(allowed, fixed=()):
+    # Returns True if every player can be given a distinct slot (see find_assignment())
+    return find_assignment(allowed, fixed) is not None
+
+
+def spotify_constraints(roles, ids, stats):
+    # Work out which slots of `roles` each player may receive in Spotify mode.
+    # `roles` is a list of (role, side) pairs, where role may be a tuple of merged
+    # roles; `ids` are the user ids of the players in seating order; `stats` is the
+    # chronological list of stats records. Going from the newest record back, each
+    # player is forbidden from getting a role they had recently, until either
+    # SPOTIFY_HISTORY records have been looked at or the next restriction would
+    # leave no valid assignment at all.
+    holding = {} # Maps each role ID in play to the set of slots including that role
+    for slot, (role, side) in enumerate(roles):
+        for r in (role if isinstance(role, tuple) else (role,)):
+            holding.setdefault(r.value, set()).add(slot)
+    seat = {user_id: index for index, user_id in enumerate(ids)}
+    allowed = [set(range(len(roles))) for i in ids]
+    assignment = list(range(len(ids))) # A valid assignment under `allowed`
+    for user_id, role_id, win_bool, merge_count, timestamp in stats[:-SPOTIFY_HISTORY-1:-1]:
+        index = seat.get(user_id)
+        if (index is None) or not allowed[index].intersection(holding.get(role_id, ())):
+            continue
+        narrowed = allowed[index].difference(holding[role_id])
+        if not narrowed:
+            break # Have to finish now
+        trial = allowed[:]
+        trial[index] = narrowed
+        if assignment[index] not in narrowed:
+            # Only look for a new assignment if the restriction rules out the current one
+            assignment = find_assignment(trial)
+            if assignment is None:
+                break # Likewise
+        allowed = trial
+    return allowed
+
+
+def constrained_shuffle(items, allowed, rng=random):
+    # Return a random ordering of `items` in which position i holds one of the
+    # items indexed by allowed[i]. A few plain shuffles are tried first, since
+    # when the constraints are loose one of them usually fits, and accepting the
+    # first that does picks uniformly among all valid orderings. Otherwise the
+    # ordering is drawn one position at a time, only ever choosing an item that
+    # still leaves a way to fill the remaining positions, so no work is wasted.
+    n = len(items)
+    for i in range(SPOTIFY_TRIES):
+        perm = rng.sample(range(n), n)
+        if all([perm[j] in allowed[j] for j in range(n)]):
+            return [items[j] for j in perm]
+    perm = []
+    for i in range(n):
+        choices = sorted(allowed[i].difference(perm))
+        rng.shuffle(choices)
+        for slot in choices:
+            if has_assignment(allowed[i+1:], perm + [slot]):
+                perm.append(slot)
+                break
+        else:
+            raise ValueError('no valid assignment exists')
+    return [items[j] for j in perm]
+
+
+
+
+
+
+
+
+class Game:
+
+    # State of a single Avalon game.
+    # `channel` identifies where the game is being played and `bot` is the user
+    # players should send private commands to; the engine never looks at either
+    # except to mention the bot in its messages.
+
+    def __init__(self, channel, user, bot):
+        self.channel = channel # Where the game is being played
+        self.bot = bot # The bot user, which players send private commands to
+        self.rng = random.Random() # Source of randomness for this game
+        self.now = datetime.datetime.utcnow # Clock used to timestamp the game record
+        self.command_time = None # Time the command being run was logged at
+        self.owner = Player(user) # The player who started the game
+        self.running = False # True if the game is currently ongoing
+        self.players = [self.owner] # List of Player objects in the game, in order
+        self.team = [] # List of members of the current team
+        self.leader = None
+        self.current_quest = None # A 2-tuple (team members, fails required)
+        self.quest_results = [] # Boolean values signifying which quests so far have passed
+        self.reject_counter = 1 # Number of consecutive teams that have been rejected
+        self.lady = None # The player who currently has the Lady of the Lake
+        self.investigated = [] # Keep track of who has been investigated using Lady of the Lake
+        self.assassin = None # The player with the Assassin role, once it is their turn
+        self.start_time = None # When the game was started
+        self.vote_history = [] # Details of every team vote, for the game record
+        self.quest_history = [] # Details of every quest, for the game record
+        self.lady_history = [] # Details of every Lady of the Lake investigation, for the game record
+        self.assassinated = None # The player the Assassin chose, if any
+        self.winner = None # GOOD or EVIL once the game is over
+        self.waiting_for_votes = False # True if the game is waiting for people to cast their votes
+        self.waiting_for_outcomes = False # True if the game is waiting for people to decide the outcome
+        self.waiting_for_lady = False # True if the game is waiting for someone to play the Lady of the Lake
+        self.waiting_for_assassin = False # True if the game is waiting for the assassin to kill someone
+        self.muted = False # True if the bot is currently silencing all non-bot command messages
+        self.votekicks = set() # List of people who have requested that the game be canceled due to an unresponsive owner
+        # Game features
+        self.features = {
+            # True means enabled; False disabled.
+            'merlin': True,
+            'morgana': False,
+            'mordred': False,
+            'oberon': False,
+            'norebo': False,
+            'palm': False,
+            'lady': False,
+            }
+        self.merged = [] # Merged roles
+        self.timeouts = dict(PHASE_TIMEOUTS) # Seconds allowed for each phase before default_moves() are made
+        self.visibility = None # What everyone learned about each other at the start (a Visibility)
+        self.events = [['create', user.id, self.timestamp()]] # Log of commands, for replay()
+
+
+    def command(self, name, user, *args):
+        # Run the method `name` on behalf of `user` with the given arguments and
+        # return its effects, logging the command first if it is in EVENT_ARGS
+        if name not in EVENT_ARGS:
+            return getattr(self, name)(user, *args)
+        if (name == 'start') and (args[0] is None):
+            # Pick the seed here so that it goes in the log
+            args = (random.getrandbits(64),) + args[1:]
+        self.command_time = from_micros(to_micros(self.now())) # Same precision as the log
+        self.events.append([name, user.id, self.timestamp()] + \
+                           [encode_arg(kind, arg) for kind, arg in zip(EVENT_ARGS[name], args)])
+        try:
+            return getattr(self, name)(user, *args)
+        finally:
+            self.command_time = None
+
+
+    def find_player(self, user):
+        # Find the Player corresponding to the given user
+        for player in self.players:
+            if player.user == user:
+                return player
+
+
+
+
+    ##### Checks; each returns a list of error effects, or None if the check passes #####
+
+
+    def check_owner(self, user):
+        if self.owner.user != user:
+            return [Reply('This game was created by %s. You do not have permission to modify it.' % self.owner.user.mention)]
+
+    def check_running(self):
+        if not self.running:
+            return [Reply('This game has not started yet.')]
+
+    def check_not_running(self):
+        if self.running:
+            return [Reply('Cannot modify this game, it has already started.')]
+
+
+
+
+    ##### Setting up the game #####
+
+
+    def join(self, user):
+        # Add a player to the game
+        errors = self.check_not_running()
+        if errors:
+            return errors
+        # Make sure we're not already part of the game
+        if self.find_player(user):
+            return [Reply('You are already part of this game.')]
+        # Add the player
+        self.players.append(Player(user))
+        # Make a public announcement
+        return [Announce('%s has joined the game.' % user.mention)]
+
+
+    def leave(self, user):
+        # Remove a player from the game (the owner cancels it instead)
+        errors = self.check_not_running()
+        if errors:
+            return errors
+        # Make sure we're currently part of the game
+        player = self.find_player(user)
+        if not player:
+            return [Reply('You are not part of this game.')]
+        # Remove the player
+        self.players.remove(player)
+        # Make a public announcement
+        return [Announce('%s has left the game.' % user.mention)]
+
+
+    def enable(self, user, feature, enable):
+        # Enable or disable a feature
+        errors = self.check_not_running() or self.check_owner(user)
+        if errors:
+            return errors
+        # Make sure the feature exists
+        if feature == 'all':
+            # Enable/disable all
+            for key in self.features:
+                self.features[key] = enable
+            return [Announce('all %s' % ('enabled' if enable else 'disabled'))]
+        if feature in ('perc', 'percival'):
+            feature = 'morgana' # alias
+        if feature not in self.features:
+            return [Reply('Unrecognized feature "%s": should be one of %s, all' % (feature, ', '.join(self.features)))]
+        self.features[feature] = enable
+        return [Announce('%s %s' % (FEATURE_NAMES[feature], 'enabled' if enable else 'disabled'))]
+
+
+    def votekick(self, user):
+        # Vote to cancel the game; four votes end it
+        self.votekicks.add(user.id)
+        if len(self.votekicks) == 1:
+            effects = [Reply('1 person has voted to cancel the game.')]
+        else:
+            effects = [Reply('%d people have voted to cancel the game.' % len(self.votekicks))]
+        if len(self.votekicks) >= 4:
+            self.owner = None
+            # Make a public announcement
+            effects.append(Announce('The currently active game has been canceled by popular vote.'))
+        return effects
+
+
+    def mute(self, user, muted):
+        # Turn silent mode on or off
+        errors = self.check_not_running() or self.check_owner(user)
+        if errors:
+            return errors
+        self.muted = muted
+        if muted:
+            return [Announce('**The host has muted the game.** All in-game discussion will be deleted by the bot.')]
+        return [Announce('**The host has unmuted the game.** In-game discussion is freely allowed.')]
+
+
+    def merge(self, user, names):
+        # Merge two or more special roles
+        errors = self.check_not_running() or self.check_owner(user)
+        if errors:
+            return errors
+        values = []
+        # Look up the roles based on the string
+        for name in names:
+            try:
+                value = ROLE_NAMES[3:].index(name.title()) + 3
+            except ValueError:
+                # Role does not exist
+                return [Reply('Unrecognized role "%s": should be one of %s' % (name, ', '.join(ROLE_NAMES[3:])))]
+            if Role(value) in values:
+                return [Reply('Duplicate role "%s"' % name)]
+            values.append(Role(value))
+        # Find everything else that overlaps and merge it into one
+        merged = self.merged[:]
+        for merge in merged[:]:
+            if set(merge).intersection(values):
+                values.extend(merge)
+                merged.remove(merge)
+        values = sorted(set(values), key = lambda x: x.value)
+        # Make sure the merged roles are actually okay to merge
+        # First check that they are either all good or all evil
+        good = [value for value in values if value in GOOD_ROLES]
+        if len(good) not in (0, len(values)):
+            return [Reply('Cannot merge good roles with evil roles.')]
+        if (Role.MERLIN in values) and (Role.PERCIVAL in values):
+            return [Reply('Cannot merge Merlin with Percival.')] # This would break too many things
+        merged.append(values)
+        self.merged = merged
+        # Enable things if necessary
+        effects = []
+        for role in values:
+            name = ROLE_NAMES[role.value].lower()
+            if name == 'assassin': name = 'merlin'
+            if name == 'percival': name = 'morgana'
+            if not self.features[name]:
+                self.features[name] = True
+                effects.append(Reply('%s enabled' % FEATURE_NAMES[name]))
+        # Make a public announcement
+        effects.append(Announce('Roles %s have been merged for this game.' % ', '.join([ROLE_NAMES[role.value] for role in values])))
+        return effects
+
+
+    def unmerge(self, user):
+        # Unmerge all previously merged special roles
+        errors = self.check_not_running() or self.check_owner(user)
+        if errors:
+            return errors
+        self.merged = []
+        return [Announce('All roles have been unmerged for this game.')]
+
+
+    def timeout(self, user, phase, seconds):
+        # Set how long a phase may take (None for no limit) before the bot
+        # makes the choice for whoever is holding it up
+        errors = self.check_owner(user)
+        if errors:
+            return errors
+        if phase == 'all':
+            phases = list(self.timeouts)
+        elif phase in self.timeouts:
+            phases = [phase]
+        else:
+            return [Reply('Unrecognized phase "%s": should be one of %s, all' % (phase, ', '.join(self.timeouts)))]
+        for key in phases:
+            self.timeouts[key] = seconds
+        return [Announce('Time limit for %s: %s' % (phase, describe_timeout(seconds)))]
+
+
+    def start(self, user, seed=None, spotify_stats=None):
+        # Start the game. `seed` seeds this game's random number generator (a fresh
+        # random seed is used if it is None). If `spotify_stats` is given, roles are
+        # assigned in Spotify mode, avoiding roles players had in those recent stats.
+        errors = self.check_owner(user)
+        if errors:
+            return errors
+        if self.running:
+            return [Reply('The game has already started.')]
+        # Set up the quests
+        if len(self.players) not in QUEST_LISTS:
+            return [Reply('Cannot start: this game has too %s players' % ('few' if len(self.players) < 5 else 'many'))]
+        self.current_quest = QUEST_LISTS[len(self.players)][0] # This is always a 2-tuple (team members, fails required)
+        self.running = True
+        self.start_time = self.time()
+        # Make a public announcement
+        effects = [Announce('The game has now been started!')]
+        # Set up the game
+        self.rng.seed(seed) # Seed the random number generator
+        self.rng.shuffle(self.players) # Randomize the play order
+        if self.features['lady']:
+            self.lady = self.players[-1] # Give the Lady of the Lake to the last player who will get to lead a team
+            self.investigated = [self.lady]
+        effects += self.info(user) # Print out the public info
+        effects += self.secret_info(spotify_stats)
+        effects += self.init_team()
+        return effects
+
+
+
+
+    ##### Status #####
+
+
+    def info(self, user):
+        # Print out the current game info
+        info = '**Current players:**\n%s\n' % ', '.join([player.user.name for player in self.players])
+        info += 'Game owner: %s\n' % self.owner.user.mention
+        if self.muted:
+            info += '*This is a silent game.*\n'
+        info += '**Game settings:**\n%s\n' % '\n'.join(['%s %s' % \
+                                                        (FEATURE_NAMES[key], 'enabled' if value else 'disabled') \
+                                                        for key, value in self.features.items()])
+        info += '**Time limits:** %s\n' % ', '.join(['%s %s' % (key, describe_timeout(value)) for key, value in self.timeouts.items()])
+        if self.merged:
+            info += '**Merged roles:**\n%s\n' % '\n'.join([', '.join([ROLE_NAMES[role.value] for role in group]) for group in self.merged])
+        if not self.running:
+            info += 'Game has not yet started.'
+            return [Reply(info)]
+        info += '**Current team**:\n%s\n' % ', '.join([player.user.name for player in self.team])
+        info += '**Current results**:\n```\n%s\n%s\nVote tracker: %d\n```\n' % \
+                (' '.join([str(i[0]) for i in QUEST_LISTS[len(self.players)]]),
+                 ' '.join(['S' if i else 'F' for i in self.quest_results]),
+                 self.reject_counter)
+        if self.lady:
+            info += '%s currently has the Lady of the Lake' % self.lady.user.name
+        if self.muted:
+            return [Whisper(user, info)] + self.poke()
+        return [Reply(info)] + self.poke()
+
+
+    def poke(self):
+        # Point out who the game is currently waiting for
+        errors = self.check_running()
+        if errors:
+            return errors
+        if self.waiting_for_votes:
+            return [Reply('*Currently waiting for the following players to cast their votes: %s*' % \
+                          ', '.join([p.user.mention for p in self.players if p.vote is None]))]
+        if self.waiting_for_outcomes:
+            return [Reply('*Currently waiting for the following players to play their Success/Fail cards: %s*' % \
+                          ', '.join([p.user.mention for p in self.team if p.outcome is None]))]
+        if self.waiting_for_lady:
+            return [Reply('*Currently waiting for %s to play the Lady of the Lake*' % self.lady.user.mention)]
+        if self.waiting_for_assassin:
+            return [Reply('*Currently waiting for %s to pick someone to assassinate*' % self.assassin.user.mention)]
+        if self.leader and (len(self.team) < self.current_quest[0]):
+            n = self.current_quest[0] - len(self.team)
+            return [Reply('*Currently waiting for %s to pick %d%s team member%s*' % \
+                          (self.leader.user.mention, n, (' more' if self.team else ''), ('s' if n > 1 else '')))]
+        return [Reply('*Not currently waiting for anyone to make a decision.*')]
+
+
+    def phase(self):
+        # The phase the game is waiting on ('pick', 'vote', 'outcome', 'lady' or
+        # 'assassin'), or None if it isn't waiting for anyone
+        if not self.running:
+            return None
+        if self.waiting_for_votes:
+            return 'vote'
+        if self.waiting_for_outcomes:
+            return 'outcome'
+        if self.waiting_for_lady:
+            return 'lady'
+        if self.waiting_for_assassin:
+            return 'assassin'
+        if self.leader and (len(self.team) < self.current_quest[0]):
+            return 'pick'
+        return None
+
+
+    def default_moves(self, rng=random):
+        # The commands to run when the current phase runs out of time, as
+        # (name, user, args) tuples: random picks to fill the team, approvals from
+        # everyone who hasn't voted, Success cards from everyone on the team who
+        # hasn't played one, or a random investigation or assassination. `rng`
+        # makes the random choices, which are logged with the commands as usual.
+        phase = self.phase()
+        if phase == 'pick':
+            return [('pickrandom', self.leader.user, ())] * (self.current_quest[0] - len(self.team))
+        if phase == 'vote':
+            return [('vote', p.user, (APPROVE,)) for p in self.players if p.vote is None]
+        if phase == 'outcome':
+            return [('outcome', p.user, (SUCCESS,)) for p in self.team if p.outcome is None]
+        if phase == 'lady':
+            targets = [p for p in self.players if (p is not self.lady) and (p not in self.investigated)]
+            return [('lady_of_the_lake', self.lady.user, (rng.choice(targets).user,))]
+        if phase == 'assassin':
+            # Someone the Assassin doesn't already know to be evil
+            seat = self.players.index(self.assassin)
+            targets = [p for i, p in enumerate(self.players) if (i != seat) and not (self.visibility.appears_evil[seat] >> i & 1)] \
+                      or [p for p in self.players if p is not self.assassin]
+            return [('assassinate', self.assassin.user, (rng.choice(targets).user,))]
+        return []
+
+
+
+
+    ##### Playing the game #####
+
+
+    def pick(self, user, users):
+        # Add people to the team
+        errors = self.check_running()
+        if errors:
+            return errors
+        if user != self.leader.user:
+            return [Reply('Error: You are not currently the leader of the team.')]
+        if len(self.team) == self.current_quest[0]:
+            return [Reply('Error: Your team is currently full.')]
+        new_players = []
+        for target in users:
+            player = self.find_player(target)
+            if not player:
+                return [Reply('Error: %s is not part of the game.' % target.name)]
+            if player in self.team + new_players:
+                return [Reply('Error: %s is already part of the team.' % player.user.name)]
+            new_players.append(player)
+            if len(self.team + new_players) > self.current_quest[0]:
+                return [Reply('Error: the team only has room for %d members.' % self.current_quest[0])]
+        # Add the new players then
+        self.team.extend(new_players)
+        # Make a public announcement:
+        effects = [Announce('%s added new teammate%s %s.' % (self.leader.user.mention,
+                                                             's' if len(new_players) >= 2 else '',
+                                                             ', '.join([player.user.mention for player in new_players])))]
+        # Figure out if we now have the correct number
+        if len(self.team) == self.current_quest[0]:
+            effects += self.init_voting()
+        else:
+            n = self.current_quest[0] - len(self.team)
+            effects.append(Reply('You still need to pick %d more teammate%s.' % (n, 's' if n >= 2 else '')))
+        return effects
+
+
+    def pickrandom(self, user):
+        # Pick a random person to join the team
+        errors = self.check_running()
+        if errors:
+            return errors
+        return self.pick(user, [self.rng.choice([p for p in self.players if p not in self.team]).user])
+
+
+    def vote(self, user, vote, private=True):
+        # Vote for or against a team. `private` is False if the vote was cast in public.
+        errors = self.check_running()
+        if errors:
+            return errors
+        if not private:
+            return [DeleteCommand(), Reply('Votes should be cast in a **private message** to %s. Please try again.' % self.bot.mention)]
+        if len(self.team) != self.current_quest[0]:
+            return [Reply('Cannot vote: the team is not full yet.')]
+        player = self.find_player(user)
+        if player is None:
+            return [Reply('Cannot vote: you are not part of this game.')]
+        if not self.waiting_for_votes:
+            return [Reply('Sorry, it is too late to change your vote.')]
+        if player.vote is None:
+            effects = [Reply('Thank you for voting!')]
+        else:
+            effects = [Reply('Your vote has been updated.')]
+        player.vote = vote
+        if not any([p.vote is None for p in self.players]):
+            approved, results = self.tabulate_votes()
+            effects += results
+            if self.running:
+                if approved:
+                    effects += self.init_outcome()
+                else:
+                    effects += self.init_team()
+            # Reset the votes to make extra sure
+            for player in self.players:
+                player.vote = None
+        return effects
+
+
+    def outcome(self, user, outcome, private=True):
+        # Signal a quest to succeed or fail. `private` is False if the card was played in public.
+        errors = self.check_running()
+        if errors:
+            return errors
+        if not private:
+            return [DeleteCommand(), Reply('Play your success or fail cards in a **private message** to %s, you doofus.' % self.bot.mention)]
+        if not self.waiting_for_outcomes:
+            return [Reply('Too early to play success or fail cards.')]
+        player = self.find_player(user)
+        if player is None:
+            return [Reply('Cannot play success/fail cards: you are not part of this game.')]
+        if player not in self.team:
+            return [Reply('Cannot play success/fail cards: you are not part of this team.')]
+        if player.outcome is not None:
+            return [Reply('You have already played a success/fail card.')]
+        if (player.side == GOOD) and (outcome == FAIL):
+            return [Reply('Servants of Arthur are not permitted to play Fail cards. Please use the "av success" command.')]
+        player.outcome = outcome
+        effects = [Reply('Thank you for playing your card!')]
+        if self.team and not any([p.outcome is None for p in self.team]):
+            effects += self.tabulate_outcome()
+            if self.running and not self.waiting_for_assassin:
+                if self.lady and (len(self.quest_results) >= 2):
+                    self.waiting_for_lady = True
+                    effects.append(Announce('**Lady of the Lake:** %s, choose someone to investigate using "av lady".' % self.lady.user.mention))
+                else:
+                    self.next_quest()
+                    effects += self.init_team()
+            # Reset the outcomes to make extra sure
+            for player in self.players:
+                player.outcome = None
+        return effects
+
+
+    def lady_of_the_lake(self, user, target):
+        # Investigate the alignment of another player
+        errors = self.check_running()
+        if errors:
+            return errors
+        if not self.waiting_for_lady:
+            return [Reply('Error: It is not currently time to use the Lady of the Lake.')]
+        if user != self.lady.user:
+            return [Reply('Error: You do not currently have the Lady of the Lake.')]
+        player = self.find_player(target)
+        if not player:
+            return [Reply('Error: %s is not part of the game.' % target.name)]
+        if player.user == user:
+            return [Reply('Error: you cannot investigate yourself.')]
+        if player in self.investigated:
+            return [Reply('Error: you cannot investigate someone who has already had the Lady of the Lake.')]
+        # Make a public announcement
+        effects = [Announce('**Lady of the Lake:** %s has chosen to investigate %s.' % (self.lady.user.mention, player.user.mention))]
+        # Send a private message
+        effects.append(Whisper(self.lady.user, 'Investigative result: %s is **%s**' % (player.user.name, 'Good' if player.side == GOOD else 'Evil')))
+        self.lady_history.append({
+            'holder': self.lady.user.id,
+            'target': player.user.id,
+            'time': self.timestamp(),
+            })
+        # And update who has the Lady of the Lake
+        self.lady = player
+        self.investigated.append(player)
+        self.waiting_for_lady = False
+        self.next_quest()
+        effects += self.init_team()
+        return effects
+
+
+    def assassinate(self, user, target):
+        # Try to kill Merlin at the end of the game
+        errors = self.check_running()
+        if errors:
+            return errors
+        if not self.waiting_for_assassin:
+            return [Reply('Error: It is not currently time to assassinate someone.')]
+        if user != self.assassin.user:
+            return [Reply('Error: You are not the Assassin.')]
+        player = self.find_player(target)
+        if not player:
+            return [Reply('Error: %s is not part of the game.' % target.name)]
+        # Make a public announcement
+        effects = [Announce('**Assassin:** %s has chosen to assassinate %s.' % (self.assassin.user.mention, player.user.mention))]
+        self.assassinated = player
+        self.waiting_for_assassin = False
+        effects.append(Pause(DRAMATIC_PAUSE)) # Pause for dramatic effect
+        if Role.MERLIN in player.role:
+            effects.append(Announce('**The game is over. %s correctly identified Merlin. Evil wins!!**' % self.assassin.user.mention))
+            effects += self.finish_game(EVIL)
+        else:
+            effects.append(Announce('**The game is over. %s failed to identify Merlin. Good wins!!**' % self.assassin.user.mention))
+            effects += self.finish_game(GOOD)
+        return effects
+
+
+
+
+    ##### Other game running methods #####
+
+
+    def secret_info(self, spotify_stats=None):
+        # Figure out which roles are being used
+        effects = []
+        n_evil = N_EVIL[len(self.players)]
+        good = [Role.SERVANT for i in range(len(self.players) - n_evil)]
+        evil = [Role.MINION for i in range(n_evil)]
+        special_good = []
+        special_evil = []
+        # Merlin/Morgana roles
+        if self.features['merlin']:
+            special_good.append(Role.MERLIN)
+            special_evil.append(Role.ASSASSIN)
+            if self.features['morgana']:
+                special_good.append(Role.PERCIVAL)
+                special_evil.append(Role.MORGANA)
+        elif self.features['morgana']:
+            # Warn that these are being ignored
+            effects.append(Announce('Switching Morgana/Percival off because Merlin is off.'))
+            self.features['morgana'] = False
+        # Other weird roles
+        if self.features['mordred']:
+            special_evil.append(Role.MORDRED)
+        if self.features['oberon']:
+            special_evil.append(Role.OBERON)
+        if self.features['norebo']:
+            special_good.append(Role.NOREBO)
+        if self.features['palm']:
+            special_good.append(Role.PALM)
+        # Merged roles
+        for merge in self.merged:
+            good_merge = tuple([role for role in merge if role in special_good])
+            evil_merge = tuple([role for role in merge if role in special_evil])
+            if len(good_merge) >= 2:
+                for role in good_merge:
+                    special_good.remove(role)
+                special_good.append(good_merge)
+            elif len(evil_merge) >= 2:
+                for role in evil_merge:
+                    special_evil.remove(role)
+                special_evil.append(evil_merge)
+        # Consolidate all roles into the appropriately sized lists
+        good = (special_good + good)[:len(good)]
+        evil = (special_evil + evil)[:len(evil)]
+        # Turn off roles if we don't have enough players for them
+        rejected_roles = [role for role in special_good if role not in good] + \
+                         [role for role in special_evil if role not in evil]
+        for role in rejected_roles:
+            if not isinstance(role, tuple):
+                role = (role,)
+            effects.append(Announce('Switching %s off because there are not enough players.' % '/'.join([ROLE_NAMES[r.value] for r in role])))
+            for sub in role:
+                feature = ROLE_NAMES[sub.value].lower()
+                if feature in self.features:
+                    self.features[feature] = False
+        # Randomly assign them to players
+        roles = [(role, True) for role in good] + [(role, False) for role in evil]
+        if spotify_stats is not None:
+            ids = [p.user.id for p in self.players]
+            roles = constrained_shuffle(roles, spotify_constraints(roles, ids, spotify_stats), self.rng)
+        else:
+            self.rng.shuffle(roles)
+        for player, (role, side) in zip(self.players, roles):
+            player.role = (role if isinstance(role, tuple) else (role,))
+            player.side = side
+            names = [ROLE_NAMES[role.value] for role in player.role]
+            names = [name for name in names if name not in ('Palm', 'Norebo')] # Palm and Norebo don't know their own identities.
+            name = '/'.join(names) or ROLE_NAMES[Role.SERVANT.value] # `names` should only be empty if it's a good guy whose special role is Palm or Norebo
+            effects.append(Whisper(player.user, 'Your role for this game: **%s**\nYour alignment: **%s**' % \
+                                   (name, ('Good' if side == GOOD else 'Evil'))))
+        # Disclose information to players as appropriate
+        self.visibility = seat_visibility([player.role for player in self.players])
+        for i, player in enumerate(self.players):
+            view = self.visibility.view[i]
+            minions = [p.user.name for j, p in enumerate(self.players) if self.visibility.appears_evil[i] >> j & 1]
+            if view == 'minion':
+                if minions:
+                    effects.append(Whisper(player.user, 'Other Minions of Mordred: %s' % ', '.join(minions)))
+                else:
+                    effects.append(Whisper(player.user, 'There are no other Minions of Mordred.'))
+            elif view == 'merlin':
+                if minions:
+                    effects.append(Whisper(player.user, 'The Minions of Mordred are: %s' % ', '.join(minions)))
+                else:
+                    effects.append(Whisper(player.user, 'There are no Minions of Mordred.'))
+            elif view == 'percival':
+                merlins = [p.user.name for j, p in enumerate(self.players) if self.visibility.appears_merlin[i] >> j & 1]
+                self.rng.shuffle(merlins)
+                effects.append(Whisper(player.user, 'Merlin and Morgana are %s and %s (in some order)' % tuple(merlins)))
+        return effects
+
+
+    def next_quest(self):
+        # Move on to the next quest
+        self.current_quest = QUEST_LISTS[len(self.players)][len(self.quest_results)]
+
+
+    def init_team(self):
+        # Announce a new leader and let them pick a team
+        if self.leader:
+            index = self.players.index(self.leader)
+            self.leader = self.players[(index + 1) % len(self.players)]
+        else:
+            self.leader = self.players[0]
+        self.team = []
+        effects = [Announce('%s is now the leader. Pick %d people to join the team (possibly including yourself) using "av pick".' % \
+                            (self.leader.user.mention, self.current_quest[0]))]
+        # Special messages if necessary
+        if self.current_quest[1] == 2:
+            effects.append(Announce('**Reminder: This quest requires 2 fails instead of 1.**'))
+        if self.reject_counter == 4:
+            effects.append(Announce('**Warning: Evil will win if this quest is rejected.**'))
+        return effects
+
+
+    def init_voting(self):
+        # Reset everyone's votes and let them cast votes again
+        self.waiting_for_votes = True
+        for player in self.players:
+            player.vote = None
+        return [Announce('''Everyone: the team for this quest is %s.
+Please cast your votes **privately** by DMing either "av approve" or "av reject" to %s.''' % \
+                         (', '.join([player.user.mention for player in self.team]), self.bot.mention))]
+
+
+    def tabulate_votes(self):
+        # Tabulate the votes that were cast; returns whether the team was approved
+        # along with the effects
+        self.waiting_for_votes = False
+        effects = [Announce('Voting for the team has concluded. Results are:\n%s' % \
+                            '\n'.join(['%s: %s' % (p.user.name, 'Approve' if p.vote == APPROVE else 'Reject') for p in self.players]),
+                            True)] # Delete after a certain time
+        approved = sum([p.vote for p in self.players]) > len(self.players) // 2
+        self.vote_history.append({
+            'leader': self.leader.user.id,
+            'team': [p.user.id for p in self.team],
+            'votes': [[p.user.id, bool(p.vote)] for p in self.players],
+            'approved': approved,
+            'time': self.timestamp(),
+            })
+        if approved:
+            effects.append(Announce('The team consisting of %s was approved!' % ', '.join([player.user.mention for player in self.team])))
+            self.reject_counter = 1
+            return True, effects
+        self.reject_counter += 1
+        effects.append(Announce('The team consisting of %s was rejected. Vote tracker is now at **%d** out of 5.' % \
+                                (', '.join([player.user.mention for player in self.team]), self.reject_counter)))
+        effects += self.check_for_winner()
+        return False, effects
+
+
+    def init_outcome(self):
+        # Let everyone on the team play success/fail cards
+        self.waiting_for_outcomes = True
+        for player in self.team:
+            player.outcome = None
+        return [Announce('''Everyone who is on the team: please signal the outcome of this quest
+**privately** by DMing either "av success" or "av fail" to %s.''' % self.bot.mention)]
+
+
+    def tabulate_outcome(self):
+        # Determine whether the quest succeeded
+        self.waiting_for_outcomes = False
+        effects = [Pause(DRAMATIC_PAUSE)] # Pause for dramatic effect
+        n_fails = [p.outcome for p in self.team].count(FAIL)
+        if n_fails == 1:
+            effects.append(Announce('There was 1 Fail card played out of %d.' % len(self.team)))
+        else:
+            effects.append(Announce('There were %d Fail cards played out of %d.' % (n_fails, len(self.team))))
+        if n_fails >= self.current_quest[1]:
+            effects.append(Announce('**The quest has failed.**'))
+            self.quest_results.append(False)
+        else:
+            effects.append(Announce('**The quest has succeeded!**'))
+            self.quest_results.append(True)
+        self.quest_history.append({
+            'team': [p.user.id for p in self.team],
+            'fails': n_fails,
+            'fails_required': self.current_quest[1],
+            'result': self.quest_results[-1],
+            'time': self.timestamp(),
+            })
+        effects += self.check_for_winner()
+        return effects
+
+
+    def check_for_winner(self):
+        # Check for a winner
+        if self.quest_results.count(False) >= 3:
+            return [Announce('**The game is over. Evil wins!!**')] + self.finish_game(EVIL)
+        if self.reject_counter >= 5:
+            return [Announce('**The game is over. The vote tracker has reached 5. Evil wins!!**')] + self.finish_game(EVIL)
+        if self.quest_results.count(True) >= 3:
+            if self.features['merlin']:
+                self.assassin = [p for p in self.players if Role.ASSASSIN in p.role][0]
+                self.waiting_for_assassin = True
+                return [Announce('**Good is about to win.** %s, choose someone to assassinate using "av assassinate".' % self.assassin.user.mention)]
+            return [Announce('**The game is over. Good wins!!**')] + self.finish_game(GOOD)
+        return []
+
+
+    def finish_game(self, winner):
+        # Announce the roles and clear the `running' flag
+        self.owner = None
+        self.running = False
+        self.winner = winner
+        info = '**Game role reveals:**\n'
+        for p in self.players:
+            info += '%s: %s\n' % (p.user.mention, '/'.join([ROLE_NAMES[role.value] for role in p.role]))
+        return [GameOver(info, winner)]
+
+
+
+
+    ##### Game records #####
+
+
+    def time(self):
+        # The current time, or while a command is being run, the time it was logged
+        # with (so that replaying the log reproduces every timestamp exactly)
+        return self.now() if self.command_time is None else self.command_time
+
+
+    def timestamp(self):
+        # Current time in integer microseconds since the epoch
+        return to_micros(self.time())
+
+
+    def record(self, timestamp):
+        # Return the structured record of a finished game (a JSON-serializable
+        # dict) and the stats records it produces. `timestamp` is when it finished.
+        winner = self.winner
+        rows = []
+        for p in self.players:
+            for role in p.role:
+                rows.append((p.user.id, role.value, p.side == winner, len(p.role), timestamp))
+        record = {
+            'players': [{'id': p.user.id, 'roles': [role.value for role in p.role], 'side': p.side} for p in self.players],
+            'features': self.features,
+            'merged': [[role.value for role in merge] for merge in self.merged],
+            'winner': winner,
+            'quest_results': self.quest_results,
+            'quests': self.quest_history,
+            'votes': self.vote_history,
+            'lady': self.lady_history,
+            'assassinated': self.assassinated.user.id if self.assassinated else None,
+            'started': to_micros(self.start_time),
+            'finished': to_micros(timestamp),
+            'events': self.events,
+            }
+        return record, rows
+
+
+
+
+    ##### Snapshots #####
+
+
+    def snapshot(self):
+        # Return the complete state of the game as a JSON-serializable dict, from
+        # which restore() can rebuild it. Users are stored by ID and players by
+        # their seat (index in self.players).
+        def seat(player):
+            return None if player is None else self.players.index(player)
+        version, state, gauss_next = self.rng.getstate()
+        return {
+            'owner': self.owner.user.id,
+            'running': self.running,
+            'players': [[p.user.id, [role.value for role in p.role], p.side, p.vote, p.outcome] for p in self.players],
+            'team': [seat(p) for p in self.team],
+            'leader': seat(self.leader),
+            'current_quest': self.current_quest,
+            'quest_results': self.quest_results,
+            'reject_counter': self.reject_counter,
+            'lady': seat(self.lady),
+            'investigated': [seat(p) for p in self.investigated],
+            'assassin': seat(self.assassin),
+            'start_time': None if self.start_time is None else to_micros(self.start_time),
+            'vote_history': self.vote_history,
+            'quest_history': self.quest_history,
+            'lady_history': self.lady_history,
+            'assassinated': seat(self.assassinated),
+            'waiting': [self.waiting_for_votes, self.waiting_for_outcomes, self.waiting_for_lady, self.waiting_for_assassin],
+            'muted': self.muted,
+            'votekicks': sorted(self.votekicks),
+            'features': self.features,
+            'merged': [[role.value for role in merge] for merge in self.merged],
+            'timeouts': self.timeouts,
+            'rng': [version, state, gauss_next],
+            'events': self.events,
+            }
+
+
+    @classmethod
+    def restore(cls, snapshot, channel, bot, get_user):
+        # Rebuild a game from the output of snapshot(). `get_user` maps a user ID
+        # back to a user; a KeyError is raised if it returns None for anyone.
+        def user(user_id):
+            result = get_user(user_id)
+            if result is None:
+                raise KeyError('Unknown user %d' % user_id)
+            return result
+        players = [Player(user(user_id), tuple([Role(value) for value in roles]), side, vote, outcome) \
+                   for user_id, roles, side, vote, outcome in snapshot['players']]
+        def player(seat):
+            return None if seat is None else players[seat]
+        game = cls(channel, user(snapshot['owner']), bot)
+        owners = [p for p in players if p.user.id == snapshot['owner']]
+        if owners:
+            game.owner = owners[0]
+        game.running = snapshot['running']
+        game.players = players
+        game.team = [player(seat) for seat in snapshot['team']]
+        game.leader = player(snapshot['leader'])
+        game.current_quest = None if snapshot['current_quest'] is None else tuple(snapshot['current_quest'])
+        game.quest_results = snapshot['quest_results']
+        game.reject_counter = snapshot['reject_counter']
+        game.lady = player(snapshot['lady'])
+        game.investigated = [player(seat) for seat in snapshot['investigated']]
+        game.assassin = player(snapshot['assassin'])
+        game.start_time = None if snapshot['start_time'] is None else from_micros(snapshot['start_time'])
+        game.vote_history = snapshot['vote_history']
+        game.quest_history = snapshot['quest_history']
+        game.lady_history = snapshot['lady_history']
+        game.assassinated = player(snapshot['assassinated'])
+        game.waiting_for_votes, game.waiting_for_outcomes, game.waiting_for_lady, game.waiting_for_assassin = snapshot['waiting']
+        game.muted = snapshot['muted']
+        game.votekicks = set(snapshot['votekicks'])
+        game.features = snapshot['features']
+        game.merged = [[Role(value) for value in merge] for merge in snapshot['merged']]
+        game.timeouts = snapshot.get('timeouts', dict(PHASE_TIMEOUTS))
+        version, state, gauss_next = snapshot['rng']
+        game.rng.setstate((version, tuple(state), gauss_next))
+        game.events = snapshot.get('events', [])
+        if game.running:
+            game.visibility = seat_visibility([p.role for p in players])
+        return game
@@ -0,0 +1,198 @@
+# Avalon role inference
+# Works out how likely each player is to be Evil, Merlin and so on, judging
+# only by what anyone watching the game can see: which roles are in play, the
+# teams that were voted on and how everyone voted, the number of Fail cards
+# played on each quest, and who turned out to be the Assassin.
+# Every way of seating the roles is weighed by how likely it would have made
+# what happened, under a simple model of play: Evil players play Fail cards
+# with probability FAIL_RATE and approve teams more often if they include
+# someone Evil, Merlin approves teams less often if they include someone he
+# sees as Evil, and everyone else approves at a fixed rate. Lady of the Lake
+# results are private, so investigations aren't taken into account.
+# The only things about a seating this model depends on are which seats are
+# Evil, which seat is Merlin, which seats Merlin sees as Evil and which seat is
+# the Assassin, so seatings that differ only in, say, which Evil player is
+# Morgana are lumped together, and each role's chances are shared out within
+# the lumps at the end. The seatings are stored column by column, as bitmasks
+# of seats, and every observation updates all their weights in one pass over
+# the columns.
+
+import math
+import functools
+import itertools
+import collections
+
+from avalon_engine import GOOD, Role, seat_visibility
+
+
+
+FAIL_RATE = 0.8 # Chance that an Evil player on a quest plays a Fail card
+GOOD_APPROVE = 0.6 # Chance that a Good player other than Merlin approves a team
+EVIL_APPROVE = (0.5, 0.85) # Chance that an Evil player approves a team with no Evil players, and with some
+MERLIN_APPROVE = (0.8, 0.2) # Chance that Merlin approves a team with no one he sees as Evil, and with someone
+
+MODEL_ROLES = (Role.MERLIN, Role.MORDRED, Role.PALM, Role.ASSASSIN) # The roles that make a difference to the model
+
+
+
+
+def bits(mask):
+    # The seats in a bitmask
+    return [seat for seat in range(mask.bit_length()) if mask >> seat & 1]
+
+
+@functools.lru_cache(maxsize=64)
+def seatings(counts):
+    # Every distinct way of seating sum(counts) players of len(counts) types,
+    # with counts[t] players of type t, as a tuple for each type of the bitmask
+    # of its seats in each seating. This only depends on the number of players
+    # of each type, so it is cached and shared by every game with the same roles.
+    columns = [[] for count in counts]
+    def place(t, free, masks):
+        if t == len(counts):
+            for column, mask in zip(columns, masks):
+                column.append(mask)
+            return
+        for seats in itertools.combinations(free, counts[t]):
+            mask = sum([1 << seat for seat in seats])
+            place(t + 1, [seat for seat in free if not mask >> seat & 1], masks + [mask])
+    place(0, list(range(sum(counts))), [])
+    return tuple([tuple(column) for column in columns])
+
+
+
+
+class RoleInference:
+
+    def __init__(self, ids, roles):
+        # `ids` are the user IDs of the players in seating order, and `roles`
+        # the (role tuple, side) pairs dealt out, in any order
+        self.seat = {user_id: seat for seat, user_id in enumerate(ids)}
+        # Lump the roles into types that look the same as far as the model is concerned
+        types = collections.OrderedDict() # Maps type keys to the list of role tuples of that type
+        for role, side in sorted(roles, key = lambda pair: [r.value for r in pair[0]]):
+            key = (side, tuple([r for r in MODEL_ROLES if r in role]))
+            types.setdefault(key, []).append(role)
+        self.types = list(types)
+        self.counts = tuple([len(group) for group in types.values()])
+        self.role_counts = [collections.Counter([r for role in group for r in role]) for group in types.values()]
+        self.special = sorted(set([r for role, side in roles for r in role]) - {Role.SERVANT, Role.MINION}, key = lambda r: r.value)
+        self.masks = seatings(self.counts)
+        # Work out the Evil seats, Merlin's seat and the seats he sees as Evil in each seating
+        evil_types = [t for t, (side, relevant) in enumerate(self.types) if side != GOOD]
+        merlin_types = [t for t, (side, relevant) in enumerate(self.types) if Role.MERLIN in relevant]
+        self.evil = [sum(masks) for masks in zip(*[self.masks[t] for t in evil_types])]
+        if merlin_types:
+            # Which types Merlin sees as Evil depends only on the roles, so seat them in any order to find out
+            example = [role for group in types.values() for role in group]
+            example_types = [t for t, group in enumerate(types.values()) for role in group]
+            merlin = [Role.MERLIN in role for role in example].index(True)
+            seen = set([example_types[seat] for seat in bits(seat_visibility(example).appears_evil[merlin])])
+            self.merlin = [mask.bit_length() - 1 for mask in self.masks[merlin_types[0]]]
+            self.sees = [sum(masks) for masks in zip(*[self.masks[t] for t in seen])] if seen else [0] * len(self.merlin)
+        else:
+            self.merlin = [-1] * len(self.evil)
+            self.sees = self.evil
+        # Distinct sets of Evil seats, so that things depending only on those are worked out once for each
+        self.evil_sets = sorted(set(self.evil))
+        index = {evil: i for i, evil in enumerate(self.evil_sets)}
+        self.evil_index = [index[evil] for evil in self.evil]
+        self.weights = [1.0 / len(self.evil)] * len(self.evil)
+        self.votes_seen = 0 # Number of entries of the vote history taken into account
+        self.quests_seen = 0 # Likewise for the quest history
+        self.assassin_seen = False
+
+
+    def team(self, user_ids):
+        return sum([1 << self.seat[user_id] for user_id in user_ids])
+
+
+    def reweigh(self, factors):
+        # Multiply the weight of every seating by the chance it gives the observation, and renormalize
+        weights = [w * f for w, f in zip(self.weights, factors)]
+        total = sum(weights)
+        if total > 0: # (Otherwise the observation was impossible, so there's nothing to learn from it)
+            self.weights = [w / total for w in weights]
+
+
+    def observe_vote(self, vote):
+        # Take a team vote into account, given as an entry of Game.vote_history
+        team = self.team(vote['team'])
+        votes = [(self.seat[user_id], approved) for user_id, approved in vote['votes']]
+        def chance(p, approved):
+            return p if approved else 1 - p
+        # Everyone's votes, if they aren't Merlin
+        base = []
+        for evil in self.evil_sets:
+            p_evil = EVIL_APPROVE[bool(evil & team)]
+            factor = 1.0
+            for seat, approved in votes:
+                factor *= chance(p_evil if evil >> seat & 1 else GOOD_APPROVE, approved)
+            base.append(factor)
+        # Corrections for whoever is Merlin
+        merlin = {-1: (1.0, 1.0)}
+        for seat, approved in votes:
+            merlin[seat] = tuple([chance(p, approved) / chance(GOOD_APPROVE, approved) for p in MERLIN_APPROVE])
+        self.reweigh([base[e] * merlin[m][bool(sees & team)] for e, m, sees in zip(self.evil_index, self.merlin, self.sees)])
+
+
+    def observe_quest(self, quest):
+        # Take a quest into account, given as an entry of Game.quest_history
+        team = self.team(quest['team'])
+        fails = quest['fails']
+        base = []
+        for evil in self.evil_sets:
+            n = bin(evil & team).count('1')
+            base.append(math.comb(n, fails) * FAIL_RATE ** fails * (1 - FAIL_RATE) ** (n - fails) if fails <= n else 0.0)
+        self.reweigh([base[e] for e in self.evil_index])
+
+
+    def observe_assassin(self, user_id):
+        # Take into account that the player `user_id` is the Assassin
+        seat = self.seat[user_id]
+        factors = [0.0] * len(self.weights)
+        for t, masks in enumerate(self.masks):
+            share = self.role_counts[t][Role.ASSASSIN] / self.counts[t]
+            if share:
+                for i, mask in enumerate(masks):
+                    if mask >> seat & 1:
+                        factors[i] = share
+        self.reweigh(factors)
+
+
+    def catch_up(self, votes, quests, assassin=None):
+        # Take into account any entries of a game's vote and quest histories that
+        # haven't been yet, and the Assassin's user ID once they are known
+        for vote in votes[self.votes_seen:]:
+            self.observe_vote(vote)
+        for quest in quests[self.quests_seen:]:
+            self.observe_quest(quest)
+        self.votes_seen = len(votes)
+        self.quests_seen = len(quests)
+        if (assassin is not None) and not self.assassin_seen:
+            self.observe_assassin(assassin)
+            self.assassin_seen = True
+
+
+    def chances(self):
+        # Returns the chance of each seat being Evil, as a list, and a dict
+        # mapping each special role in play to the chance of each seat having it
+        n = len(self.seat)
+        evil = [0.0] * n
+        roles = {role: [0.0] * n for role in self.special}
+        for t, masks in enumerate(self.masks):
+            # Add up the weights of the seatings with the same seats for this type first
+            totals = collections.defaultdict(float)
+            for mask, weight in zip(masks, self.weights):
+                totals[mask] += weight
+            seats = [0.0] * n
+            for mask, weight in totals.items():
+                for seat in bits(mask):
+                    seats[seat] += weight
+            if self.types[t][0] != GOOD:
+                evil = [a + b for a, b in zip(evil, seats)]
+            for role in roles:
+                share = self.role_counts[t][role] / self.counts[t]
+                if share:
+                    roles[role] = [a + b * share for a, b in zip(roles[role], seats)]
+        return evil, roles
@@ -0,0 +1,171 @@
+# Avalon bot instrumentation
+# Keeps per-command metrics in memory: histograms of how long each bot command
+# takes and of the longest stretch it holds up the event loop for, a count of
+# the commands that failed, and a count of the Discord API requests each one
+# caused. Histograms have fixed buckets, so memory use doesn't grow with
+# traffic. Everything can be rendered as tables for av perf or in the
+# Prometheus text format.
+
+import time
+import types
+import bisect
+import contextvars
+import collections
+
+
+
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # Bucket upper bounds, in seconds
+
+# Name of the command being handled. Tasks and timers started by a command
+# inherit it, so the API requests they make are counted against the command.
+current_command = contextvars.ContextVar('current_command', default=None)
+
+
+
+
+class Histogram:
+
+    # Counts of observations in fixed buckets, plus one for anything bigger
+    # than the last bound
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th quantile (never more than the maximum)
+        rank = q * self.count
+        total = 0
+        for bound, n in zip(self.bounds + (self.max,), self.counts):
+            total += n
+            if total >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class CommandStats:
+
+    def __init__(self):
+        self.wall = Histogram() # Seconds from receiving the command to finishing with it
+        self.stall = Histogram() # Longest time the command kept the event loop busy without a break
+        self.errors = 0 # Number of times the command raised an exception
+        self.api_calls = collections.Counter() # Maps each API route to the number of requests made to it
+
+
+
+
+@types.coroutine
+def stepped(coro, stall):
+    # Run `coro` the way a task would, one step (the code between two awaits
+    # that actually suspend) at a time, keeping the longest step in stall[0]
+    step, args = coro.send, (None,)
+    while True:
+        start = time.perf_counter()
+        try:
+            signal = step(*args)
+        except StopIteration as e:
+            return e.value
+        finally:
+            stall[0] = max(stall[0], time.perf_counter() - start)
+        try:
+            args = ((yield signal),)
+            step = coro.send
+        except GeneratorExit:
+            coro.close()
+            raise
+        except BaseException as e:
+            step, args = coro.throw, (e,)
+
+
+
+
+class Metrics:
+
+    def __init__(self):
+        self.commands = collections.defaultdict(CommandStats) # Maps command names (None for anything else) to their CommandStats
+        self.started = time.time()
+
+    async def run(self, name, coro):
+        # Await `coro` as the handler for command `name`, recording its metrics
+        stats = self.commands[name]
+        token = current_command.set(name)
+        stall = [0.0]
+        start = time.perf_counter()
+        try:
+            return (await stepped(coro, stall))
+        except Exception:
+            stats.errors += 1
+            raise
+        finally:
+            stats.wall.observe(time.perf_counter() - start)
+            stats.stall.observe(stall[0])
+            current_command.reset(token)
+
+    def api_call(self, route):
+        # Count a request to the Discord API route `route`, e.g. 'POST /channels/{channel_id}/messages'
+        self.commands[current_command.get()].api_calls[route] += 1
+
+
+    def report(self, n=10):
+        # Tables of the `n` commands with the slowest p99 times and of the `n`
+        # that make the most API requests per use, as a list of messages
+        names = [name for name, stats in self.commands.items() if (name is not None) and stats.wall.count]
+        def table(title, names):
+            rows = [('Command', 'Uses', 'p50 ms', 'p99 ms', 'Stall ms', 'API/use', 'Errors')]
+            for name in names[:n]:
+                stats = self.commands[name]
+                rows.append((name, str(stats.wall.count),
+                             '%.1f' % (stats.wall.quantile(0.5) * 1000), '%.1f' % (stats.wall.quantile(0.99) * 1000),
+                             '%.1f' % (stats.stall.max * 1000), '%.1f' % (sum(stats.api_calls.values()) / stats.wall.count),
+                             str(stats.errors)))
+            lengths = [max([len(row[i]) for row in rows]) for i in range(len(rows[0]))]
+            divider = '+%s+\n' % '+'.join(['-'*l for l in lengths])
+            rows = ['|%s|\n' % '|'.join([entry.rjust(l) for entry, l in zip(row, lengths)]) for row in rows]
+            return '**%s:**\n```\n%s```' % (title, divider + divider.join(rows) + divider)
+        if not names:
+            return ['No commands have been run since %s.' % time.strftime('%c', time.localtime(self.started))]
+        names.sort(key = lambda name: self.commands[name].wall.quantile(0.99), reverse=True)
+        slowest = table('Slowest commands (p99)', names)
+        names.sort(key = lambda name: sum(self.commands[name].api_calls.values()) / self.commands[name].wall.count, reverse=True)
+        return [slowest, table('Most API requests per use', names)]
+
+
+    def prometheus(self):
+        # All the metrics in the Prometheus text exposition format
+        def label(value):
+            return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        lines = []
+        for metric, attr, description in (('avalon_command_seconds', 'wall', 'Time taken to handle each bot command'),
+                                          ('avalon_command_stall_seconds', 'stall', 'Longest time each bot command kept the event loop busy')):
+            lines.append('# HELP %s %s' % (metric, description))
+            lines.append('# TYPE %s histogram' % metric)
+            for name, stats in sorted(self.commands.items(), key = lambda item: item[0] or ''):
+                if name is None:
+                    continue
+                histogram = getattr(stats, attr)
+                total = 0
+                for bound, n in zip(histogram.bounds + ('+Inf',), histogram.counts):
+                    total += n
+                    lines.append('%s_bucket{command="%s",le="%s"} %d' % (metric, label(name), bound, total))
+                lines.append('%s_sum{command="%s"} %r' % (metric, label(name), histogram.sum))
+                lines.append('%s_count{command="%s"} %d' % (metric, label(name), histogram.count))
+        lines.append('# HELP avalon_command_errors_total Bot commands that raised an exception')
+        lines.append('# TYPE avalon_command_errors_total counter')
+        for name, stats in sorted(self.commands.items(), key = lambda item: item[0] or ''):
+            if name is not None:
+                lines.append('avalon_command_errors_total{command="%s"} %d' % (label(name), stats.errors))
+        lines.append('# HELP avalon_api_requests_total Discord API requests, by the command that caused them')
+        lines.append('# TYPE avalon_api_requests_total counter')
+        for name, stats in sorted(self.commands.items(), key = lambda item: item[0] or ''):
+            for route, n in sorted(stats.api_calls.items()):
+                lines.append('avalon_api_requests_total{command="%s",route="%s"} %d' % (label(name or 'other'), label(route), n))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,130 @@
+# Avalon teammate and opponent stats
+# For every pair of players who have been in a game together, counts how those
+# games went: as teammates, the wins and losses they had together on each
+# side, and as opponents, how each of them did against the other. The counts
+# form a sparse player by player matrix, kept as a dict of dicts holding only
+# pairs who have actually met, with a row for each player so that everything
+# about one player is found without looking at anyone else. Along with each
+# player's own record, this answers questions like "how often do A and B win
+# together as Evil" and which partners someone does better with than usual.
+# Counts don't depend on the order of games, so games are just added on as
+# they are recorded, grouped by the game numbers in the stats store.
+
+import collections
+
+from avalon_engine import EVIL_ROLES
+
+
+
+# Indices of the counts kept for each player and pair. Counts for a pair of
+# opponents are from the point of view of the player whose row they're in.
+GOOD_WINS, GOOD_LOSSES, EVIL_WINS, EVIL_LOSSES = range(4)
+
+EVIL_ROLE_IDS = frozenset([role.value for role in EVIL_ROLES])
+
+
+
+
+class PairStats:
+
+    def __init__(self):
+        self.records = {} # Maps user_id to the counts for all their games
+        self.together = {} # Maps user_id to a dict mapping each teammate they've had to the counts for their games together
+        self.against = {} # Maps user_id to a dict mapping each opponent they've had to the counts for their games against them
+        self.rows = 0 # Number of stats records accounted for
+        self.codes = [] # For each group code in the stats columns, (user_id, count index)
+
+
+    def update(self, store):
+        # Count the games added to `store` since the last call. Returns True if there were any.
+        store.load()
+        columns = store.columns
+        if self.rows > len(columns):
+            self.__init__()
+        if self.rows == len(columns):
+            return False
+        for user_id, role_id, win, merge_count in columns.groups[len(self.codes):]:
+            evil = role_id in EVIL_ROLE_IDS
+            self.codes.append((user_id, (EVIL_WINS if evil else GOOD_WINS) + (not win)))
+        games = collections.defaultdict(dict) # Maps game numbers to dicts mapping user_id to count index
+        codes = self.codes
+        for game, code in zip(columns.game[self.rows:], columns.group[self.rows:]):
+            user_id, index = codes[code]
+            games[game][user_id] = index # Players with merged roles have several records
+        for players in games.values():
+            self.add_game(players)
+        self.rows = len(columns)
+        return True
+
+
+    def add_game(self, players):
+        # Count one game, given a dict mapping each player to the count index of their result
+        records, together, against = self.records, self.together, self.against
+        for user_id, index in players.items():
+            if user_id not in records:
+                records[user_id] = [0, 0, 0, 0]
+                together[user_id] = collections.defaultdict(new_counts)
+                against[user_id] = collections.defaultdict(new_counts)
+            records[user_id][index] += 1
+        good = [user_id for user_id, index in players.items() if index < EVIL_WINS]
+        evil = [user_id for user_id, index in players.items() if index >= EVIL_WINS]
+        for team, other_team in ((good, evil), (evil, good)):
+            for user_id in team:
+                index = players[user_id]
+                teammates = together[user_id]
+                for other in team:
+                    if other != user_id:
+                        teammates[other][index] += 1
+                opponents = against[user_id]
+                for other in other_team:
+                    opponents[other][index] += 1
+
+    def pair(self, user_id, other):
+        # The counts for the games `user_id` played with and against `other`
+        return (self.together.get(user_id, {}).get(other, [0, 0, 0, 0]),
+                self.against.get(user_id, {}).get(other, [0, 0, 0, 0]))
+
+
+    def partners(self, user_id, side=None, min_games=1):
+        # List of (synergy, wins, games, teammate) for everyone `user_id` has had
+        # at least `min_games` games with on the same side ('good', 'evil' or None
+        # for either), best first. Synergy is how much higher their win ratio
+        # together is than the average of the two players' own win ratios.
+        own_wins, own_games = tally(self.records.get(user_id, [0, 0, 0, 0]), side)
+        partners = []
+        for other, counts in self.together.get(user_id, {}).items():
+            wins, games = tally(counts, side)
+            if games < min_games:
+                continue
+            other_wins, other_games = tally(self.records[other], side)
+            expected = (own_wins / own_games + other_wins / other_games) / 2
+            partners.append((wins / games - expected, wins, games, other))
+        partners.sort(reverse=True)
+        return partners
+
+
+    def opponents(self, user_id, side=None, min_games=1):
+        # List of (win ratio, wins, games, opponent) for everyone `user_id` has
+        # played at least `min_games` games against while on `side`, worst first
+        opponents = []
+        for other, counts in self.against.get(user_id, {}).items():
+            wins, games = tally(counts, side)
+            if games >= min_games:
+                opponents.append((wins / games, wins, games, other))
+        opponents.sort()
+        return opponents
+
+
+
+
+def new_counts():
+    return [0, 0, 0, 0]
+
+
+def tally(counts, side=None):
+    # (wins, games) from a list of counts, for 'good', 'evil' or both sides
+    if side == 'good':
+        return counts[GOOD_WINS], counts[GOOD_WINS] + counts[GOOD_LOSSES]
+    if side == 'evil':
+        return counts[EVIL_WINS], counts[EVIL_WINS] + counts[EVIL_LOSSES]
+    return counts[GOOD_WINS] + counts[EVIL_WINS], sum(counts)
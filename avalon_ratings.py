@@ -0,0 +1,211 @@
+# Avalon skill ratings
+# Elo-style ratings worked out from the stats log. Every player has a rating
+# for each side and for each role they have played, all starting at INITIAL.
+# A game is scored as a match between the Good team and the Evil team: each
+# team's strength is the average of its members' ratings for their side, plus
+# `bias` for Evil, which is learned along with the ratings to make up for the
+# rules favoring one side. After the game everyone's side and role ratings move
+# by K times the difference between the result and the expected result, so
+# beating a stronger team is worth more than beating a weaker one.
+# A game is the run of stats records with the same game number. Ratings are
+# brought up to date one game at a time as games are recorded, and saved in the
+# stats database along with the rating each player ended each month on, so
+# that neither leaderboards nor rating histories need the log to be scanned
+# again.
+
+import json
+import datetime
+import collections
+
+from avalon_engine import EVIL_ROLES
+from avalon_stats import to_micros, from_micros
+
+
+
+INITIAL = 1500.0 # Rating of a player who hasn't played yet
+K = 24.0 # Largest possible change in a rating from one game
+K_BIAS = 1.0 # Largest possible change in the Evil advantage from one game
+SCALE = 400.0 # A difference in ratings of SCALE means 10 to 1 odds
+
+PARAMS = json.dumps([INITIAL, K, K_BIAS, SCALE]) # Saved ratings are recomputed if these change
+
+EVIL_ROLE_IDS = frozenset([role.value for role in EVIL_ROLES])
+
+
+
+
+class Ratings:
+
+    # Ratings are keyed by (user_id, kind), where kind is 'good', 'evil' or a role ID
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.rating = {} # Maps (user_id, kind) to rating
+        self.games = collections.Counter() # Maps (user_id, kind) to number of games rated
+        self.months = {} # Maps user_id to a dict mapping (year, month) to [good rating, evil rating, games] at the end of the month
+        self.bias = 0.0 # Rating points added to the Evil team's strength
+        self.rows = 0 # Number of stats records accounted for
+        self.last = None # Timestamp of the last game accounted for, in microseconds
+        self.codes = [] # For each group code in the stats columns, (user_id, role_id, side, good_won)
+        self.changed = set() # Users whose ratings changed since the last save
+        self.first_month = None # Earliest (year, month) with changes since the last save
+        self.loaded = False
+
+
+    def load(self, store):
+        # Read the saved ratings, if they were worked out with the current parameters
+        self.clear()
+        self.loaded = True
+        saved = store.load_ratings()
+        if (saved is None) or (saved['params'] != PARAMS):
+            return
+        for user_id, kind, rating, games in saved['ratings']:
+            key = (user_id, int(kind) if kind.isdigit() else kind)
+            self.rating[key] = rating
+            self.games[key] = games
+        for user_id, month, good, evil, games in saved['months']:
+            self.months.setdefault(user_id, {})[divmod(month, 100)] = [good, evil, games]
+        self.bias = saved['bias']
+        self.rows = saved['rows']
+        self.last = saved['last']
+
+
+    def update(self, store):
+        # Rate any games added to `store` since the last call and save the
+        # results. If old games were backfilled in between, everything is rated
+        # again from the start, since ratings depend on the order of games.
+        if not self.loaded:
+            self.load(store)
+        store.load()
+        columns = store.columns
+        if self.rows == len(columns):
+            return False
+        timestamps = columns.timestamp[self.rows:]
+        numbers = columns.game[self.rows:]
+        groups = columns.group[self.rows:]
+        recompute = (self.rows > len(columns)) or ((self.last is not None) and (min(timestamps) < self.last))
+        if not recompute and any(a > b for a, b in zip(timestamps, timestamps[1:])):
+            order = sorted(range(len(timestamps)), key=timestamps.__getitem__)
+            timestamps = [timestamps[i] for i in order]
+            numbers = [numbers[i] for i in order]
+            groups = [groups[i] for i in order]
+        if recompute:
+            self.clear()
+            self.loaded = True
+            columns.sort()
+            timestamps = columns.sorted_timestamp
+            numbers = columns.sorted_game
+            groups = columns.sorted_group
+        self.describe_codes(columns.groups)
+        self.rate(timestamps, numbers, groups)
+        self.rows = len(columns)
+        store.save_ratings([(user_id, str(kind), rating, self.games[(user_id, kind)]) \
+                            for (user_id, kind), rating in self.rating.items() if user_id in self.changed],
+                           [(user_id, year * 100 + month, good, evil, games) \
+                            for user_id in self.changed \
+                            for (year, month), (good, evil, games) in self.months[user_id].items() if (year, month) >= self.first_month],
+                           {'params': PARAMS, 'bias': self.bias, 'rows': self.rows, 'last': self.last},
+                           replace=recompute)
+        self.changed.clear()
+        self.first_month = None
+        return True
+
+
+    def describe_codes(self, groups):
+        # Extend self.codes to cover every (user_id, role_id, win, merge_count) group
+        for user_id, role_id, win, merge_count in groups[len(self.codes):]:
+            side = 'evil' if role_id in EVIL_ROLE_IDS else 'good'
+            self.codes.append((user_id, role_id, side, win == (side == 'good')))
+
+
+    def rate(self, timestamps, numbers, groups):
+        # Rate the games in parallel sequences of timestamps, game numbers and
+        # group codes, in time order. This loop is all the time it takes to rate
+        # the whole log, so everything in it is bound to a local name.
+        codes = self.codes
+        rating = self.rating
+        get = rating.get
+        games = self.games
+        months = self.months
+        changed = self.changed
+        bias = self.bias
+        month_start = month_end = 0 # Bounds of the month of the current game
+        n = len(timestamps)
+        start = 0
+        while start < n:
+            timestamp = timestamps[start]
+            number = numbers[start]
+            end = start + 1
+            while (end < n) and (numbers[end] == number):
+                end += 1
+            records = [codes[code] for code in groups[start:end]]
+            start = end
+            sides = {} # Players with merged roles have several records
+            for user_id, role_id, side, good_won in records:
+                sides[user_id] = side
+            good = [get((user_id, 'good'), INITIAL) for user_id, side in sides.items() if side == 'good']
+            evil = [get((user_id, 'evil'), INITIAL) for user_id, side in sides.items() if side == 'evil']
+            if not (good and evil):
+                continue # Not a real game
+            expected = 1 / (1 + 10 ** ((sum(evil) / len(evil) + bias - sum(good) / len(good)) / SCALE))
+            surprise = records[0][3] - expected # How much better Good did than expected
+            bias -= K_BIAS * surprise
+            change = {'good': K * surprise, 'evil': -K * surprise}
+            for user_id, side in sides.items():
+                key = (user_id, side)
+                rating[key] = get(key, INITIAL) + change[side]
+                games[key] += 1
+            for user_id, role_id, side, good_won in records:
+                key = (user_id, role_id)
+                rating[key] = get(key, INITIAL) + change[side]
+                games[key] += 1
+            changed.update(sides)
+            # Remember where everyone ended the month
+            if not (month_start <= timestamp < month_end):
+                date = from_micros(timestamp)
+                month = (date.year, date.month)
+                month_start = to_micros(datetime.datetime(date.year, date.month, 1))
+                month_end = to_micros(datetime.datetime(date.year + (date.month == 12), date.month % 12 + 1, 1))
+                if self.first_month is None:
+                    self.first_month = month
+            for user_id in sides:
+                entry = months.setdefault(user_id, {}).get(month)
+                if entry is None:
+                    entry = months[user_id][month] = [None, None, 0]
+                entry[0], entry[1] = get((user_id, 'good')), get((user_id, 'evil'))
+                entry[2] += 1
+        self.bias = bias
+        if n:
+            self.last = timestamps[n - 1]
+
+
+    def overall(self, user_id):
+        # A player's side ratings averaged over the games they played on each side
+        good, evil = self.games[(user_id, 'good')], self.games[(user_id, 'evil')]
+        if not (good or evil):
+            return INITIAL
+        return (good * self.rating.get((user_id, 'good'), INITIAL) + evil * self.rating.get((user_id, 'evil'), INITIAL)) / (good + evil)
+
+
+    def leaderboard(self, kind=None, min_games=1):
+        # List of (rating, games, user_id) for everyone with at least `min_games`
+        # games of the given kind ('good', 'evil', a role ID, or None for both sides), best first
+        if kind is None:
+            games = collections.Counter()
+            for (user_id, key_kind), n in self.games.items():
+                if key_kind in ('good', 'evil'):
+                    games[user_id] += n
+            board = [(self.overall(user_id), n, user_id) for user_id, n in games.items() if n >= min_games]
+        else:
+            board = [(self.rating[key], n, key[0]) for key, n in self.games.items() if (key[1] == kind) and (n >= min_games)]
+        board.sort(reverse=True)
+        return board
+
+
+    def history(self, user_id):
+        # List of ((year, month), good rating, evil rating, games) for each month
+        # the player played in, oldest first; ratings are None before the player's
+        # first game on that side
+        return [(month, good, evil, games) for month, (good, evil, games) in sorted(self.months.get(user_id, {}).items())]
@@ -0,0 +1,126 @@
+# Avalon game replay tool
+# Re-runs the event logs of games through the engine in avalon_engine.py,
+# without any Discord connection, and checks that they come out the same as
+# they did the first time. Logs can come from the games recorded in the stats
+# database, from game snapshots (see Avalon.save_snapshot) or from JSON files
+# holding a game record or a bare list of events. Use --show to print what the
+# bot said in response to every event, for reproducing bugs.
+#
+# Usage: python avalon_replay.py [--db PATH] [--sim GAMES] [--show] [files...]
+
+import sys
+import json
+import time
+import random
+import argparse
+
+from avalon_engine import Announce, Reply, Whisper, GameOver, replay
+from avalon_stats import STATS_DB, StatsStore, from_micros
+from avalon_sim import SimUser, BOT, make_users, new_game, play_move
+
+
+
+# Fields of a game record that a replay must reproduce
+RECORD_FIELDS = ('players', 'features', 'merged', 'winner', 'quest_results', 'quests', 'votes', 'lady', 'assassinated', 'started')
+
+
+
+
+def user_lookup():
+    # Returns a get_user function that makes up a user for each ID
+    users = {}
+    def get_user(user_id):
+        if user_id not in users:
+            users[user_id] = SimUser(user_id, str(user_id), '<@%d>' % user_id)
+        return users[user_id]
+    return get_user
+
+
+def load_logs(args):
+    # Yield (description, log, expected) for every game to replay, where
+    # `expected` is a game record or a snapshot to compare the result against
+    if args.sim:
+        rng = random.Random(args.seed)
+        users = make_users(10)
+        for i in range(args.sim):
+            game, effects = new_game(users, ['lady', 'morgana'], rng.getrandbits(64))
+            while game.running:
+                play_move(game, rng)
+            record, rows = game.record(game.now())
+            yield 'simulated game %d' % i, game.events, json.loads(json.dumps(record))
+    for filename in args.files:
+        with open(filename) as o:
+            data = json.load(o)
+        if isinstance(data, list):
+            yield filename, data, None
+        else:
+            yield filename, data['events'], data
+    if args.db:
+        store = StatsStore(args.db, args.db + '.legacy')
+        for i, record in enumerate(store.games()):
+            if 'events' in record:
+                yield 'game %d in %s' % (i + 1, args.db), record['events'], record
+        store.close()
+
+
+def check(game, expected):
+    # Return a list of the ways the replayed game differs from what was expected
+    if expected is None:
+        return []
+    if 'rng' in expected:
+        # A snapshot of a game in progress
+        actual = json.loads(json.dumps(game.snapshot()))
+        return [key for key in expected if actual.get(key) != expected[key]]
+    record, rows = game.record(from_micros(expected['finished']))
+    record = json.loads(json.dumps(record))
+    return [key for key in RECORD_FIELDS if record[key] != expected[key]]
+
+
+def show(log, effects):
+    for event, results in zip(log[1:], effects):
+        print('%s %s' % (from_micros(event[2]).strftime('%H:%M:%S'), ' '.join(map(str, [event[0], event[1]] + event[3:]))))
+        for effect in results:
+            if isinstance(effect, Whisper):
+                print('    [to %s] %s' % (effect.user.id, effect.text))
+            elif isinstance(effect, (Announce, Reply, GameOver)):
+                print('    ' + effect.text.replace('\n', '\n    '))
+            else:
+                print('    %r' % (effect,))
+
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay Avalon game logs without Discord.')
+    parser.add_argument('--db', nargs='?', const=STATS_DB, default=None, help='replay the games recorded in this stats database (default %s)' % STATS_DB)
+    parser.add_argument('--sim', type=int, default=0, help='simulate this many games first and replay them')
+    parser.add_argument('--seed', type=int, default=None, help='random seed for --sim')
+    parser.add_argument('--show', action='store_true', help='print the effects of every event')
+    parser.add_argument('files', nargs='*', help='JSON files holding a snapshot, game record or list of events')
+    args = parser.parse_args()
+    games = events = mismatched = 0
+    elapsed = 0
+    for description, log, expected in load_logs(args):
+        start = time.perf_counter()
+        game, effects = replay(log, user_lookup(), BOT)
+        elapsed += time.perf_counter() - start
+        games += 1
+        events += len(log)
+        differences = check(game, expected)
+        if differences:
+            mismatched += 1
+            print('%s: replay differs in %s' % (description, ', '.join(differences)))
+        if args.show:
+            print('=== %s ===' % description)
+            show(log, effects)
+    if games:
+        print('Replayed %d games (%d events) in %.2fs: %.0f games/minute, %d mismatched' % \
+              (games, events, elapsed, 60 * games / elapsed, mismatched))
+    else:
+        print('No game logs found.')
+    return 1 if mismatched else 0
+
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,142 @@
+# Headless Avalon simulator
+# Plays games through the engine in avalon_engine.py with simple random
+# players, without any Discord connection. Useful for benchmarking the rules
+# and for fuzzing them with random (often invalid) commands.
+#
+# Usage: python avalon_sim.py [-n GAMES] [-p PLAYERS] [--seed SEED] [--fuzz] [features...]
+
+import time
+import random
+import argparse
+import collections
+
+from avalon_engine import Game, FEATURE_NAMES, QUEST_LISTS, N_EVIL, GOOD, EVIL, APPROVE, REJECT, SUCCESS, FAIL, GameOver
+
+
+
+SimUser = collections.namedtuple('SimUser', 'id name mention')
+
+BOT = SimUser(0, 'avalon', '<@0>')
+
+MAX_STEPS = 10000 # Give up on a game that has not finished after this many commands
+
+
+
+
+def make_users(n):
+    return [SimUser(i, 'player%d' % i, '<@%d>' % i) for i in range(1, n + 1)]
+
+
+def new_game(users, features, seed):
+    # Create a game with the given players and features and start it
+    game = Game(None, users[0], BOT)
+    for user in users[1:]:
+        game.command('join', user)
+    for feature in features:
+        game.command('enable', users[0], feature, True)
+    effects = game.command('start', users[0], seed)
+    return game, effects
+
+
+
+
+def play_move(game, rng, fail_rate=0.5):
+    # Make one sensible move for whoever the game is waiting for
+    if game.waiting_for_assassin:
+        target = rng.choice([p for p in game.players if p is not game.assassin])
+        return game.command('assassinate', game.assassin.user, target.user)
+    if game.waiting_for_lady:
+        target = rng.choice([p for p in game.players if p not in game.investigated])
+        return game.command('lady_of_the_lake', game.lady.user, target.user)
+    if game.waiting_for_outcomes:
+        player = [p for p in game.team if p.outcome is None][0]
+        fail = (player.side == EVIL) and (rng.random() < fail_rate)
+        return game.command('outcome', player.user, FAIL if fail else SUCCESS)
+    if game.waiting_for_votes:
+        player = [p for p in game.players if p.vote is None][0]
+        return game.command('vote', player.user, rng.choice([APPROVE, APPROVE, REJECT]))
+    return game.command('pickrandom', game.leader.user)
+
+
+def fuzz_move(game, users, rng):
+    # Send a random command from a random user, valid or not
+    user = rng.choice(users)
+    target = rng.choice(users)
+    return rng.choice([
+        lambda: game.command('pick', user, [target]),
+        lambda: game.command('pickrandom', user),
+        lambda: game.command('vote', user, rng.choice([APPROVE, REJECT]), rng.random() < 0.9),
+        lambda: game.command('outcome', user, rng.choice([SUCCESS, FAIL]), rng.random() < 0.9),
+        lambda: game.command('lady_of_the_lake', user, target),
+        lambda: game.command('assassinate', user, target),
+        lambda: game.command('info', user),
+        lambda: game.poke(),
+        lambda: game.command('enable', user, rng.choice(list(FEATURE_NAMES)), True),
+        lambda: game.command('join', user),
+        lambda: game.command('leave', user),
+        lambda: game.command('timeout', user, rng.choice(['vote', 'all', 'nap']), rng.choice([None, 60])),
+        lambda: [effect for name, player, args in game.default_moves(rng) for effect in game.command(name, player, *args)],
+        ])()
+
+
+def check_invariants(game):
+    # Sanity checks that must hold after every command
+    n = len(game.players)
+    assert n in QUEST_LISTS
+    assert len(game.team) <= game.current_quest[0]
+    assert len(set(id(p) for p in game.team)) == len(game.team)
+    assert 1 <= game.reject_counter <= 5
+    assert len(game.quest_results) <= 5
+    assert game.quest_results.count(True) <= 3 and game.quest_results.count(False) <= 3
+    assert sum([game.waiting_for_votes, game.waiting_for_outcomes, game.waiting_for_lady, game.waiting_for_assassin]) <= 1
+    assert len([p for p in game.players if p.side == EVIL]) == N_EVIL[n]
+    if game.running:
+        assert game.leader in game.players
+
+
+
+
+def simulate(n_games, n_players, features, seed=None, fuzz=False):
+    # Play `n_games` games; returns a Counter of results
+    rng = random.Random(seed)
+    users = make_users(n_players)
+    results = collections.Counter()
+    for i in range(n_games):
+        game, effects = new_game(users, features, rng.getrandbits(64))
+        results['effects'] += len(effects)
+        for step in range(MAX_STEPS):
+            if not game.running:
+                break
+            effects = fuzz_move(game, users, rng) if fuzz else play_move(game, rng)
+            results['commands'] += 1
+            results['effects'] += len(effects)
+            if fuzz:
+                check_invariants(game)
+            for effect in effects:
+                if isinstance(effect, GameOver):
+                    results['good' if effect.winner == GOOD else 'evil'] += 1
+        else:
+            results['unfinished'] += 1
+        results['games'] += 1
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Play simulated Avalon games without Discord.')
+    parser.add_argument('-n', '--games', type=int, default=10000, help='number of games to play')
+    parser.add_argument('-p', '--players', type=int, default=10, choices=sorted(QUEST_LISTS), help='players per game')
+    parser.add_argument('--seed', type=int, default=None, help='random seed, for reproducible runs')
+    parser.add_argument('--fuzz', action='store_true', help='send random commands and check invariants')
+    parser.add_argument('features', nargs='*', help='features to enable (%s)' % ', '.join(FEATURE_NAMES))
+    args = parser.parse_args()
+    start = time.perf_counter()
+    results = simulate(args.games, args.players, args.features, args.seed, args.fuzz)
+    elapsed = time.perf_counter() - start
+    print('%d games (%d commands, %d effects) in %.2fs' % (results['games'], results['commands'], results['effects'], elapsed))
+    print('%.0f games/s, %.0f games/hour' % (results['games'] / elapsed, 3600 * results['games'] / elapsed))
+    print('Good won %d, Evil won %d, unfinished %d' % (results['good'], results['evil'], results['unfinished']))
+
+
+
+if __name__ == '__main__':
+    main()
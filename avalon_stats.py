@@ -0,0 +1,417 @@
+# Avalon bot stats storage
+
+import os
+import json
+import array
+import bisect
+import pickle
+import sqlite3
+import datetime
+import collections
+
+
+
+STATS_DB = 'avalon_stats.db' # SQLite file holding the stats log
+LEGACY_STATS_FILE = 'avalon_stats' # Old pickle file, migrated on first use
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+
+
+def to_micros(timestamp):
+    # Convert a naive UTC datetime to integer microseconds since the epoch
+    delta = timestamp - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+def from_micros(micros):
+    # Inverse of to_micros()
+    return EPOCH + datetime.timedelta(microseconds=micros)
+
+
+
+
+class StatsColumns:
+
+    # The stats log stored column by column in compact arrays, so that queries can
+    # be answered by C-level passes over whole columns instead of a Python loop
+    # over tuples. Timestamps are kept as microseconds (see to_micros()), along
+    # with the number of the game each record came from.
+    # Every record also gets a small integer code for its (user_id, role_id, win,
+    # merge_count) combination, so that grouping records is a matter of counting
+    # codes, like numpy's bincount.
+    # Date-restricted queries use a copy of the timestamp and group code columns
+    # sorted by time, so the records in a date range are found by two binary
+    # searches. Records arrive in chronological order except when old games are
+    # backfilled, in which case the sorted copy is rebuilt on the next query.
+    # Group counts are also rolled up by calendar month, so queries covering
+    # whole months don't look at the records at all.
+
+    CHUNK = 20000 # Maximum number of records to count in one go
+
+    def __init__(self):
+        self.timestamp = array.array('q')
+        self.game = array.array('q') # Game number of each record
+        self.group = array.array('l') # Group code of each record
+        self.groups = [] # The (user_id, role_id, win, merge_count) tuple for each group code
+        self.group_codes = {} # Inverse of self.groups
+        self.totals = collections.Counter() # Number of records with each group code
+        self.months = {} # Maps (year, month) to a Counter of the group codes of the records in it
+        self.sorted_timestamp = array.array('q') # self.timestamp in ascending order
+        self.sorted_group = array.array('l') # self.group in the same order as self.sorted_timestamp
+        self.sorted_game = array.array('q') # Likewise for self.game
+        self.in_order = True # False if self.sorted_* need to be rebuilt
+
+    def __len__(self):
+        return len(self.group)
+
+
+    def extend(self, rows, games):
+        # Add records, given with a parallel list of their game numbers
+        self.game.extend(games)
+        for (user_id, role_id, win_bool, merge_count, timestamp), game in zip(rows, games):
+            key = (user_id, role_id, bool(win_bool), merge_count)
+            code = self.group_codes.get(key)
+            if code is None:
+                code = self.group_codes[key] = len(self.groups)
+                self.groups.append(key)
+            micros = to_micros(timestamp)
+            self.group.append(code)
+            self.totals[code] += 1
+            self.months.setdefault((timestamp.year, timestamp.month), collections.Counter())[code] += 1
+            self.timestamp.append(micros)
+            if self.in_order:
+                if self.sorted_timestamp and (micros < self.sorted_timestamp[-1]):
+                    self.in_order = False
+                else:
+                    self.sorted_timestamp.append(micros)
+                    self.sorted_group.append(code)
+                    self.sorted_game.append(game)
+
+
+    def sort(self):
+        # Rebuild the time-sorted columns after records were added out of order
+        if self.in_order:
+            return
+        order = sorted(range(len(self.timestamp)), key=self.timestamp.__getitem__)
+        self.sorted_timestamp = array.array('q', [self.timestamp[i] for i in order])
+        self.sorted_group = array.array('l', [self.group[i] for i in order])
+        self.sorted_game = array.array('q', [self.game[i] for i in order])
+        self.in_order = True
+
+
+    def month_range(self, after, before):
+        # The list of (year, month) pairs making up [after, before) if both ends
+        # fall on the start of a month, else None
+        if (after is None) or (before is None) or (after >= before):
+            return None
+        for ts in (after, before):
+            if (ts.day, ts.hour, ts.minute, ts.second, ts.microsecond) != (1, 0, 0, 0, 0):
+                return None
+        months = []
+        year, month = after.year, after.month
+        while (year, month) < (before.year, before.month):
+            months.append((year, month))
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return months
+
+
+    def tally(self, after=None, before=None):
+        # Count the records with each distinct (user_id, role_id, win, merge_count),
+        # optionally restricted to timestamps in [after, before). There are only a
+        # few of these groups per player, so callers can filter and sum the groups
+        # rather than the records.
+        months = self.month_range(after, before)
+        if (after is None) and (before is None):
+            counts = self.totals
+        elif months is not None:
+            counts = collections.Counter()
+            for month in months:
+                counts.update(self.months.get(month, ()))
+        else:
+            self.sort()
+            lo = 0 if after is None else bisect.bisect_left(self.sorted_timestamp, to_micros(after))
+            hi = len(self.sorted_timestamp) if before is None else bisect.bisect_left(self.sorted_timestamp, to_micros(before))
+            # Count in chunks: each Counter pass holds the GIL, and this may be
+            # running on a thread alongside the event loop
+            counts = collections.Counter()
+            for start in range(lo, hi, self.CHUNK):
+                counts.update(self.sorted_group[start:min(start + self.CHUNK, hi)])
+        return {self.groups[code]: count for code, count in counts.items()}
+
+
+
+
+class StatsStore:
+
+    # Append-only stats log.
+    # Every record is a tuple of the form (user_id, role_id, win_bool, merge_count, timestamp),
+    # kept in chronological order. Records are only ever inserted, never rewritten, so
+    # saving new stats costs time proportional to the number of new records. The store
+    # also keeps a checkpoint of the last channel message that was scanned for stats.
+    # Each record is also numbered with the game it came from: every role reveal
+    # of a game gets the same number, and later games get higher numbers.
+
+    def __init__(self, path=STATS_DB, legacy_path=LEGACY_STATS_FILE):
+        self.path = path
+        self.legacy_path = legacy_path
+        self.db = None # The sqlite3 connection, opened lazily
+        self.columns = None # In-memory copy of every record as a StatsColumns, loaded lazily
+        self.next_game = None # Number to give the next game added
+        self.version = 0 # Incremented whenever records are added
+
+
+    def open(self):
+        # Connect to the database, creating and migrating it if necessary
+        if self.db is not None:
+            return
+        self.db = sqlite3.connect(self.path)
+        with self.db:
+            self.db.execute('''CREATE TABLE IF NOT EXISTS stats (
+                id INTEGER PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                role_id INTEGER NOT NULL,
+                win INTEGER NOT NULL,
+                merge_count INTEGER NOT NULL,
+                timestamp INTEGER NOT NULL,
+                game INTEGER)''')
+            self.db.execute('''CREATE TABLE IF NOT EXISTS games (
+                id INTEGER PRIMARY KEY,
+                message_id INTEGER UNIQUE,
+                timestamp INTEGER NOT NULL,
+                record TEXT NOT NULL,
+                game INTEGER,
+                channel INTEGER)''')
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS names (user_id INTEGER PRIMARY KEY, name TEXT NOT NULL)')
+            # Skill ratings (see avalon_ratings.py); kind is 'good', 'evil' or a role ID
+            self.db.execute('''CREATE TABLE IF NOT EXISTS ratings (
+                user_id INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                rating REAL NOT NULL,
+                games INTEGER NOT NULL,
+                PRIMARY KEY (user_id, kind))''')
+            # Each player's side ratings at the end of each month they played in; month is year * 100 + month
+            self.db.execute('''CREATE TABLE IF NOT EXISTS rating_months (
+                user_id INTEGER NOT NULL,
+                month INTEGER NOT NULL,
+                good REAL,
+                evil REAL,
+                games INTEGER NOT NULL,
+                PRIMARY KEY (user_id, month))''')
+        self.number_games()
+        self.index_channels()
+        self.next_game = (self.db.execute('SELECT MAX(game) FROM stats').fetchone()[0] or 0) + 1
+        self.migrate()
+
+
+    def number_games(self):
+        # One-time numbering of the games in a database from before records had
+        # game numbers. The records of a game all have the same timestamp.
+        if 'game' in [column[1] for column in self.db.execute('PRAGMA table_info(stats)')]:
+            return
+        numbers = {}
+        updates = []
+        for row_id, timestamp in self.db.execute('SELECT id, timestamp FROM stats ORDER BY id'):
+            updates.append((numbers.setdefault(timestamp, len(numbers) + 1), row_id))
+        with self.db:
+            self.db.execute('ALTER TABLE stats ADD COLUMN game INTEGER')
+            if 'game' not in [column[1] for column in self.db.execute('PRAGMA table_info(games)')]:
+                self.db.execute('ALTER TABLE games ADD COLUMN game INTEGER')
+            self.db.executemany('UPDATE stats SET game = ? WHERE id = ?', updates)
+            self.db.execute('UPDATE games SET game = (SELECT game FROM stats WHERE stats.timestamp = games.timestamp LIMIT 1)')
+
+
+    def index_channels(self):
+        # Index the games table by the channel each game was played in, first
+        # filling in the channels from the game records in a database from
+        # before the table had a column for them
+        if 'channel' not in [column[1] for column in self.db.execute('PRAGMA table_info(games)')]:
+            updates = [(json.loads(record).get('channel'), row_id) for row_id, record in self.db.execute('SELECT id, record FROM games')]
+            with self.db:
+                self.db.execute('ALTER TABLE games ADD COLUMN channel INTEGER')
+                self.db.executemany('UPDATE games SET channel = ? WHERE id = ?', updates)
+        with self.db:
+            self.db.execute('CREATE INDEX IF NOT EXISTS games_channel ON games (channel)')
+
+
+    def migrate(self):
+        # One-time import of the old pickled stats list
+        if self.get_meta('migrated') or not os.path.exists(self.legacy_path):
+            return
+        with open(self.legacy_path, 'rb') as o:
+            stats = pickle.load(o)
+        with self.db:
+            self.advance(self.insert(stats))
+            self.set_meta('migrated', 1)
+            if stats:
+                # The old file was built by scanning the channel history up to here
+                self.set_meta('scanned_until', to_micros(stats[-1][-1]))
+        os.replace(self.legacy_path, self.legacy_path + '.migrated')
+
+
+    def get_meta(self, key, default=None):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, value))
+
+
+    def insert(self, rows, game=None):
+        # Internal method to write records without committing. They are all
+        # from `game` if it's given, or else from one game per timestamp.
+        # Returns the list of their game numbers.
+        if game is not None:
+            games = [game] * len(rows)
+        else:
+            numbers = {}
+            games = [numbers.setdefault(timestamp, self.next_game + len(numbers)) for user_id, role_id, win_bool, merge_count, timestamp in rows]
+        self.db.executemany('INSERT INTO stats (user_id, role_id, win, merge_count, timestamp, game) VALUES (?, ?, ?, ?, ?, ?)',
+                            [(user_id, role_id, int(win_bool), merge_count, to_micros(timestamp), game) \
+                             for (user_id, role_id, win_bool, merge_count, timestamp), game in zip(rows, games)])
+        return games
+
+
+    def advance(self, games):
+        # Internal method to move self.next_game past the given game numbers
+        # once they have been committed
+        if games:
+            self.next_game = max(self.next_game, max(games) + 1)
+
+
+
+
+    def load(self):
+        # Return the StatsColumns holding all records (shared, so don't modify it)
+        if self.columns is None:
+            self.open()
+            records = self.db.execute('SELECT user_id, role_id, win, merge_count, timestamp, game FROM stats ORDER BY id').fetchall()
+            self.columns = StatsColumns()
+            self.columns.extend([(user_id, role_id, bool(win), merge_count, from_micros(timestamp)) \
+                                 for user_id, role_id, win, merge_count, timestamp, game in records],
+                                [record[5] for record in records])
+        return self.columns
+
+
+    def recent(self, count):
+        # List of the last `count` records, oldest first
+        columns = self.load()
+        start = max(len(columns) - count, 0)
+        return [columns.groups[code] + (from_micros(timestamp),) \
+                for code, timestamp in zip(columns.group[start:], columns.timestamp[start:])]
+
+
+    def tally(self, after=None, before=None):
+        # Grouped record counts for a stats query; see StatsColumns.tally()
+        self.load()
+        return self.columns.tally(after, before)
+
+
+    def append(self, rows, checkpoint=None):
+        # Add new records to the end of the log, and optionally move the checkpoint
+        # to the ID of the last message that was scanned. Both happen in one transaction.
+        self.load()
+        with self.db:
+            games = self.insert(rows)
+            if checkpoint is not None:
+                self.set_meta('checkpoint', checkpoint)
+        self.advance(games)
+        self.columns.extend(rows, games)
+        self.version += 1
+
+
+    def record_game(self, record, rows, timestamp, message_id=None):
+        # Store the structured record of a finished game (a JSON-serializable dict)
+        # together with the stats records it produced. `message_id` is the ID of
+        # the role reveal message, so that a later history backfill can skip it.
+        self.load()
+        game = self.next_game
+        with self.db:
+            self.db.execute('INSERT INTO games (message_id, timestamp, record, game, channel) VALUES (?, ?, ?, ?, ?)',
+                            (message_id, to_micros(timestamp), json.dumps(record), game, record.get('channel')))
+            games = self.insert(rows, game)
+        self.advance([game])
+        self.columns.extend(rows, games)
+        self.version += 1
+
+
+    def has_game(self, message_id):
+        # True if the game revealed in the given message was recorded directly
+        self.open()
+        return self.db.execute('SELECT 1 FROM games WHERE message_id = ?', (message_id,)).fetchone() is not None
+
+
+    def games(self):
+        # Iterate over all recorded games, oldest first
+        self.open()
+        for record, in self.db.execute('SELECT record FROM games ORDER BY id'):
+            yield json.loads(record)
+
+
+    def last_game(self, channel_id):
+        # The record of the last game recorded as played in the given channel, or None
+        self.open()
+        row = self.db.execute('SELECT record FROM games WHERE channel = ? ORDER BY id DESC LIMIT 1', (channel_id,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+
+    def names(self):
+        # Dict mapping user IDs to the last username seen for them
+        self.open()
+        return dict(self.db.execute('SELECT user_id, name FROM names'))
+
+
+    def save_names(self, names):
+        # Remember the usernames in the given dict, so that stats can still be
+        # shown for people after they leave the server
+        self.open()
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO names (user_id, name) VALUES (?, ?)', names.items())
+
+
+    def load_ratings(self):
+        # The saved skill ratings as a dict with lists of 'ratings' and 'months'
+        # rows plus the state saved by save_ratings(), or None if there are none
+        self.open()
+        state = self.get_meta('ratings')
+        if state is None:
+            return None
+        saved = json.loads(state)
+        saved['ratings'] = self.db.execute('SELECT user_id, kind, rating, games FROM ratings').fetchall()
+        saved['months'] = self.db.execute('SELECT user_id, month, good, evil, games FROM rating_months').fetchall()
+        return saved
+
+
+    def save_ratings(self, ratings, months, state, replace=False):
+        # Save changed rows of the ratings and rating_months tables, along with a
+        # JSON-serializable dict of any other state, in one transaction. If
+        # `replace` is set, the given rows replace everything saved before.
+        self.open()
+        with self.db:
+            if replace:
+                self.db.execute('DELETE FROM ratings')
+                self.db.execute('DELETE FROM rating_months')
+            self.db.executemany('INSERT OR REPLACE INTO ratings (user_id, kind, rating, games) VALUES (?, ?, ?, ?)', ratings)
+            self.db.executemany('INSERT OR REPLACE INTO rating_months (user_id, month, good, evil, games) VALUES (?, ?, ?, ?, ?)', months)
+            self.set_meta('ratings', json.dumps(state))
+
+
+    def checkpoint(self):
+        # ID of the last message scanned for stats, or None
+        self.open()
+        return self.get_meta('checkpoint')
+
+
+    def scanned_until(self):
+        # Timestamp the channel history had been scanned up to before the
+        # checkpoint existed (i.e. in the old pickle file), or None
+        self.open()
+        micros = self.get_meta('scanned_until')
+        return None if micros is None else from_micros(micros)
+
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
@@ -0,0 +1,179 @@
+# Load test for the Avalon bot
+# Plays many games at once against a MockServer (see mock_discord.py). Scripted
+# players send every command (create, join, start, pick, approve/reject,
+# success/fail, lady, assassinate) through on_message, as Discord would, and
+# the benchmark reports command throughput, handler latency, Discord API calls
+# per game and peak memory. Save the results with --json and pass them to a
+# later run with --compare to catch regressions between releases.
+#
+# Usage: python benchmarks/bench_load.py [-g GAMES] [-c CHANNELS] [-p PLAYERS] [--delay SECONDS]
+#                                        [--seed SEED] [--memory] [--perf] [--json PATH] [--compare PATH] [features...]
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import avalon_engine
+from avalon_engine import EVIL
+
+from mock_discord import MockServer
+
+
+
+class Player:
+
+    # Sends commands to the client and times how long it takes to handle them
+
+    def __init__(self, client, server, latencies):
+        self.client = client
+        self.server = server
+        self.latencies = latencies
+
+    async def say(self, user, channel, content, mentions=()):
+        message = self.server.message(user, channel, content, mentions)
+        start = time.perf_counter()
+        await self.client.on_message(message)
+        self.latencies.append(time.perf_counter() - start)
+
+    async def whisper(self, user, content):
+        await self.say(user, user.dm, content)
+
+
+async def play_game(player, channel, users, features, rng):
+    # Play one game in `channel` from creation until its result has been recorded
+    client = player.client
+    await player.say(users[0], channel, 'av create')
+    for user in users[1:]:
+        await player.say(user, channel, 'av join')
+    for feature in features:
+        await player.say(users[0], channel, 'av enable %s' % feature)
+    await player.say(users[0], channel, 'av start')
+    game = client.games.get(channel.id)
+    while client.games.get(channel.id) is game:
+        phase = game.phase()
+        if phase == 'pick':
+            team = rng.sample([p.user for p in game.players if p not in game.team], game.current_quest[0] - len(game.team))
+            await player.say(game.leader.user, channel, 'av pick %s' % ' '.join([user.mention for user in team]), team)
+        elif phase == 'vote':
+            await asyncio.gather(*[player.whisper(p.user, rng.choice(['av approve', 'av approve', 'av reject'])) \
+                                   for p in game.players if p.vote is None])
+        elif phase == 'outcome':
+            await asyncio.gather(*[player.whisper(p.user, 'av fail' if (p.side == EVIL) and (rng.random() < 0.5) else 'av success') \
+                                   for p in game.team if p.outcome is None])
+        elif phase == 'lady':
+            target = rng.choice([p for p in game.players if (p is not game.lady) and (p not in game.investigated)]).user
+            await player.say(game.lady.user, channel, 'av lady %s' % target.mention, [target])
+        elif phase == 'assassin':
+            target = rng.choice([p for p in game.players if p is not game.assassin]).user
+            await player.say(game.assassin.user, channel, 'av assassinate %s' % target.mention, [target])
+        else:
+            await asyncio.sleep(0.001) # In a dramatic pause, or waiting for the result to be recorded
+
+
+async def run(args, directory):
+    server = MockServer(args.channels, args.channels * args.players)
+    client = server.client(directory)
+    client.VOTE_DELAY = args.delay
+    await client.on_ready()
+    latencies = []
+    player = Player(client, server, latencies)
+    rng = random.Random(args.seed)
+    remaining = [args.games]
+    async def channel_worker(channel, users, seed):
+        # Play games in one channel, one after another, until enough have been played
+        worker_rng = random.Random(seed)
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            await play_game(player, channel, users, args.features, worker_rng)
+    users = list(server.users.values())
+    workers = [channel_worker(channel, users[i * args.players:(i + 1) * args.players], rng.getrandbits(64)) \
+               for i, channel in enumerate(server.game_channels())]
+    server.api_calls.clear() # Only count calls made while playing
+    start = time.perf_counter()
+    await asyncio.gather(*workers)
+    elapsed = time.perf_counter() - start
+    # Let any messages still queued go out, then shut down
+    await asyncio.sleep(max(args.delay, client.COALESCE_WINDOW) * 2)
+    await client.in_stats_thread(client.stats_store.close)
+    client.stats_executor.shutdown()
+    if args.perf:
+        for text in client.metrics.report():
+            print(text)
+    return elapsed, latencies, server.api_calls
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the Avalon bot against a mock Discord server.')
+    parser.add_argument('-g', '--games', type=int, default=500, help='number of games to play')
+    parser.add_argument('-c', '--channels', type=int, default=50, help='number of games to play at once, each in its own channel')
+    parser.add_argument('-p', '--players', type=int, default=7, choices=sorted(avalon_engine.QUEST_LISTS), help='players per game')
+    parser.add_argument('--delay', type=float, default=0, help='seconds for dramatic pauses and before vote messages are deleted (default 0)')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--memory', action='store_true', help='trace Python memory allocations (slower) instead of reporting peak RSS')
+    parser.add_argument('--perf', action='store_true', help='print the bot\'s own av perf report at the end')
+    parser.add_argument('--json', help='save the results to this file')
+    parser.add_argument('--compare', help='compare with results saved by an earlier run')
+    parser.add_argument('features', nargs='*', help='features to enable (%s)' % ', '.join(avalon_engine.FEATURE_NAMES))
+    args = parser.parse_args()
+    avalon_engine.DRAMATIC_PAUSE = args.delay
+    if args.memory:
+        tracemalloc.start()
+    with tempfile.TemporaryDirectory() as directory:
+        elapsed, latencies, api_calls = asyncio.get_event_loop().run_until_complete(run(args, directory))
+    if args.memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # Reported in kilobytes on Linux
+    latencies.sort()
+    results = {
+        'games': args.games,
+        'commands': len(latencies),
+        'elapsed': elapsed,
+        'commands_per_second': len(latencies) / elapsed,
+        'games_per_second': args.games / elapsed,
+        'latency_p50_ms': percentile(latencies, 0.5) * 1000,
+        'latency_p99_ms': percentile(latencies, 0.99) * 1000,
+        'latency_max_ms': latencies[-1] * 1000,
+        'api_calls_per_game': sum(api_calls.values()) / args.games,
+        'api_calls': dict(api_calls),
+        'peak_memory_mb': peak / 2 ** 20,
+        'memory': 'python heap' if args.memory else 'rss',
+        }
+    print('%d games, %d players each, %d at a time: %d commands in %.2fs' % \
+          (args.games, args.players, args.channels, results['commands'], elapsed))
+    print('%.0f commands/s, %.1f games/s' % (results['commands_per_second'], results['games_per_second']))
+    print('handler latency: p50 %.3fms, p99 %.3fms, max %.2fms' % \
+          (results['latency_p50_ms'], results['latency_p99_ms'], results['latency_max_ms']))
+    print('API calls per game: %.1f (%s)' % (results['api_calls_per_game'], ', '.join(['%s %.1f' % (kind, count / args.games) \
+                                                                                     for kind, count in sorted(api_calls.items())])))
+    print('peak memory (%s): %.1f MB' % (results['memory'], results['peak_memory_mb']))
+    if args.compare:
+        with open(args.compare) as o:
+            baseline = json.load(o)
+        print('Compared with %s:' % args.compare)
+        for key in ('commands_per_second', 'latency_p50_ms', 'latency_p99_ms', 'api_calls_per_game', 'peak_memory_mb'):
+            if baseline.get(key):
+                print('  %s: %.2f -> %.2f (%+.1f%%)' % (key, baseline[key], results[key], 100 * (results[key] / baseline[key] - 1)))
+    if args.json:
+        with open(args.json, 'w') as o:
+            json.dump(results, o, indent=2)
+
+
+
+if __name__ == '__main__':
+    main()
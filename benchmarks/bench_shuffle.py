@@ -0,0 +1,93 @@
+# Benchmark for Spotify-mode role assignment
+# Compares the old approach (materialize every permutation of the roles, sample
+# 500 of them and filter against recent stats) with the constrained sampler in
+# avalon_engine.py, for every supported player count.
+#
+# Usage: python benchmarks/bench_shuffle.py [repeats]
+
+import os
+import sys
+import time
+import random
+import datetime
+import itertools
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from avalon_engine import Role, N_EVIL, SPOTIFY_HISTORY, spotify_constraints, constrained_shuffle
+
+
+
+def legacy_shuffle(roles, ids, stats):
+    # The original Avalon.spotify_shuffle, minus the stats fetch
+    roles = [i if isinstance(i, tuple) else (i,) for i in roles]
+    sample = list(itertools.permutations(roles))
+    if len(sample) > 500:
+        sample = random.sample(sample, 500)
+    count = 0
+    for user_id, role_id, win_bool, merge_count, timestamp in stats[::-1]:
+        count += 1
+        role = Role(role_id)
+        if user_id in ids:
+            index = ids.index(user_id)
+            newsample = [perm for perm in sample if role not in perm[index]]
+            if not newsample:
+                return list(random.choice(sample))
+            sample = newsample
+            if count == SPOTIFY_HISTORY:
+                return list(random.choice(sample))
+    return list(random.choice(sample))
+
+
+def new_shuffle(roles, ids, stats):
+    return constrained_shuffle(roles, spotify_constraints(roles, ids, stats))
+
+
+
+def make_game(n):
+    # Build a role list like secret_info does, plus some fake recent history
+    n_evil = N_EVIL[n]
+    good = ([Role.MERLIN, Role.PERCIVAL] + [Role.SERVANT] * n)[:n - n_evil]
+    evil = ([Role.ASSASSIN, Role.MORGANA] + [Role.MINION] * n)[:n_evil]
+    roles = [(role, True) for role in good] + [(role, False) for role in evil]
+    ids = list(range(1000, 1000 + n))
+    now = datetime.datetime.utcnow()
+    stats = []
+    for game in range(SPOTIFY_HISTORY // n + 1):
+        shuffled = roles[:]
+        random.shuffle(shuffled)
+        for user_id, (role, side) in zip(ids, shuffled):
+            stats.append((user_id, role.value, side, 1, now))
+    return roles, ids, stats
+
+
+def measure(func, roles, ids, stats, repeats):
+    # Time the runs with tracemalloc off, since it slows allocation down a lot,
+    # then make one more run to find the peak memory use
+    start = time.perf_counter()
+    for i in range(repeats):
+        func(roles, ids, stats)
+    elapsed = (time.perf_counter() - start) / repeats
+    tracemalloc.start()
+    func(roles, ids, stats)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    random.seed(0)
+    print('%7s | %12s %12s | %12s %12s' % ('players', 'legacy time', 'legacy peak', 'new time', 'new peak'))
+    for n in sorted(N_EVIL):
+        roles, ids, stats = make_game(n)
+        old_time, old_peak = measure(legacy_shuffle, roles, ids, stats, repeats)
+        new_time, new_peak = measure(new_shuffle, roles, ids, stats, repeats * 100)
+        print('%7d | %10.2fms %10.1fKB | %10.3fms %10.1fKB' % \
+              (n, old_time * 1000, old_peak / 1024, new_time * 1000, new_peak / 1024))
+
+
+
+if __name__ == '__main__':
+    main()
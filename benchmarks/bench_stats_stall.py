@@ -0,0 +1,135 @@
+# Benchmark for event loop stalls during av stats
+# Fills a scratch stats database with fake games, then runs a series of av stats
+# queries (with the reply cache cleared each time) while a heartbeat task
+# measures how late the event loop wakes it up. With --inline the stats work is
+# done on the event loop itself, as it was before it moved to the stats thread.
+#
+# Usage: python benchmarks/bench_stats_stall.py [--inline] [-r RECORDS] [-q QUERIES]
+
+import os
+import sys
+import time
+import random
+import asyncio
+import argparse
+import datetime
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import discord
+
+from avalon import Avalon
+from avalon_stats import StatsStore
+
+QUERIES = ['', 'merlin', 'good', 'evil', 'after 01/01/2020', 'before 06/15/2020', 'player3', '<@1003> evil']
+
+HEARTBEAT = 0.001 # Seconds between heartbeat wakeups
+
+
+
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.name = 'player%d' % (user_id - 1000)
+        self.nick = None
+        self.mention = '<@%d>' % user_id
+
+
+class FakeTyping:
+    async def __aenter__(self):
+        pass
+    async def __aexit__(self, *args):
+        pass
+
+
+class FakeChannel:
+    # Just enough of a text channel for av stats
+    type = discord.ChannelType.text
+    id = 1
+    def __init__(self):
+        self.sent = []
+    async def send(self, text):
+        self.sent.append(text)
+    def typing(self):
+        return FakeTyping()
+
+
+class FakeMessage:
+    def __init__(self, author, channel, content):
+        self.author = author
+        self.channel = channel
+        self.content = content
+
+
+
+def make_store(path, n_records):
+    # Fill a new stats store with about `n_records` records from random 7-player games
+    store = StatsStore(path, path + '.legacy')
+    rng = random.Random(0)
+    timestamp = datetime.datetime(2020, 1, 1)
+    rows = []
+    while len(rows) < n_records:
+        timestamp += datetime.timedelta(hours=rng.random() * 12)
+        good_won = (rng.random() < 0.5)
+        for user_id in rng.sample(range(1000, 1020), 7):
+            role_id = rng.randrange(1, 11)
+            rows.append((user_id, role_id, (good_won == (role_id in (1, 3, 6))), 1, timestamp))
+    store.append(rows)
+    store.close()
+    return StatsStore(path, path + '.legacy')
+
+
+async def heartbeat(lags):
+    # Record how late each wakeup is
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(HEARTBEAT)
+        lags.append(time.perf_counter() - start - HEARTBEAT)
+
+
+async def run(store, n_queries, inline):
+    client = Avalon()
+    client.stats_store = store
+    if inline:
+        async def in_stats_thread(func, *args):
+            return func(*args)
+        client.in_stats_thread = in_stats_thread
+    users = [FakeUser(user_id) for user_id in range(1000, 1020)]
+    for user in users:
+        client.index_names(user.id, user.name)
+    channel = FakeChannel()
+    await client.in_stats_thread(store.load) # As on_ready does
+    lags = []
+    monitor = asyncio.ensure_future(heartbeat(lags))
+    await asyncio.sleep(HEARTBEAT)
+    start = time.perf_counter()
+    for i in range(n_queries):
+        client.stats_cache.clear()
+        await client.av_stats(FakeMessage(users[0], channel, 'av stats %s' % QUERIES[i % len(QUERIES)]))
+        await asyncio.sleep(HEARTBEAT * 2) # Commands arrive one at a time
+    elapsed = time.perf_counter() - start
+    monitor.cancel()
+    await client.in_stats_thread(store.close)
+    client.stats_executor.shutdown()
+    return elapsed, lags
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure event loop stalls during av stats.')
+    parser.add_argument('--inline', action='store_true', help='do the stats work on the event loop')
+    parser.add_argument('-r', '--records', type=int, default=300000, help='number of stats records')
+    parser.add_argument('-q', '--queries', type=int, default=40, help='number of queries to run')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        store = make_store(os.path.join(tmp, 'stats.db'), args.records)
+        elapsed, lags = asyncio.get_event_loop().run_until_complete(run(store, args.queries, args.inline))
+    lags.sort()
+    print('%d queries over %d records in %.2fs (%s)' % (args.queries, args.records, elapsed, 'inline' if args.inline else 'stats thread'))
+    print('event loop stall: max %.1fms, p99 %.1fms, median %.2fms' % \
+          (lags[-1] * 1000, lags[int(len(lags) * 0.99)] * 1000, lags[len(lags) // 2] * 1000))
+
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+# Local stand-in for the parts of Discord the Avalon bot uses
+# A MockServer holds one guild with text channels (including the bot's default
+# and ping channels), the Avalon role and a set of users, each with a private
+# channel. MockServer.client() returns a MockAvalon: the real Avalon client,
+# with everything discord.Client would get from its connection supplied by the
+# server instead, so messages can be fed straight to on_message. Every call
+# the bot makes that would reach Discord's API is counted in server.api_calls,
+# and in the client's metrics under the API route it would have used.
+
+import os
+import sys
+import asyncio
+import datetime
+import itertools
+import collections
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import discord
+
+from avalon import Avalon
+from avalon_stats import StatsStore
+
+HISTORY = 100 # Number of recent messages each channel keeps for history()
+
+ROUTES = {
+    # The Discord API route each kind of call would use
+    'send': 'POST /channels/{channel_id}/messages',
+    'delete': 'DELETE /channels/{channel_id}/messages/{message_id}',
+    'typing': 'POST /channels/{channel_id}/typing',
+    'history': 'GET /channels/{channel_id}/messages',
+    }
+
+
+
+class MockTyping:
+    async def __aenter__(self):
+        pass
+    async def __aexit__(self, *args):
+        pass
+
+
+class MockMessage:
+
+    def __init__(self, server, author, channel, content, mentions=()):
+        self.server = server
+        self.id = next(server.ids)
+        self.author = author
+        self.channel = channel
+        self.content = content
+        self.mentions = list(mentions)
+        self.channel_mentions = []
+        self.guild = channel.guild
+        self.created_at = datetime.datetime.utcnow()
+        self.deleted = False
+
+    async def delete(self, delay=None):
+        self.server.api_call('delete')
+        self.deleted = True
+
+
+class MockChannel:
+
+    def __init__(self, server, channel_id, name, guild=None):
+        self.server = server
+        self.id = channel_id
+        self.name = name
+        self.guild = guild
+        self.type = discord.ChannelType.text if guild else discord.ChannelType.private
+        self.mention = '<#%d>' % channel_id
+        self.messages = collections.deque(maxlen=HISTORY) # Most recent messages sent here
+
+    async def send(self, text):
+        self.server.api_call('send')
+        message = MockMessage(self.server, self.server.bot, self, text)
+        self.messages.append(message)
+        return message
+
+    async def trigger_typing(self):
+        self.server.api_call('typing')
+
+    def typing(self):
+        self.server.api_call('typing')
+        return MockTyping()
+
+    async def history(self, limit=100, after=None, oldest_first=False):
+        self.server.api_call('history')
+        messages = [m for m in self.messages if (after is None) or (m.id > after.id)]
+        if not oldest_first:
+            messages.reverse()
+        for message in messages[:limit]:
+            yield message
+
+
+class MockUser:
+
+    def __init__(self, server, user_id, name):
+        self.id = user_id
+        self.name = name
+        self.nick = None
+        self.mention = '<@%d>' % user_id
+        self.dm = MockChannel(server, next(server.ids), name)
+
+    async def send(self, text):
+        return (await self.dm.send(text))
+
+
+class MockRole:
+
+    def __init__(self, role_id, name):
+        self.id = role_id
+        self.name = name
+        self.mention = '<@&%d>' % role_id
+
+
+class MockGuild:
+
+    def __init__(self, guild_id):
+        self.id = guild_id
+        self.channels = []
+        self.roles = []
+        self.members = []
+
+
+
+
+class MockAvalon(Avalon):
+
+    # The Avalon client, connected to a MockServer instead of Discord
+
+    user = None # Plain attributes in place of discord.Client's read-only properties
+    guilds = ()
+
+    def __init__(self, server):
+        Avalon.__init__(self)
+        self.server = server
+        self.user = server.bot
+        self.guilds = [server.guild]
+
+    def get_all_channels(self):
+        return iter(self.server.guild.channels)
+
+    def get_all_members(self):
+        return iter(self.server.guild.members)
+
+    def get_channel(self, channel_id):
+        return self.server.channels.get(channel_id)
+
+    def get_user(self, user_id):
+        return self.server.users.get(user_id)
+
+    async def wait_for(self, event, check=None, timeout=None):
+        raise asyncio.TimeoutError # Nobody ever answers
+
+
+
+
+class MockServer:
+
+    # A guild with `n_channels` channels for games besides the bot's own two,
+    # and `n_users` users
+
+    def __init__(self, n_channels, n_users):
+        self.ids = itertools.count(10 ** 17) # Snowflakes for everything created here
+        self.api_calls = collections.Counter() # Number of calls made to each kind of API
+        self.metrics = None # Metrics of the client, once there is one
+        self.bot = MockUser(self, next(self.ids), 'avalon')
+        self.guild = MockGuild(next(self.ids))
+        self.guild.roles.append(MockRole(Avalon.ROLE_ID, 'avalon'))
+        self.guild.channels.append(MockChannel(self, Avalon.DEFAULT_CHANNEL, 'avalon', self.guild))
+        self.guild.channels.append(MockChannel(self, Avalon.PING_CHANNEL, 'off-topic', self.guild))
+        for i in range(n_channels):
+            self.guild.channels.append(MockChannel(self, next(self.ids), 'avalon-%d' % (i + 1), self.guild))
+        for i in range(n_users):
+            self.guild.members.append(MockUser(self, next(self.ids), 'player%d' % (i + 1)))
+        self.channels = {channel.id: channel for channel in self.guild.channels}
+        self.users = {user.id: user for user in self.guild.members}
+
+    def api_call(self, kind):
+        self.api_calls[kind] += 1
+        if self.metrics:
+            self.metrics.api_call(ROUTES[kind])
+
+    def game_channels(self):
+        return self.guild.channels[2:]
+
+    def client(self, directory):
+        # A MockAvalon for this server that keeps its stats and game snapshots
+        # in `directory`. Call its on_ready() before sending it messages.
+        client = MockAvalon(self)
+        client.stats_store = StatsStore(os.path.join(directory, 'stats.db'), os.path.join(directory, 'stats.legacy'))
+        client.SNAPSHOT_DIR = os.path.join(directory, 'games')
+        self.metrics = client.metrics
+        return client
+
+    def message(self, author, channel, content, mentions=()):
+        return MockMessage(self, author, channel, content, mentions)